@@ -0,0 +1,284 @@
+# Сервер мессенджера на asyncio (режим async, запуск: server.py -m async).
+# Говорит на том же JIM-протоколе, что и MsgTCPServer (presence, get_contacts, sync_contacts, msg, add_contact,
+# del_contact, join, leave, get_history), но каждое подключение обслуживается отдельной корутиной, поэтому сервер
+# не перебирает всех клиентов на каждой итерации цикла и может держать десятки тысяч подключений в одном процессе.
+
+import asyncio
+import signal
+from server import MsgTCPServer, log, STATE_PRESENCE, POLICY_DISCONNECT, POLICY_DROP, CONTACTS_DELAY, FORWARD_BATCH, BACKLOG
+from jim.utils import InvalidMessage, decode_message, BUFFER_SIZE
+
+# Интервал проверки, опустел ли буфер транспорта клиента (см. AsyncMsgServer.when_sent), с
+SENT_CHECK_INTERVAL = 0.01
+
+
+class AsyncMsgServer(MsgTCPServer):
+    """ Сервер мессенджера на asyncio-потоках (streams).
+    Вместо сокетов в словаре self.clients хранятся объекты StreamWriter подключенных клиентов.
+    Исходящие данные буферизуются транспортами asyncio, поэтому очереди self.outbox не используются.
+    """
+
+    def __init__(self, address, **kwargs):
+        super().__init__(address, **kwargs)
+        self.congested = set() # получатели, буфер которых переполнился при обработке текущего запроса (POLICY_PAUSE)
+        self.db_waits = {} # словарь клиент-future выполняющегося запроса к БД
+        self.stopped = None # событие остановки сервера (создается в цикле событий методом serve)
+        self.flush_scheduled = False # запись журнала сообщений в файлы запланирована в цикле событий
+
+    @log
+    def mainloop(self):
+        """ Основная функция: создает сессию для работы с БД и запускает цикл событий asyncio.
+
+        :return: None
+        """
+        self.create_db_session() # создание сессии для работы с БД
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        """ Запускает asyncio-сервер на уже созданном слушающем сокете и обслуживает подключения.
+
+        :return: None
+        """
+        self.stopped = asyncio.Event()
+        # SIGTERM обрабатывается в цикле событий, а не прерывает его в произвольном месте
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, self.stop)
+        server = await asyncio.start_server(self.handle_client, sock=self.s, backlog=BACKLOG)
+        async with server:
+            await self.stopped.wait()
+
+    def stop(self):
+        """ Останавливает сервер (вызывается в цикле событий).
+
+        :return: None
+        """
+        if self.stopped is not None:
+            self.stopped.set()
+
+    async def handle_client(self, reader, writer):
+        """ Корутина обслуживания одного клиента: читает запросы клиента и обрабатывает их
+        функциями process_request и write_responses, пока клиент не отключится.
+
+        :param reader: StreamReader клиента
+        :param writer: StreamWriter клиента
+        :return: None
+        """
+        print("Получен запрос на соединение с %s" % str(writer.get_extra_info('peername')))
+        self.new_client(writer)
+        writer.transport.set_write_buffer_limits(high=self.high_water, low=self.low_water)
+        try:
+            while True:
+                data = await reader.read(BUFFER_SIZE)
+                if not data:
+                    break
+                decoder = self.get_decoder(writer, data)
+                if decoder is not None:
+                    # В framed-режиме за одно чтение может прийти несколько запросов (или часть запроса)
+                    decoder.feed(data)
+                for i in range(1 if decoder is None else len(decoder.ready)):
+                    try:
+                        message = decode_message(data) if decoder is None else decoder.pop()
+                        request = self.process_request(writer, message)
+                    except InvalidMessage as e:
+                        self.reject(writer, e)
+                        continue
+                    if request:
+                        self.write_responses({writer: request}, list(self.clients))
+                        self.schedule_flush()
+                    # Следующий запрос клиента обрабатывается только после ответа на запрос к БД
+                    waiting = self.db_waits.pop(writer, None)
+                    if waiting is not None:
+                        await asyncio.wait([waiting])
+                # Не читаем следующий запрос, пока буфер ответов клиенту не опустеет до нижней границы
+                await writer.drain()
+                # и пока не опустеют переполненные этим запросом буферы получателей (POLICY_PAUSE)
+                congested, self.congested = self.congested, set()
+                for receiver in congested:
+                    try:
+                        await receiver.drain()
+                    except ConnectionError:
+                        pass
+        except Exception:
+            pass
+        print('Клиент {} отключился'.format(writer.get_extra_info('peername')))
+        self.disconnect(writer)
+
+    def schedule_flush(self):
+        """ Планирует запись журнала сообщений в файлы после обработки запросов, готовых в этой итерации
+        цикла событий (одна запись на все запросы итерации, как в основном цикле MsgTCPServer).
+
+        :return: None
+        """
+        if self.msglog is not None and not self.flush_scheduled:
+            self.flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self.flush_msglog)
+
+    def flush_msglog(self):
+        """ Записывает журнал сообщений в файлы (вызывается циклом событий).
+
+        :return: None
+        """
+        self.flush_scheduled = False
+        self.msglog.flush()
+
+    def client_ip(self, writer):
+        """ Возвращает IP-адрес клиента
+
+        :param writer: StreamWriter клиента
+        :return: IP-адрес
+        """
+        return writer.get_extra_info('peername')[0]
+
+    def new_client(self, writer):
+        """ Добавляет в список клиентов только что подключившегося клиента.
+
+        :param writer: StreamWriter клиента
+        :return: None
+        """
+        self.clients[writer] = ''
+        self.states[writer] = STATE_PRESENCE
+
+    def send_to(self, writer, data, sender=None, framed=None):
+        """ Отправляет клиенту байты data (данные буферизуются транспортом asyncio).
+        Если буфер транспорта превысил верхнюю границу, применяется политика для медленного клиента:
+        - POLICY_DROP: сообщение отбрасывается (буфер транспорта нельзя почистить, поэтому
+          в отличие от MsgTCPServer отбрасываются новые, а не самые старые сообщения)
+        - POLICY_DISCONNECT: клиент отключается
+        - POLICY_PAUSE: сообщение записывается, а корутина отправителя перед чтением следующего запроса
+          ждет, пока буфер получателя опустеет до нижней границы
+
+        :param writer: StreamWriter клиента
+        :param data: отправляемые байты
+        :param sender: не используется (отправитель - клиент, запрос которого обрабатывается сейчас)
+        :param framed: уже упакованный в кадр data (см. MsgTCPServer.frame)
+        :return: None
+        """
+        if writer not in self.clients:
+            return  # клиент уже отключен
+        if writer.transport.get_write_buffer_size() >= self.high_water:
+            if self.slow_policy == POLICY_DISCONNECT:
+                print('Клиент {} {} не успевает принимать сообщения'.format(
+                    writer.get_extra_info('peername'), self.clients[writer]))
+                self.disconnect(writer)
+                return
+            elif self.slow_policy == POLICY_DROP:
+                return
+            self.congested.add(writer)
+        writer.write(self.frame(writer, data, framed))
+
+    def db_call(self, writer, job, done):
+        """ Выполняет запрос к БД job(хранилище) в пуле потоков (см. MsgTCPServer.db_call).
+        Результат передается функции done в цикле событий, а корутина клиента ждет его перед обработкой
+        следующего запроса.
+
+        :param writer: StreamWriter клиента
+        :param job: функция, выполняющая запрос к хранилищу (вызывается в потоке пула)
+        :param done: функция обработки результата запроса
+        :return: None
+        """
+        if self.db_pool is None:
+            return super().db_call(writer, job, done)
+        future = asyncio.get_running_loop().run_in_executor(self.db_pool, self.run_db_job, job)
+        future.add_done_callback(lambda future: self.db_finish(writer, future, done))
+        self.db_waits[writer] = future
+
+    def start_forwarding(self, writer):
+        """ Запускает корутину отправки клиенту сообщений из его очереди (см. MsgTCPServer.start_forwarding).
+
+        :param writer: StreamWriter клиента
+        :return: None
+        """
+        if self.pending is None or writer in self.forwarding or self.clients[writer] in self.claims:
+            return
+        reader = self.pending.claim(self.clients[writer])
+        if reader is not None:
+            self.forwarding[writer] = (reader, None)
+            self.claims[self.clients[writer]] = writer
+            asyncio.get_running_loop().create_task(self.forward_pending_to(writer, reader))
+
+    async def forward_pending_to(self, writer, reader):
+        """ Отправляет клиенту сообщения из очереди частями: клиенту с кадрированием - по FORWARD_BATCH
+        сообщений, дожидаясь опустошения буфера транспорта до нижней границы, клиенту без кадрирования -
+        по одному сообщению раз в CONTACTS_DELAY (после отложенного списка контактов). Сообщения, сохраненные
+        в очередь во время отправки, забираются и отправляются следом.
+
+        :param writer: StreamWriter клиента
+        :param reader: PendingReader очереди клиента
+        :return: None
+        """
+        framed = self.decoders.get(writer) is not None
+        if not framed:
+            await asyncio.sleep(2 * CONTACTS_DELAY)
+        while writer in self.forwarding:
+            if reader.done:
+                reader.close()
+                # Сообщения, сохраненные в очередь во время отправки
+                reader = self.pending.claim(self.clients[writer])
+                if reader is None:
+                    del self.forwarding[writer]
+                    del self.claims[self.clients[writer]]
+                    return
+                self.forwarding[writer] = (reader, None)
+            for data in reader.read(FORWARD_BATCH if framed else 1):
+                self.send_to(writer, data)
+            try:
+                await writer.drain()
+            except ConnectionError:
+                break
+            await asyncio.sleep(0 if framed else CONTACTS_DELAY)
+        if self.forwarding.pop(writer, None) is not None:
+            reader.close()
+            del self.claims[self.clients[writer]]
+
+    def send_later(self, writer, data, delay, done=None):
+        """ Откладывает отправку клиенту байтов data на delay секунд (с помощью таймера цикла событий).
+
+        :param writer: StreamWriter клиента
+        :param data: отправляемые байты
+        :param delay: задержка, с
+        :param done: функция без аргументов, вызываемая после отправки (см. when_sent)
+        :return: None
+        """
+        asyncio.get_running_loop().call_later(delay, self.send_delayed, writer, data, done)
+
+    def send_delayed(self, writer, data, done=None):
+        """ Выполняет отложенную отправку, если клиент еще подключен.
+
+        :param writer: StreamWriter клиента
+        :param data: отправляемые байты
+        :param done: функция, вызываемая после отправки
+        :return: None
+        """
+        if writer in self.clients:
+            self.send_to(writer, data)
+            if done is not None:
+                self.when_sent(writer, done)
+
+    def when_sent(self, writer, done):
+        """ Вызывает done, когда буфер транспорта клиента опустеет, т.е. все записанные данные будут
+        переданы в сокет (см. MsgTCPServer.when_sent). Если клиент отключится раньше, done не вызывается.
+
+        :param writer: StreamWriter клиента
+        :param done: функция без аргументов
+        :return: None
+        """
+        if writer not in self.clients:
+            return
+        if writer.transport.get_write_buffer_size():
+            asyncio.get_running_loop().call_later(SENT_CHECK_INTERVAL, self.when_sent, writer, done)
+        else:
+            done()
+
+    def disconnect(self, writer):
+        """ Удаляет клиента из списка клиентов и закрывает соединение.
+
+        :param writer: StreamWriter клиента
+        :return: None
+        """
+        username = self.clients.pop(writer, None)
+        self.remove_route(writer, username)
+        self.db_waits.pop(writer, None)
+        self.leave_all(writer)
+        self.stop_forwarding(writer, username)
+        self.decoders.pop(writer, None)
+        self.states.pop(writer, None)
+        writer.close()
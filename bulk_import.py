@@ -0,0 +1,86 @@
+# Массовая загрузка клиентов и списков контактов в базу данных сервера из CSV или JSONL
+# (запуск: python bulk_import.py clients users.csv, python bulk_import.py contacts contacts.jsonl [--delete]).
+# Файл читается потоком, а записи пишутся в БД большими транзакциями (см. Repo.add_clients_bulk),
+# поэтому загрузка миллионов записей не требует ни памяти под весь файл, ни коммита на каждую запись.
+# Форматы строк:
+# - clients: CSV "имя[,информация]" или JSONL {"name": "...", "info": "..."}
+# - contacts: CSV "клиент,контакт" или JSONL {"client": "...", "contact": "..."}
+
+import argparse
+import csv
+import json
+import sys
+import time
+from sqlalchemy.orm import sessionmaker
+from server import create_db_engine
+from repo.server_repo import Repo
+
+
+def create_parser():
+    """ Создает парсер аргументов командной строки.
+
+    :return: парсер
+    >>> create_parser().parse_args(['contacts', 'contacts.csv', '--delete'])
+    Namespace(kind='contacts', file='contacts.csv', format=None, delete=True)
+    """
+    parser = argparse.ArgumentParser(description='Массовая загрузка клиентов и контактов в базу данных сервера')
+    parser.add_argument('kind', choices=('clients', 'contacts'), help='что загружается')
+    parser.add_argument('file', help='файл CSV или JSONL (- - стандартный ввод)')
+    parser.add_argument('--format', choices=('csv', 'jsonl'), default=None,
+                        help='формат файла (по умолчанию - по расширению, иначе csv)')
+    parser.add_argument('--delete', action='store_true', help='удалить перечисленные контакты вместо добавления')
+    return parser
+
+
+def read_records(lines, file_format, fields):
+    """ Читает записи из строк файла по мере обработки (пустые строки пропускаются).
+
+    :param lines: итератор строк файла
+    :param file_format: 'csv' или 'jsonl'
+    :param fields: имена полей записи JSONL (и их количество в строке CSV)
+    :return: генератор кортежей значений полей (отсутствующие поля - None)
+    """
+    if file_format == 'jsonl':
+        for line in lines:
+            if line.strip():
+                record = json.loads(line)
+                yield tuple(record.get(field) for field in fields)
+    else:
+        for row in csv.reader(lines):
+            if row:
+                yield tuple(row[:len(fields)]) + (None,) * (len(fields) - len(row))
+
+
+def bulk_import(repo, kind, records, delete=False):
+    """ Загружает записи в хранилище.
+
+    :param repo: хранилище сервера
+    :param kind: 'clients' или 'contacts'
+    :param records: поток записей (см. read_records)
+    :param delete: удалить контакты вместо добавления
+    :return: Counter с количеством обработанных записей по результатам
+    """
+    if kind == 'clients':
+        return repo.add_clients_bulk(records)
+    if delete:
+        return repo.del_contacts_bulk(records)
+    return repo.add_contacts_bulk(records)
+
+
+if __name__ == '__main__':
+    namespace = create_parser().parse_args()
+    file_format = namespace.format or ('jsonl' if namespace.file.endswith(('.jsonl', '.json')) else 'csv')
+    fields = ('name', 'info') if namespace.kind == 'clients' else ('client', 'contact')
+
+    session = sessionmaker(bind=create_db_engine())()
+    repo = Repo(session)
+    started = time.time()
+    if namespace.file == '-':
+        counts = bulk_import(repo, namespace.kind, read_records(sys.stdin, file_format, fields), namespace.delete)
+    else:
+        with open(namespace.file, encoding='utf-8', newline='') as f:
+            counts = bulk_import(repo, namespace.kind, read_records(f, file_format, fields), namespace.delete)
+    session.close()
+    print('Обработано записей: {} за {:.1f} с ({})'.format(
+        sum(counts.values()), time.time() - started,
+        ', '.join('{}: {}'.format(result, count) for result, count in sorted(counts.items()))))
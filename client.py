@@ -4,17 +4,25 @@
 #   -r: получить сообщения от клиентов-писателей и вывести в чат
 #   -w: отправить сообщения в чат
 #
-# Параметры командной строки: client.py -r -w <host> [<port>]
+# Параметры командной строки: client.py -r -w -f <host> [<port>]
 
 import logging
 import log_config
 import argparse
+import datetime
+from os import path
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import NullPool
+from sqlalchemy.orm import sessionmaker, scoped_session
+from repo.client_models import Base
+from repo.client_repo import Repo, MsgHistoryWriter
 from socket import socket, AF_INET, SOCK_STREAM
 from jim import utils
 from jim.config import JIMMsg, code_dict
 import sys
 from PyQt5.QtWidgets import QApplication, QWidget, qApp
 from PyQt5.QtCore import pyqtSignal, QObject, pyqtSlot, QThread, QEvent
+from PyQt5.QtGui import QTextCursor
 import chatform
 import addcontact
 import delcontact
@@ -25,6 +33,9 @@ import time
 # Получаем ссылку на объект getLogger('msg')
 logger = logging.getLogger('msg')
 
+# Количество сообщений из локальной истории, которые показываются при запуске и подгружаются при прокрутке чата
+HISTORY_RENDER = 50
+
 def log(func):
     """ Декорирует функцию func для логгирования ее имени и аргументов согласно настройкам объекта logger.
 
@@ -39,24 +50,57 @@ def log(func):
 
 @log
 def create_parser():
-    """ Возвращает парсер четырех аргуметов командной строки: -r, -w, IP-адрес и порт.
+    """ Возвращает парсер пяти аргуметов командной строки: -r, -w, -f, IP-адрес и порт.
     IP-адрес - обязательный аргумент. Порт - необязательный (по умолчанию задается как [7777]).
     -r - признак клиента-читателя. -w - признак клиента-писателя.
+    -f - признак framed-режима (сообщения передаются кадрами с заголовком длины).
 
     Следующий тест сработает при передаче в качестве в командной строке одного аргумента localhost.
     >>> create_parser()
-    Namespace(addr='localhost', port='[7777]', r=False, w=False)
+    Namespace(addr='localhost', f=False, port='[7777]', r=False, w=False)
 
-    :return: парсер четырех аргументов (-r, -w, адрес - обязательный, порт - необязательный)
+    :return: парсер пяти аргументов (-r, -w, -f, адрес - обязательный, порт - необязательный)
     """
     parser = argparse.ArgumentParser()
     parser.add_argument('-r', action='store_const', const=True, default=False)
     parser.add_argument('-w', action='store_const', const=True, default=False)
+    parser.add_argument('-f', action='store_const', const=True, default=False)
     parser.add_argument('addr')
     parser.add_argument('port', nargs='?', default='[7777]')
     return parser.parse_args()
 
 
+@log
+def create_db_engine(username, db_path=None):
+    """ Создает движок локальной базы данных клиента (история сообщений) и ее структуру, если ее еще нет.
+    У каждого пользователя своя база repo/client_<логин>.db. История пишется отдельным потоком,
+    а читается потоком интерфейса, поэтому база работает в режиме WAL (чтение не ждет записи).
+
+    :param username: имя пользователя
+    :param db_path: путь к файлу базы данных (по умолчанию repo/client_<логин>.db)
+    :return: движок базы данных
+    """
+    DB_PATH = db_path or path.join(path.dirname(path.abspath(__file__)), 'repo', 'client_{}.db'.format(username))
+    engine = create_engine('sqlite:///{}'.format(DB_PATH), echo=False, poolclass=NullPool)
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode = WAL')
+        cursor.close()
+    Base.metadata.create_all(engine)
+    return engine
+
+
+def msg_time(msg):
+    """ Возвращает время сообщения сервера в виде datetime (как оно хранится в локальной истории).
+
+    :param msg: словарь сообщения
+    :return: datetime
+    """
+    return datetime.datetime.fromtimestamp(msg['time'])
+
+
 @log
 def client_type(namespace):
     """ Возвращает тип клинта (r или w) в зависимости от содержания namespace.
@@ -124,21 +168,54 @@ class ContactList:
 
     @log
     def get_client_contacts(self):
-        get_contacts_msg = JIMMsg(action='get_contacts').msg
-        utils.send_message(self.client.s, get_contacts_msg)
-        accept = utils.get_message(self.client.s)
-        contacts = utils.get_message(self.client.s)['message']
-        # if accept['quantity']:
-        #    print('Ваши контакты: ')
-        #    for i in range(accept['quantity']):
-        #        print(utils.get_message(self.client.s)['user']['account_name'])
-        return contacts
+        """ Получает список контактов. Если открыта локальная история, с сервера запрашиваются только изменения
+        после версии сохраненной в ней копии списка (sync_contacts), а копия обновляется.
+
+        :return: список имен контактов
+        """
+        if self.client.history is None:
+            get_contacts_msg = JIMMsg(action='get_contacts').msg
+            self.client.send_message(get_contacts_msg)
+            accept = self.client.get_message()
+            contacts = self.client.get_message()['message']
+            # if accept['quantity']:
+            #    print('Ваши контакты: ')
+            #    for i in range(accept['quantity']):
+            #        print(utils.get_message(self.client.s)['user']['account_name'])
+            return contacts
+        self.sync()
+        self.client.get_message()  # ответ 202
+        self.save_changes(self.client.get_message())
+        return self.client.history.get_contact_list(self.client.user.username)[0]
+
+    @log
+    def sync(self):
+        """ Отправляет запрос sync_contacts с версией локальной копии списка контактов (0 - копии нет).
+
+        :return: None
+        """
+        version = 0
+        if self.client.history is not None:
+            version = self.client.history.get_contact_list(self.client.user.username)[1]
+        self.client.send_message(JIMMsg(action='sync_contacts', version=version).msg)
+
+    def save_changes(self, msg):
+        """ Сохраняет в локальной копии списка контактов полученный с сервера список (contact_list)
+        или его изменения (contact_changes).
+
+        :param msg: словарь сообщения contact_list или contact_changes
+        :return: None
+        """
+        if self.client.history is not None:
+            self.client.history.apply_contact_changes(self.client.user.username, msg.get('version', 0),
+                                                      msg['message'], msg.get('removed', ()),
+                                                      full=msg['action'] == 'contact_list')
 
     @log
     def add_contact(self, contact_username):
         add_contact_msg = JIMMsg(action='add_contact', login=contact_username).msg
         #print(add_contact_msg)
-        utils.send_message(self.client.s, add_contact_msg)
+        self.client.send_message(add_contact_msg)
         #resp = utils.get_message(self.client.s)
         #return resp
 
@@ -146,7 +223,7 @@ class ContactList:
     def del_contact(self, contact_username):
         del_contact_msg = JIMMsg(action='del_contact', login=contact_username).msg
         #print(del_contact_msg)
-        utils.send_message(self.client.s, del_contact_msg)
+        self.client.send_message(del_contact_msg)
         #resp = utils.get_message(self.client.s)
         #return resp
 
@@ -160,13 +237,41 @@ class User:
 
 class MsgTCPClient:
     @log
-    def __init__(self, type, address=None):
+    def __init__(self, type, address=None, framed=False):
         self.s = socket(AF_INET, SOCK_STREAM)
         self.type = type
+        self.framed = framed
+        # Декодер кадров соединения (только для framed-режима)
+        self.decoder = utils.FrameDecoder() if framed else None
         if address: # для возможности тестирования без подключения к серверу
             self.s.connect(address)
         # self.login = ''
         self.user = User(None)
+        self.history = None # локальная история сообщений (Repo, открывается методом open_history)
+        self.history_writer = None # поток записи локальной истории
+
+    @log
+    def open_history(self, db_path=None):
+        """ Открывает локальную историю сообщений пользователя и запускает поток ее записи.
+
+        :param db_path: путь к файлу базы данных (по умолчанию repo/client_<логин>.db)
+        :return: None
+        """
+        Session = scoped_session(sessionmaker(bind=create_db_engine(self.user.username, db_path)))
+        self.history = Repo(Session)
+        self.history_writer = MsgHistoryWriter(Session)
+        self.history_writer.start()
+
+    def save_message(self, username, message, msg_time):
+        """ Ставит сообщение в очередь записи локальной истории.
+
+        :param username: имя отправителя
+        :param message: текст сообщения
+        :param msg_time: время сообщения (datetime)
+        :return: None
+        """
+        if self.history_writer is not None:
+            self.history_writer.add(username, message, msg_time)
 
     @log
     def create_presence_message(self):
@@ -177,31 +282,64 @@ class MsgTCPClient:
         return JIMMsg(action='presence', login=self.user.username).msg
 
     @log
-    def create_chat_message(self, message):
+    def create_chat_message(self, message, to=None):
         """ Создает словарь/json сообщения для последующей отправки в чат.
 
         :param message: сообщение для заполнения поля message в json
+        :param to: имя пользователя-адресата личного сообщения (None - сообщение в чат)
         :return: словарь/json сообщения
         """
         #print('**' + message + '**')
-        return JIMMsg(action='msg', message=message).msg
+        return JIMMsg(action='msg', message=message, to=to).msg
 
     @log
     def send_message(self, jsonmsg, group=None):
         """ Отправляет сообщения на сервер.
 
         :param jsonmsg: отправляемое сообщение
+        :param group: имя группы (чата), в которую отправляется сообщение
         :return: длина отправленного сообщения (для тестирования)
         """
-        utils.send_message(self.s, jsonmsg, group)
+        utils.send_message(self.s, jsonmsg, group, self.framed)
         return len(jsonmsg)
 
+    @log
+    def join_group(self, group):
+        """ Отправляет на сервер запрос на вступление в группу (чат).
+
+        :param group: имя группы
+        :return: None
+        """
+        self.send_message(JIMMsg(action='join', group=group).msg)
+
+    @log
+    def leave_group(self, group):
+        """ Отправляет на сервер запрос на выход из группы (чата).
+
+        :param group: имя группы
+        :return: None
+        """
+        self.send_message(JIMMsg(action='leave', group=group).msg)
+
+    @log
+    def get_history(self, to=None, group=None, cursor=None, limit=None):
+        """ Отправляет на сервер запрос страницы истории переписки
+        (сервер отвечает сообщением history с курсором следующей, более старой страницы).
+
+        :param to: имя пользователя (история личной переписки с ним)
+        :param group: имя группы (история группы); без to и group - история общего чата
+        :param cursor: курсор из предыдущего ответа history (None - последние сообщения)
+        :param limit: количество сообщений на странице (None - по умолчанию сервера)
+        :return: None
+        """
+        self.send_message(JIMMsg(action='get_history', to=to, cursor=cursor, limit=limit).msg, group)
+
     def get_message(self):
         """ Получает сообщения от сервера.
 
         :return: словарь / json-сообщение
         """
-        return utils.get_message(self.s)
+        return utils.get_message(self.s, self.decoder)
 
     @log
     def resp_code_into_text(self, srv_response):
@@ -230,6 +368,7 @@ class MsgTCPClient:
         self.send_message(self.create_presence_message())
         response = self.get_message()
         print(self.resp_code_into_text(response))
+        self.open_history()
 
         #contact_list = ContactList(self)
         #print(contact_list.get_client_contacts())
@@ -295,7 +434,10 @@ class MsgTCPClient:
 class ReceiveHandler(QObject):
     ''' Обработчик входящего сетевого соединения
     '''
-    gotData = pyqtSignal(str)
+    gotMessage = pyqtSignal(object)
+    gotHistory = pyqtSignal(object)
+    gotContacts = pyqtSignal(object)
+    contactsChanged = pyqtSignal()
 
     @log
     def __init__(self, client):
@@ -312,10 +454,19 @@ class ReceiveHandler(QObject):
                 if response == b'':
                     print('Получено пустое соообщение!')
                     break
+                elif not isinstance(response, dict):
+                    pass  # обрывок сообщения, не поместившегося в буфер приема (без кадрирования)
+                elif response.get('action') == 'history':
+                    self.gotHistory.emit(response)
+                elif response.get('action') in ('contact_list', 'contact_changes'):
+                    self.gotContacts.emit(response)
                 elif 'message' in response.keys():
-                    self.gotData.emit(' >> ' + response['message'])
+                    self.gotMessage.emit(response)
                 elif 'response' in response.keys():
-                    if response['response'] == 500:
+                    # Ответ 200 окно получает только на add_contact и del_contact: список контактов изменен
+                    if response['response'] == 200:
+                        self.contactsChanged.emit()
+                    elif response['response'] == 500:
                         print('contact was not added as it does not exist')
             except OSError as e:
                 pass  # timeout вышел
@@ -338,6 +489,15 @@ class MyWindow(QWidget):
         self.thread = None
         self.clnt = client
         self.is_active = False
+        self.history_cursor = None # курсор следующей (более старой) страницы истории чата (None - история прочитана)
+        self.history_requested = False # запрошенная страница истории еще не получена
+        self.oldest_shown = None # время самого старого показанного сообщения (datetime)
+        self.sync_since = None # время последнего сообщения других пользователей в локальной истории
+        self.sync_own = False # свои сообщения уже есть в локальной истории (при синхронизации пропускаются)
+        self.syncing = False # с сервера запрашиваются сообщения, пришедшие после sync_since
+        self.synced = [] # сообщения, полученные при синхронизации
+        self.received = set() # (отправитель, время) сообщений, полученных во время синхронизации
+        self.dm_target = None # контакт, которому отправляются личные сообщения (None - общий чат)
 
         self.contacts = ContactList(self.clnt).get_client_contacts()
         self.updateCL.connect(self.show_contact_list)
@@ -345,6 +505,8 @@ class MyWindow(QWidget):
         #self.show_contact_list()
         self.ui.pushAdd.clicked.connect(self.show_add_contact_form)
         self.ui.pushDelete.clicked.connect(self.show_del_contact_form)
+        # Двойной щелчок по контакту включает личную переписку с ним, повторный (или Esc) - возврат в общий чат
+        self.ui.listWidget.itemDoubleClicked.connect(self.toggle_dm_target)
 
         self.show_contact_list()
         self.start_chat()
@@ -355,10 +517,14 @@ class MyWindow(QWidget):
         self.receiver.is_active = False
         self.thread.quit()
         self.thread.wait()
+        if self.clnt.history_writer is not None:
+            self.clnt.history_writer.close()
 
     def keyPressEvent(self, event):
         if event.key() == 16777220:
             self.sendMsg.emit(0)
+        elif event.key() == 16777216:
+            self.set_dm_target(None)
 
     @log
     @pyqtSlot(str)
@@ -366,13 +532,36 @@ class MyWindow(QWidget):
         msg = str(time.ctime()) + data
         self.ui.textBrowser.append(msg)
 
+    def format_msg(self, username, message, msg_time):
+        direction = ' << ' if username == self.clnt.user.username else ' >> '
+        return str(time.ctime(msg_time.timestamp())) + direction + message
+
+    @log
+    @pyqtSlot(object)
+    def receive_msg(self, msg):
+        """ Показывает полученное сообщение и сохраняет его в локальной истории. """
+        if self.syncing:
+            self.received.add((msg['user']['account_name'], msg['time']))
+        self.show_msg(msg)
+
+    def show_msg(self, msg):
+        self.ui.textBrowser.append(self.format_msg(msg['user']['account_name'], msg['message'], msg_time(msg)))
+        self.clnt.save_message(msg['user']['account_name'], msg['message'], msg_time(msg))
+        if self.oldest_shown is None:
+            self.oldest_shown = msg_time(msg)
+
     @log
     def start_chat(self):
         self.is_active = True
 
         self.receiver = ReceiveHandler(self.clnt)
-        self.receiver.gotData.connect(self.update_chat)
+        self.receiver.gotMessage.connect(self.receive_msg)
+        self.receiver.gotHistory.connect(self.show_history)
+        self.receiver.gotContacts.connect(self.update_contacts)
+        self.receiver.contactsChanged.connect(self.sync_contacts)
         self.sentData.connect(self.update_chat)
+        # Когда чат прокручен до начала, подгружается следующая страница истории
+        self.ui.textBrowser.verticalScrollBar().valueChanged.connect(self.scroll_history)
 
         # Создание потока и помещение объекта-получателя в этот поток
         self.thread = QThread(self)
@@ -388,11 +577,111 @@ class MyWindow(QWidget):
 
         # Запуск потока
         self.thread.start()
+        self.show_cached()
+        # С сервера запрашиваются только сообщения, пришедшие после сохраненных в локальной истории.
+        # Страница истории не помещается в один recv без кадрирования, поэтому историю запрашивает только framed-клиент
+        if self.clnt.framed:
+            self.syncing = True
+            self.request_history()
+
+    @log
+    def show_cached(self):
+        """ Сразу при запуске показывает последние сообщения из локальной истории. """
+        rows = self.clnt.history.get_messages(HISTORY_RENDER)
+        for username, message, msg_time in rows:
+            self.ui.textBrowser.append(self.format_msg(username, message, msg_time))
+        if rows:
+            self.oldest_shown = rows[0][2]
+        # Свои сообщения попадают в локальную историю при отправке
+        self.sync_own = bool(rows)
+        self.sync_since = self.clnt.history.last_message_time(exclude=self.clnt.user.username)
+        self.clnt.history.session.close()
+
+    def request_history(self, cursor=None):
+        self.history_requested = True
+        self.clnt.get_history(cursor=cursor)
+
+    def scroll_history(self, value):
+        """ Когда чат прокручен до начала, показывает более старые сообщения из локальной истории,
+        а когда она закончилась - запрашивает их у сервера. """
+        if value != 0 or self.syncing or self.history_requested:
+            return
+        rows = self.clnt.history.get_messages(HISTORY_RENDER, before=self.oldest_shown) if self.oldest_shown else []
+        self.clnt.history.session.close()
+        if rows:
+            cursor = QTextCursor(self.ui.textBrowser.document())
+            for username, message, msg_time in rows:
+                cursor.insertText(self.format_msg(username, message, msg_time))
+                cursor.insertBlock()
+            self.oldest_shown = rows[0][2]
+        elif self.history_cursor:
+            self.request_history(self.history_cursor)
+
+    @log
+    @pyqtSlot(object)
+    def show_history(self, history):
+        """ Обрабатывает страницу истории чата (сообщение history): при синхронизации добавляет в конец чата
+        сообщения, которых еще нет в локальной истории, иначе вставляет более старые сообщения в начало чата. """
+        self.history_requested = False
+        self.history_cursor = history.get('cursor')
+        if self.syncing:
+            self.sync_history(history['message'])
+            return
+        older = [msg for msg in history['message'] if self.oldest_shown is None or msg_time(msg) < self.oldest_shown]
+        cursor = QTextCursor(self.ui.textBrowser.document())
+        for msg in older:
+            cursor.insertText(self.format_msg(msg['user']['account_name'], msg['message'], msg_time(msg)))
+            cursor.insertBlock()
+            self.clnt.save_message(msg['user']['account_name'], msg['message'], msg_time(msg))
+        if older:
+            self.oldest_shown = msg_time(older[0])
+        elif self.history_cursor:
+            # Вся страница уже есть в локальной истории
+            self.request_history(self.history_cursor)
+
+    def sync_history(self, messages):
+        """ Собирает сообщения страниц истории, пришедшие после sync_since, и показывает их,
+        когда дошел до уже сохраненных (без локальной истории - только последнюю страницу). """
+        own = self.clnt.user.username if self.sync_own else None
+        self.synced[:0] = [msg for msg in messages
+                           if msg['user']['account_name'] != own
+                           and (self.sync_since is None or msg_time(msg) > self.sync_since)
+                           and (msg['user']['account_name'], msg['time']) not in self.received]
+        if self.history_cursor and self.sync_since is not None and messages and msg_time(messages[0]) > self.sync_since:
+            self.request_history(self.history_cursor)
+            return
+        self.syncing = False
+        for msg in self.synced:
+            self.show_msg(msg)
+        self.synced = []
+        self.received.clear()
+
+    def toggle_dm_target(self, item):
+        """ Включает личную переписку с контактом, по которому дважды щелкнули,
+        а для текущего получателя личных сообщений - возвращает в общий чат.
+        """
+        self.set_dm_target(None if item.text() == self.dm_target else item.text())
+
+    def set_dm_target(self, contact):
+        """ Задает получателя личных сообщений и показывает его в заголовке окна и в поле ввода.
+
+        :param contact: имя контакта или None для возврата в общий чат
+        """
+        self.dm_target = contact
+        if contact is None:
+            self.ui.listWidget.clearSelection()
+            self.setWindowTitle('QtMessenger')
+            self.ui.lineEdit.setPlaceholderText('')
+        else:
+            self.setWindowTitle('QtMessenger - личные сообщения для ' + contact)
+            self.ui.lineEdit.setPlaceholderText('Сообщение для ' + contact + ' (Esc - общий чат)')
 
     def send_msg_to_socket(self):
         text = self.ui.lineEdit.text()
-        self.clnt.send_message(self.clnt.create_chat_message(text))
-        self.sentData.emit(' << ' + text)
+        # Личное сообщение отправляется, только если получатель выбран явно (двойным щелчком по контакту)
+        self.clnt.send_message(self.clnt.create_chat_message(text, to=self.dm_target))
+        self.clnt.save_message(self.clnt.user.username, text, datetime.datetime.now())
+        self.sentData.emit(' << ' + ('@' + self.dm_target + ': ' if self.dm_target else '') + text)
         #self.ui.textBrowser.append(self.clnt.user.username + ': ' + text)
         self.ui.lineEdit.clear()
         return text
@@ -400,6 +689,35 @@ class MyWindow(QWidget):
     def show_contact_list(self):
         self.ui.listWidget.addItems(self.contacts)
 
+    def sync_contacts(self):
+        """ Запрашивает изменения списка контактов (после ответа сервера на добавление или удаление контакта,
+        иначе запрос может опередить изменение), ответ обрабатывает функция update_contacts.
+        """
+        ContactList(self.clnt).sync()
+
+    def update_contacts(self, msg):
+        """ Сохраняет полученный список контактов или его изменения в локальной копии и обновляет только
+        изменившиеся строки списка контактов окна.
+
+        :param msg: словарь сообщения contact_list или contact_changes
+        """
+        ContactList(self.clnt).save_changes(msg)
+        if msg['action'] == 'contact_list':
+            added = [name for name in msg['message'] if name not in self.contacts]
+            removed = [name for name in self.contacts if name not in msg['message']]
+        else:
+            added, removed = msg['message'], msg.get('removed', [])
+        for name in removed:
+            if name in self.contacts:
+                self.ui.listWidget.takeItem(self.contacts.index(name))
+                self.contacts.remove(name)
+            if name == self.dm_target:
+                self.set_dm_target(None)
+        for name in added:
+            if name not in self.contacts:
+                self.ui.listWidget.addItem(name)
+                self.contacts.append(name)
+
     def show_add_contact_form(self):
         self.add_contact_form = AddContactForm(client=self.clnt, window=self)
         self.add_contact_form.show()
@@ -424,9 +742,7 @@ class AddContactForm(QWidget):
         contact_list = ContactList(self.clnt)
         contact_list.add_contact(contact)
         self.ui.lineEdit.clear()
-        # self.mainwindow.updateCL.emit(0)
-        # self.mainwindow.ui.listWidget.addItem(contact)
-        # self.mainwindow.ui.listWidget.addItems(ContactList(self.clnt).get_client_contacts())
+        # Список в окне обновится, когда после ответа сервера придут изменения списка контактов
         self.close()
 
 
@@ -445,8 +761,6 @@ class DelContactForm(QWidget):
         contact_list = ContactList(self.clnt)
         contact_list.del_contact(contact)
         self.ui.lineEdit.clear()
-        # self.mainwindow.ui.listWidget.addItem(contact)
-        # self.mainwindow.ui.listWidget.addItems(ContactList(self.clnt).get_client_contacts())
         self.close()
 
 if __name__ == '__main__':
@@ -456,7 +770,7 @@ if __name__ == '__main__':
     type = client_type(namespace)
 
     # Создаем клиента и присоединяем его к чату
-    clnt = MsgTCPClient(type, address)
+    clnt = MsgTCPClient(type, address, namespace.f)
     clnt.chat_client()
 
 
@@ -0,0 +1,206 @@
+# Режим кластера сервера мессенджера (запуск: server.py --workers <N>).
+# Процесс-супервизор порождает N процессов-обработчиков, которые слушают один и тот же порт (SO_REUSEPORT),
+# поэтому ядро распределяет подключения между ними, и сервер использует N ядер процессора.
+# Сообщения, полученные одним обработчиком, рассылаются остальным по локальной шине
+# на датаграммных Unix-сокетах, и каждый обработчик доставляет их своим клиентам.
+
+import os
+import shutil
+import signal
+import tempfile
+import time
+import traceback
+from collections import deque
+from socket import socket, AF_UNIX, SOCK_DGRAM, SOL_SOCKET, SO_RCVBUF
+from server import MsgTCPServer, create_db_engine, log
+
+
+# Размер буфера приема сокета шины (ограничен сверху настройкой ядра net.core.rmem_max)
+BUS_BUFFER_SIZE = 4 * 1024 * 1024
+# Максимальный размер датаграммы, принимаемой из шины
+BUS_MAX_MESSAGE = 1024 * 1024
+# Максимальное количество сообщений, ожидающих отправки одному обработчику (при превышении отбрасываются старые)
+BUS_PENDING_LIMIT = 10000
+# Пауза перед перезапуском завершившегося обработчика, с (чтобы не перезапускать его в цикле при ошибке запуска)
+RESPAWN_DELAY = 1
+
+
+class MsgBus:
+    """ Шина рассылки сообщений между процессами-обработчиками.
+    У каждого обработчика есть свой датаграммный Unix-сокет для приема; сообщение отправляется в сокеты
+    всех остальных через подключенные к ним сокеты-каналы. Сокеты для приема всех обработчиков создаются
+    супервизором до порождения процессов, поэтому к моменту подключения каналов они уже существуют.
+    Если очередь приема обработчика заполнена, сообщения копятся в очереди канала и отправляются,
+    когда канал снова готов к записи (подключенный датаграммный сокет сообщает об этом через select).
+    """
+
+    def __init__(self, directory, index, count):
+        """
+        :param directory: каталог для файлов сокетов шины
+        :param index: номер процесса-обработчика
+        :param count: количество процессов-обработчиков
+        """
+        paths = [os.path.join(directory, 'bus-{}.sock'.format(i)) for i in range(count)]
+        self.index = index
+        self.peers = [p for i, p in enumerate(paths) if i != index]
+        self.links = [] # сокеты-каналы к остальным обработчикам (создаются методом connect)
+        self.pending = {} # словарь канал-очередь неотправленных сообщений
+        self.sock = socket(AF_UNIX, SOCK_DGRAM)
+        self.sock.setsockopt(SOL_SOCKET, SO_RCVBUF, BUS_BUFFER_SIZE)
+        self.sock.bind(paths[index])
+        self.sock.setblocking(False)
+
+    def connect(self):
+        """ Подключает каналы к сокетам остальных обработчиков (вызывается в процессе-обработчике).
+
+        :return: None
+        """
+        for peer in self.peers:
+            link = socket(AF_UNIX, SOCK_DGRAM)
+            link.connect(peer)
+            link.setblocking(False)
+            self.links.append(link)
+            self.pending[link] = deque()
+
+    def publish(self, data):
+        """ Отправляет сообщение всем остальным процессам-обработчикам.
+        Обработчику, который не успевает принимать сообщения, сообщение ставится в очередь канала
+        (не больше BUS_PENDING_LIMIT сообщений, более старые отбрасываются).
+
+        :param data: байты сообщения
+        :return: None
+        """
+        for link in self.links:
+            queue = self.pending[link]
+            queue.append(data)
+            if len(queue) > BUS_PENDING_LIMIT:
+                queue.popleft()
+                print('Шина: обработчик {} не успевает принимать сообщения'.format(link.getpeername()))
+            if len(queue) == 1:
+                self.flush(link)
+
+    def flush(self, link):
+        """ Отправляет в канал сообщения из его очереди, пока канал готов к записи.
+
+        :param link: сокет-канал
+        :return: None
+        """
+        queue = self.pending[link]
+        while queue:
+            try:
+                link.send(queue[0])
+            except BlockingIOError:
+                break
+            except OSError as e:
+                print('Шина: сообщение не отправлено обработчику {}: {}'.format(link.getpeername(), e))
+            queue.popleft()
+
+    def receive(self):
+        """ Принимает все сообщения, уже полученные сокетом шины.
+
+        :return: список байтов сообщений
+        """
+        messages = []
+        while True:
+            try:
+                messages.append(self.sock.recv(BUS_MAX_MESSAGE))
+            except BlockingIOError:
+                break
+        return messages
+
+    def close(self):
+        for link in self.links:
+            link.close()
+        self.sock.close()
+
+
+def run_worker(address, bus, **options):
+    """ Основная функция процесса-обработчика: сервер в режиме reactor, подключенный к шине.
+
+    :param address: адрес для прослушивания
+    :param bus: шина рассылки сообщений (MsgBus) этого обработчика
+    :param options: настройки очередей исходящих сообщений (см. MsgTCPServer)
+    :return: None
+    """
+    if options.get('msglog'):
+        # Журнал пишет только один процесс, поэтому у каждого обработчика свой каталог журнала
+        options['msglog'] = os.path.join(options['msglog'], 'worker-{}'.format(bus.index))
+    serv = MsgTCPServer(address, reuse_port=True, **options)
+    bus.connect()
+    serv.bus = bus
+    # Остальные обработчики забывают пользователей, подключенных к этому обработчику до перезапуска
+    serv.announce('?')
+    # Обработчик завершается по SIGTERM супервизора после текущей итерации цикла, записав отложенные данные в БД
+    signal.signal(signal.SIGTERM, lambda signum, frame: serv.stop())
+    try:
+        serv.reactor_loop()
+    finally:
+        serv.close_db_session()
+
+
+@log
+def run_cluster(address, workers, **options):
+    """ Основная функция супервизора: порождает workers процессов-обработчиков и перезапускает
+    завершившиеся. По Ctrl+C (или SIGTERM) завершает обработчики и удаляет файлы шины.
+
+    :param address: адрес для прослушивания
+    :param workers: количество процессов-обработчиков
+    :param options: настройки очередей исходящих сообщений (см. MsgTCPServer)
+    :return: None
+    """
+    # Структура базы данных создается один раз до порождения обработчиков (иначе они создают ее наперегонки)
+    create_db_engine(options.get('storage')).dispose()
+    directory = tempfile.mkdtemp(prefix='msg-bus-')
+    buses = [MsgBus(directory, i, workers) for i in range(workers)]
+    children = {} # словарь pid-номер обработчика
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            # Процесс-обработчик: сокеты шины остальных обработчиков ему не нужны
+            status = 1
+            try:
+                for i, bus in enumerate(buses):
+                    if i != index:
+                        bus.close()
+                run_worker(address, buses[index], **options)
+            except KeyboardInterrupt:
+                status = 0
+            except Exception:
+                traceback.print_exc()
+            finally:
+                os._exit(status)
+        children[pid] = index
+        print('Запущен процесс-обработчик {} (pid {})'.format(index, pid))
+
+    def terminate(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        for i in range(workers):
+            spawn(i)
+        while True:
+            pid, status = os.wait()
+            index = children.pop(pid)
+            print('Процесс-обработчик {} (pid {}) завершился со статусом {}, перезапуск'.format(index, pid, status))
+            time.sleep(RESPAWN_DELAY)
+            spawn(index)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Повторный сигнал не должен прерывать завершение обработчиков и удаление файлов шины
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in children:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        for bus in buses:
+            bus.close()
+        shutil.rmtree(directory, ignore_errors=True)
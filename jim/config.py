@@ -1,3 +1,4 @@
+import json
 import time
 
 
@@ -10,19 +11,84 @@ code_dict = {
         }
 
 
+# Допустимые значения поля action
+JIM_ACTIONS = frozenset(['presence', 'msg', 'authenticate', 'get_contacts', 'contact_list', 'add_contact', 'del_contact',
+                         'join', 'leave', 'get_history', 'history', 'sync_contacts', 'contact_changes'])
+
+
 class JIMMsg:
-    def __init__(self, action, login=None, message=None):
+    def __init__(self, action, login=None, message=None, to=None, group=None, cursor=None, limit=None, version=None,
+                 removed=None):
         self.msg = {'action': '',
                     'time': '',
                     'user': {'account_name': ''},
                     'message': ''}
-        if action in ['presence', 'msg', 'authenticate', 'get_contacts', 'contact_list', 'add_contact', 'del_contact']:
+        if action in JIM_ACTIONS:
             self.msg['action'] = action
         else:
             raise Exception('Недопустимое значение поля action!')
         self.msg['time'] = time.time()
         self.msg['user']['account_name'] = login
         self.msg['message'] = message
+        if to:
+            # Личное сообщение: имя пользователя-адресата (без поля to сообщение рассылается всем)
+            self.msg['to'] = to
+        if group:
+            # Сообщение в группу (чат) или запрос на вступление в группу / выход из нее
+            self.msg['group'] = group
+        if cursor:
+            # Курсор страницы истории (get_history, history): с какого места продолжается чтение истории
+            self.msg['cursor'] = cursor
+        if limit:
+            # Количество сообщений на странице истории (get_history)
+            self.msg['limit'] = limit
+        if version is not None:
+            # Версия списка контактов (sync_contacts - версия копии клиента, contact_list и contact_changes - версия
+            # списка на сервере)
+            self.msg['version'] = version
+        if removed is not None:
+            # Удаленные контакты (contact_changes, добавленные - в поле message)
+            self.msg['removed'] = removed
+
+
+class JIMLiteMsg:
+    """Облегченное сообщение: поля хранятся в __slots__, а сериализация выполняется сразу в байты
+    без построения словаря (байты совпадают с json.dumps(JIMMsg(...).msg).encode('utf-8'))"""
+    __slots__ = ('action', 'time', 'login', 'message', 'to', 'group', 'version', 'removed')
+
+    def __init__(self, action, login=None, message=None, to=None, group=None, version=None, removed=None):
+        if action not in JIM_ACTIONS:
+            raise Exception('Недопустимое значение поля action!')
+        self.action = action
+        self.time = time.time()
+        self.login = login
+        self.message = message
+        self.to = to
+        self.group = group
+        self.version = version
+        self.removed = removed
+
+    def to_bytes(self):
+        return self.serialize(repr(self.time)).encode('utf-8')
+
+    def to_template(self):
+        """Шаблон байтов сообщения для повторной отправки: вместо времени в байтах остается подстановка %r
+        (как в RESPONSE_TEMPLATES)"""
+        return self.serialize('\0').replace('%', '%%').replace('\0', '%r').encode('utf-8')
+
+    def serialize(self, time_text):
+        parts = ['{"action": "', self.action, '", "time": ', time_text,
+                 ', "user": {"account_name": ', json.dumps(self.login), '}, "message": ', json.dumps(self.message)]
+        if self.to:
+            parts += [', "to": ', json.dumps(self.to)]
+        if self.group:
+            parts += [', "group": ', json.dumps(self.group)]
+        if self.version is not None:
+            parts += [', "version": ', json.dumps(self.version)]
+        if self.removed is not None:
+            parts += [', "removed": ', json.dumps(self.removed)]
+        parts.append('}')
+        return ''.join(parts)
 
 
 class JIMResponse:
@@ -45,6 +111,39 @@ class JIMResponse:
             self.resp['quantity'] = quantity
 
 
+def _response_template(response_code):
+    """Сериализует ответ один раз: вместо времени (и количества для ответа 202) в байтах остаются
+    подстановки %r и %d"""
+    resp = JIMResponse(response_code).resp
+    resp['time'] = '\0'
+    if response_code == 202:
+        resp['quantity'] = '\1'
+    text = json.dumps(resp).replace('%', '%%').replace('"\\u0000"', '%r').replace('"\\u0001"', '%d')
+    return text.encode('utf-8')
+
+
+# Заранее сериализованные ответы сервера (код ответа - шаблон байтов)
+RESPONSE_TEMPLATES = {code: _response_template(code) for code in (200, 202, 400, 500)}
+
+
+def history_bytes(messages, cursor, to=None, group=None):
+    """Байты сообщения history со страницей истории переписки (совпадают с json.dumps(JIMMsg('history', ...).msg)
+    с теми же сообщениями): сохраненные байты сообщений вставляются в список message как есть, без разбора json"""
+    text = JIMLiteMsg(action='history', message='\0', to=to, group=group).to_bytes()
+    if cursor:
+        text = text[:-1] + b', "cursor": ' + json.dumps(cursor).encode('utf-8') + b'}'
+    head, tail = text.split(b'"\\u0000"', 1)  # подстановка message идет раньше to и group
+    return head + b'[' + b', '.join(messages) + b']' + tail
+
+
+def response_bytes(response_code, quantity=None):
+    """Байты ответа сервера (совпадают с json.dumps(JIMResponse(...).resp).encode('utf-8')),
+    полученные подстановкой времени в готовый шаблон"""
+    if response_code == 202:
+        return RESPONSE_TEMPLATES[202] % (time.time(), quantity)
+    return RESPONSE_TEMPLATES[response_code] % (time.time(),)
+
+
 """Константы для jim протокола, настройки"""
 
 # Ключи
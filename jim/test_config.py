@@ -0,0 +1,34 @@
+import json
+from .config import JIMMsg, JIMResponse, JIMLiteMsg, response_bytes, history_bytes
+
+
+def test_response_bytes(monkeypatch):
+    # время фиксируем, чтобы сравнить байты шаблона с сериализацией словаря
+    monkeypatch.setattr('time.time', lambda: 1500000000.125)
+    for code in (200, 400, 500):
+        assert response_bytes(code) == json.dumps(JIMResponse(code).resp).encode('utf-8')
+    assert response_bytes(202, quantity=3) == json.dumps(JIMResponse(202, quantity=3).resp).encode('utf-8')
+
+
+def test_lite_msg(monkeypatch):
+    monkeypatch.setattr('time.time', lambda: 1500000000.125)
+    assert JIMLiteMsg('msg', login='Max', message='Привет!', to='Leo').to_bytes() == \
+        json.dumps(JIMMsg('msg', login='Max', message='Привет!', to='Leo').msg).encode('utf-8')
+    assert JIMLiteMsg('contact_list', message=['Leo', 'Kate']).to_bytes() == \
+        json.dumps(JIMMsg('contact_list', message=['Leo', 'Kate']).msg).encode('utf-8')
+    # в шаблоне время подставляется при отправке, а символ % в данных не мешает подстановке
+    template = JIMLiteMsg('contact_list', message=['100%', 'Kate']).to_template()
+    assert template % (1500000000.125,) == \
+        json.dumps(JIMMsg('contact_list', message=['100%', 'Kate']).msg).encode('utf-8')
+    # версия 0 - тоже значение поля
+    assert JIMLiteMsg('contact_changes', message=['Leo'], version=0, removed=[]).to_bytes() == \
+        json.dumps(JIMMsg('contact_changes', message=['Leo'], version=0, removed=[]).msg).encode('utf-8')
+
+
+def test_history_bytes(monkeypatch):
+    monkeypatch.setattr('time.time', lambda: 1500000000.125)
+    messages = [JIMMsg('msg', login='Max', message='Привет!', to='Leo').msg, JIMMsg('msg', login='Leo', message='1%').msg]
+    assert history_bytes([json.dumps(message).encode('utf-8') for message in messages], 'worker-0:42', to='Max') == \
+        json.dumps(JIMMsg('history', message=messages, to='Max', cursor='worker-0:42').msg).encode('utf-8')
+    assert history_bytes([], None, group='group') == \
+        json.dumps(JIMMsg('history', message=[], group='group').msg).encode('utf-8')
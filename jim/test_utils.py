@@ -1,7 +1,8 @@
 from pytest import raises
 import socket
 import json
-from .utils import dict_to_bytes, bytes_to_dict, get_message, send_message
+from .utils import dict_to_bytes, bytes_to_dict, get_message, send_message, pack_frame, FrameDecoder, MAX_FRAME_SIZE, \
+    InvalidMessage, compile_validator
 
 
 # МОДУЛЬНОЕ ТЕСТИРОВАНИЕ
@@ -19,6 +20,66 @@ def test_bytes_to_dict():
     assert bytes_to_dict(b'{"test": "test"}') == {'test': 'test'}
 
 
+def test_pack_frame():
+    assert pack_frame(b'{"test": "test"}') == b'\x00\x00\x00\x10{"test": "test"}'
+    with raises(ValueError):
+        pack_frame(b' ' * (MAX_FRAME_SIZE + 1))
+
+
+def test_frame_decoder():
+    decoder = FrameDecoder()
+    frames = pack_frame(b'{"n": 1}') + pack_frame(b'{"n": 2}') + pack_frame(b'{"n": 3}')
+    # два кадра целиком и часть третьего
+    assert decoder.feed(frames[:-3]) == 2
+    assert list(decoder.messages()) == [{'n': 1}, {'n': 2}]
+    # остаток третьего кадра
+    assert decoder.feed(frames[-3:]) == 1
+    assert list(decoder.messages()) == [{'n': 3}]
+    assert decoder.pending == 0
+    # заголовок с недопустимой длиной
+    with raises(ValueError):
+        FrameDecoder(max_size=10).feed(pack_frame(b'{"test": "test"}'))
+
+
+def test_frame_decoder_buffer():
+    decoder = FrameDecoder(size=64)
+    frame = pack_frame(b'{"text": "' + b'x' * 100 + b'"}')
+    # кадр длиннее буфера: буфер увеличивается под кадр
+    assert decoder.feed(frame[:30]) == 0
+    assert decoder.feed(frame[30:]) == 1
+    assert len(decoder.buffer) >= len(frame)
+    # после разбора всех байтов запись снова идет в начало буфера
+    assert decoder.start == decoder.end == 0
+    # остаток неполного кадра переносится в начало буфера, только когда в конце не хватает места
+    size = len(decoder.buffer)
+    decoder.feed(pack_frame(b'{"n": 1}') + frame[:10])
+    assert decoder.start > 0
+    decoder.feed(frame[10:])
+    assert [message.get('n') for message in decoder.messages()] == [None, 1, None]
+    assert len(decoder.buffer) == size
+
+
+def test_frame_decoder_invalid_message():
+    decoder = FrameDecoder()
+    # кадр без JSON-объекта не мешает разобрать следующий за ним кадр
+    assert decoder.feed(pack_frame(b'not json') + pack_frame(b'{"n": 1}')) == 2
+    with raises(InvalidMessage):
+        decoder.pop()
+    assert decoder.pop() == {'n': 1}
+
+
+def test_compile_validator():
+    validate = compile_validator({'user': {'account_name': str}}, optional={'to': str})
+    validate({'user': {'account_name': 'Max'}})
+    validate({'user': {'account_name': 'Max'}, 'to': None})
+    with raises(InvalidMessage):
+        validate({'user': 'Max'})
+    with raises(InvalidMessage):
+        validate({'user': {'account_name': 1}})
+    with raises(InvalidMessage):
+        validate({'user': {'account_name': 'Max'}, 'to': ['Leo']})
+
+
 # ИНТЕГРАЦИОННОЕ ТЕСТИРОВАНИЕ
 
 # Класс заглушка для сокета
@@ -39,6 +100,14 @@ class ClientSocket():
         pass
 
 
+class FramedClientSocket(ClientSocket):
+    """Класс-заглушка для сокета в framed-режиме: два кадра приходят одним recv_into"""
+    def recv_into(self, buffer):
+        data = pack_frame(b'{"response": 202}') + pack_frame(b'{"message": []}')
+        buffer[:len(data)] = data
+        return len(data)
+
+
 def test_get_message(monkeypatch):
     # подменяем настоящий сокет нашим классом заглушкой
     monkeypatch.setattr("socket.socket", ClientSocket)
@@ -48,6 +117,15 @@ def test_get_message(monkeypatch):
     assert get_message(sock) == {'response': 200}
 
 
+def test_get_message_framed():
+    sock = FramedClientSocket()
+    decoder = FrameDecoder()
+    assert get_message(sock, decoder) == {'response': 202}
+    # второе сообщение уже получено и берется из очереди декодера
+    assert get_message(sock, decoder) == {'message': []}
+    assert not decoder.pending
+
+
 def test_send_message(monkeypatch):
     # подменяем настоящий сокет нашим классом заглушкой
     monkeypatch.setattr("socket.socket", ClientSocket)
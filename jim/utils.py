@@ -1,8 +1,23 @@
 import json
+import struct
+from collections import deque
 
 # Кодировка
 ENCODING = 'utf-8'
 
+# Кадрирование (framed-режим): каждое сообщение передается как заголовок с длиной + JSON-байты
+# Заголовок - длина сообщения, 4 байта в сетевом порядке
+HEADER = struct.Struct('!I')
+# Максимальная длина сообщения. Меньше 2**24, поэтому первый байт заголовка всегда нулевой,
+# и кадр невозможно спутать с JSON-сообщением без кадрирования (оно начинается с '{')
+MAX_FRAME_SIZE = 1024 * 1024
+# Размер буфера чтения из сокета в framed-режиме
+BUFFER_SIZE = 65536
+# Начальный размер буфера приема соединения в framed-режиме (увеличивается для длинных кадров)
+RECV_BUFFER_SIZE = 16 * 1024
+# Минимальное свободное место в конце буфера приема, при котором байты читаются без сдвига буфера
+RECV_MIN_FREE = 1024
+
 
 def dict_to_bytes(message_dict):
     """
@@ -47,27 +62,231 @@ def bytes_to_dict(message_bytes):
         raise TypeError
 
 
-def send_message(sock, message, group=None):
+class InvalidMessage(ValueError):
+    """
+    Недопустимое сообщение: не JSON-объект, неизвестный action или не хватает обязательных полей
+    """
+    pass
+
+
+def decode_message(message_bytes):
+    """
+    Получение словаря сообщения из байтов, полученных от собеседника
+    :param message_bytes: сообщение в виде байтов (bytes, bytearray или memoryview)
+    :return: словарь сообщения
+    :raises InvalidMessage: байты не являются JSON-объектом
+    """
+    try:
+        # Байты декодируются сразу из буфера (в том числе из memoryview), без промежуточной копии
+        message = json.loads(str(message_bytes, ENCODING))
+    except ValueError as e:
+        raise InvalidMessage('Недопустимый JSON-объект: {}'.format(e)) from e
+    if not isinstance(message, dict):
+        raise InvalidMessage('Сообщение должно быть JSON-объектом')
+    return message
+
+
+def compile_validator(schema, optional=None):
+    """
+    Компиляция схемы сообщения в функцию проверки.
+    Схема - словарь поле-тип, для вложенных объектов - словарь, например {'user': {'account_name': str}}.
+    Схема разворачивается в список пар (путь к полю, тип) один раз, поэтому проверка сообщения
+    не разбирает схему заново
+    :param schema: обязательные поля
+    :param optional: необязательные поля (если поле есть, оно должно иметь указанный тип)
+    :return: функция проверки словаря сообщения, при ошибке бросает InvalidMessage
+    """
+    def flatten(schema, path=()):
+        for key, kind in schema.items():
+            if isinstance(kind, dict):
+                yield from flatten(kind, path + (key,))
+            else:
+                yield path + (key,), kind
+
+    required = tuple(flatten(schema))
+    optional = tuple(flatten(optional or {}))
+
+    def lookup(message, path):
+        for key in path:
+            if not isinstance(message, dict) or key not in message:
+                return None, False
+            message = message[key]
+        return message, True
+
+    def validate(message):
+        for path, kind in required:
+            value, found = lookup(message, path)
+            if not found or not isinstance(value, kind):
+                raise InvalidMessage('Поле {} отсутствует или имеет недопустимый тип'.format('.'.join(path)))
+        for path, kind in optional:
+            value, found = lookup(message, path)
+            if found and value is not None and not isinstance(value, kind):
+                raise InvalidMessage('Поле {} имеет недопустимый тип'.format('.'.join(path)))
+
+    return validate
+
+
+def pack_frame(bmessage):
+    """
+    Упаковка сообщения в кадр: заголовок с длиной + само сообщение
+    :param bmessage: сообщение в виде байтов
+    :return: bytes
+    """
+    if len(bmessage) > MAX_FRAME_SIZE:
+        raise ValueError('Слишком длинное сообщение: {} байт'.format(len(bmessage)))
+    return HEADER.pack(len(bmessage)) + bmessage
+
+
+class FrameDecoder:
+    """
+    Потоковый декодер кадров одного соединения.
+    Байты принимаются в заранее выделенный буфер соединения (в том числе напрямую из сокета методом recv_into),
+    сообщения разбираются прямо из буфера через memoryview. Разобранные байты не удаляются из буфера:
+    сдвигаются только границы start/end, а остаток неполного кадра переносится в начало буфера,
+    лишь когда в конце буфера не хватает места.
+    """
+
+    def __init__(self, max_size=MAX_FRAME_SIZE, size=RECV_BUFFER_SIZE):
+        # Буфер приема и представление для чтения из него без копирования
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        # Границы еще не разобранных байтов в буфере
+        self.start = 0
+        self.end = 0
+        # Полностью полученные, но еще не выбранные сообщения (словари или ошибки разбора InvalidMessage)
+        self.ready = deque()
+        self.max_size = max_size
+
+    @property
+    def pending(self):
+        """
+        Количество полученных, но еще не разобранных байтов (часть следующего кадра)
+        """
+        return self.end - self.start
+
+    def reserve(self, size):
+        """
+        Освобождение в конце буфера места не меньше size байт.
+        Неразобранные байты переносятся в начало буфера, а если места не хватает и после этого,
+        буфер заменяется большим
+        :param size: необходимое свободное место, байт
+        :return: None
+        """
+        if len(self.buffer) - self.end >= size:
+            return
+        pending = bytes(self.view[self.start:self.end])
+        if len(pending) + size > len(self.buffer):
+            # Размер bytearray нельзя изменить, пока на него есть memoryview, поэтому создаем новый буфер
+            self.view.release()
+            self.buffer = bytearray(max(len(pending) + size, 2 * len(self.buffer)))
+            self.view = memoryview(self.buffer)
+        self.buffer[:len(pending)] = pending
+        self.start = 0
+        self.end = len(pending)
+
+    def feed(self, data):
+        """
+        Добавление полученных байтов в буфер и разбор всех полностью полученных кадров
+        :param data: полученные байты
+        :return: количество новых сообщений в очереди ready
+        """
+        self.reserve(len(data))
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+        return self.parse()
+
+    def recv_into(self, sock):
+        """
+        Чтение байтов из сокета сразу в буфер соединения и разбор всех полностью полученных кадров
+        :param sock: сокет
+        :return: количество прочитанных байтов (0 - соединение закрыто)
+        """
+        self.reserve(RECV_MIN_FREE)
+        size = sock.recv_into(self.view[self.end:])
+        if size:
+            self.end += size
+            self.parse()
+        return size
+
+    def parse(self):
+        """
+        Разбор всех полностью полученных кадров буфера
+        :return: количество новых сообщений в очереди ready
+        """
+        count = 0
+        while self.end - self.start >= HEADER.size:
+            size, = HEADER.unpack_from(self.buffer, self.start)
+            if size > self.max_size:
+                raise ValueError('Слишком длинное сообщение: {} байт'.format(size))
+            end = self.start + HEADER.size + size
+            if end > self.end:
+                # Кадр получен не полностью: освобождаем место под его остаток
+                self.reserve(end - self.end)
+                break
+            try:
+                self.ready.append(decode_message(self.view[self.start + HEADER.size:end]))
+            except InvalidMessage as e:
+                # Ошибка ставится в очередь вместо сообщения, чтобы не потерять следующие за ним кадры
+                self.ready.append(e)
+            self.start = end
+            count += 1
+        if self.start == self.end:
+            # Все байты разобраны: следующие байты пишутся в начало буфера без копирования
+            self.start = self.end = 0
+        return count
+
+    def pop(self):
+        """
+        Выдача (с удалением из очереди) очередного полностью полученного сообщения
+        :return: словарь сообщения
+        :raises InvalidMessage: кадр не содержит JSON-объект
+        """
+        message = self.ready.popleft()
+        if isinstance(message, InvalidMessage):
+            raise message
+        return message
+
+    def messages(self):
+        """
+        Выдача (с удалением из очереди) всех полностью полученных сообщений
+        :return: генератор словарей сообщений
+        """
+        while self.ready:
+            yield self.pop()
+
+
+def send_message(sock, message, group=None, framed=False):
     """
     Отправка сообщения
     :param sock: сокет
     :param message: словарь сообщения
+    :param framed: упаковать сообщение в кадр (framed-режим)
     :return: None
     """
     # Словарь переводим в байты
     if group:
         message['group'] = group
     bmessage = dict_to_bytes(message)
+    if framed:
+        bmessage = pack_frame(bmessage)
     # Отправляем
     sock.send(bmessage)
 
 
-def get_message(sock):
+def get_message(sock, decoder=None):
     """
     Получение сообщения
     :param sock:
+    :param decoder: декодер кадров соединения (FrameDecoder) для framed-режима
     :return: словарь ответа
     """
+    if decoder is not None:
+        # Читаем из сокета, пока не будет получено хотя бы одно сообщение целиком
+        while not decoder.ready:
+            if not decoder.recv_into(sock):
+                print('Пришло пустое сообщение!')
+                return b''
+        return decoder.pop()
     # Получаем байты
     bresponse = sock.recv(1024)
     # переводим байты в словарь
@@ -1,8 +1,15 @@
-from server import MsgTCPServer
+from server import MsgTCPServer, OutQueue, InvalidMessage, STATE_PRESENCE, STATE_CONTACTS, STATE_READY, SLOW_POLICIES, \
+    POLICY_DROP, POLICY_DISCONNECT
+import json
 import socket
+import selectors
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy.orm import sessionmaker, scoped_session
 from pytest import raises
-from jim.config import JIMMsg
-from jim.utils import dict_to_bytes
+from jim.config import JIMMsg, JIMLiteMsg
+from jim.utils import dict_to_bytes, FrameDecoder
+from repo.server_repo import Repo
 
 class MySocket():
     ''' Класс-заглушка для операций с сокетом
@@ -56,3 +63,432 @@ class TestMsgTCPServer:
         requests[sock_r] = JIMMsg('msg', 'Hello!').msg
         self.serv.clients.remove(sock_w)
         assert self.serv.write_responses(requests, self.serv.clients) == len('')
+
+
+def test_send_to_reactor():
+    ''' В режиме reactor send_to ставит данные в очередь и регистрирует сокет на запись,
+    а flush_outbox отправляет очередь и снимает регистрацию на запись
+    '''
+    serv = MsgTCPServer(('', 0))
+    serv.selector = selectors.DefaultSelector()
+    sock, peer = socket.socketpair()
+    sock.setblocking(False)
+    serv.new_client(sock)
+    serv.clients[sock] = 'Max'
+    serv.selector.register(sock, selectors.EVENT_READ)
+
+    serv.send_to(sock, b'Hello!')
+    serv.send_to(sock, b' Bye!')
+    assert serv.selector.get_key(sock).events == selectors.EVENT_READ | selectors.EVENT_WRITE
+    assert serv.outbox[sock].size == len(b'Hello! Bye!')
+
+    serv.flush_outbox(sock)
+    assert peer.recv(1024) == b'Hello! Bye!'
+    assert serv.selector.get_key(sock).events == selectors.EVENT_READ
+
+    serv.disconnect(sock)
+    assert sock not in serv.clients and sock not in serv.outbox
+    peer.close()
+    serv.s.close()
+
+
+def test_out_queue():
+    queue = OutQueue()
+    sock, peer = socket.socketpair()
+    sock.setblocking(False)
+    for data in (b'one', b'two', b'three'):
+        queue.push(data)
+    assert queue.size == 11
+    # самые старые сообщения отбрасываются целиком
+    assert queue.drop_oldest(5) == 2
+    assert list(queue.messages) == [b'three']
+    assert queue.send(sock) == 5
+    assert peer.recv(1024) == b'three'
+    assert not queue
+    sock.close()
+    peer.close()
+
+
+class SendmsgSocket():
+    ''' Класс-заглушка для сокета, принимающего не больше limit байтов за вызов sendmsg
+    '''
+    def __init__(self, limit):
+        self.limit = limit
+        self.calls = []
+
+    def sendmsg(self, buffers):
+        data = b''.join(buffers)[:self.limit]
+        self.calls.append(data)
+        if not data:
+            raise BlockingIOError
+        return len(data)
+
+
+def test_out_queue_sendmsg():
+    ''' Все сообщения очереди отправляются одним вызовом sendmsg, частичная отправка продолжается с места остановки '''
+    queue = OutQueue()
+    for data in (b'one', b'two', b'three'):
+        queue.push(data)
+    sock = SendmsgSocket(limit=5)
+    assert queue.send(sock) == 5
+    assert sock.calls == [b'onetw']
+    assert queue.offset == 2 and queue.size == 6
+
+    sock.limit = 1024
+    assert queue.send(sock) == 6
+    assert sock.calls[1] == b'othree'
+    assert not queue and not queue.messages and queue.offset == 0
+
+
+def test_out_queue_on_sent():
+    ''' Функция, ждущая отправки сообщений очереди, возвращается, только когда они все покинули очередь '''
+    queue = OutQueue()
+    queue.push(b'one')
+    queue.push(b'two')
+    queue.on_sent('done')
+    queue.push(b'three')
+    sock = SendmsgSocket(limit=5)
+    queue.send(sock)
+    assert queue.pop_sent() == []
+    sock.limit = 1
+    queue.send(sock)
+    assert queue.pop_sent() == ['done']
+    assert queue.pop_sent() == []
+
+
+def test_slow_policies():
+    ''' Переполнение очереди получателя: drop отбрасывает старые сообщения, disconnect отключает клиента,
+    pause приостанавливает чтение отправителя до опустошения очереди до нижней границы
+    '''
+    for policy in SLOW_POLICIES:
+        serv = MsgTCPServer(('', 0), high_water=10, low_water=0, slow_policy=policy)
+        sender, _ = socket.socketpair()
+        receiver, peer = socket.socketpair()
+        receiver.setblocking(False)
+        serv.new_client(sender)
+        serv.new_client(receiver)
+        serv.send_to(receiver, b'0123456789', sender=sender)
+        serv.send_to(receiver, b'abc', sender=sender)
+        if policy == POLICY_DROP:
+            assert list(serv.outbox[receiver].messages) == [b'abc']
+        elif policy == POLICY_DISCONNECT:
+            assert receiver not in serv.clients
+        else:
+            assert serv.outbox[receiver].size == 13
+            assert sender in serv.paused
+            serv.flush_outbox(receiver)
+            assert peer.recv(1024) == b'0123456789abc'
+            assert sender not in serv.paused
+        serv.s.close()
+
+
+def test_process_request_states():
+    ''' До завершения процедуры подключения запросы msg не принимаются '''
+    serv = MsgTCPServer(('', 0))
+    sock, peer = socket.socketpair()
+    serv.new_client(sock)
+    assert serv.states[sock] == STATE_PRESENCE
+    with raises(InvalidMessage):
+        serv.process_request(sock, JIMMsg('msg', message='Hello!').msg)
+
+    serv.states[sock] = STATE_READY
+    assert serv.process_request(sock, JIMMsg('msg', message='Hello!').msg)['message'] == 'Hello!'
+
+    serv.disconnect(sock)
+    assert sock not in serv.states
+    peer.close()
+    serv.s.close()
+
+
+def test_invalid_request():
+    ''' На недопустимый запрос клиент получает ответ 400 и остается подключенным '''
+    serv = MsgTCPServer(('', 0))
+    sock, peer = socket.socketpair()
+    serv.new_client(sock)
+    serv.states[sock] = STATE_READY
+    for request in [b'{"action": "unknown"}', b'{not json', b'[1, 2]', b'{"action": "msg"}', b'{"action": ["msg"]}']:
+        peer.send(request)
+        assert serv.read_requests([sock]) == {}
+        assert sock in serv.clients
+        serv.flush_outbox(sock)
+        assert json.loads(peer.recv(1024).decode('utf-8'))['response'] == 400
+    serv.disconnect(sock)
+    peer.close()
+    serv.s.close()
+
+
+def test_oversized_message():
+    ''' Сообщение, которое после сериализации длиннее кадра, отклоняется ответом 400 и никому не отправляется '''
+    serv = MsgTCPServer(('', 0))
+    socks = [socket.socketpair()[0] for i in range(2)]
+    for sock in socks:
+        serv.new_client(sock)
+        serv.clients[sock] = 'user'
+        serv.states[sock] = STATE_READY
+    serv.write_responses({socks[0]: JIMMsg('msg', message='я' * 200000).msg}, list(serv.clients))
+    assert b'"response": 400' in serv.outbox[socks[0]].messages[0]
+    assert not serv.outbox[socks[1]]
+    for sock in socks:
+        serv.disconnect(sock)
+    serv.s.close()
+
+
+def test_broadcast_encoded_once():
+    ''' Все получатели рассылки получают в очередь один и тот же объект байтов '''
+    serv = MsgTCPServer(('', 0))
+    sender, _ = socket.socketpair()
+    receivers = [socket.socketpair()[0] for i in range(3)]
+    for sock in [sender] + receivers:
+        serv.new_client(sock)
+        serv.states[sock] = STATE_READY
+    serv.write_responses({sender: JIMMsg('msg', message='Hello!').msg}, list(serv.clients))
+    sent = [serv.outbox[sock].messages[0] for sock in receivers]
+    assert all(data is sent[0] for data in sent)
+    assert not serv.outbox[sender]
+    serv.s.close()
+
+
+def test_direct_message():
+    ''' Личное сообщение получают только подключения адресата, индекс очищается при отключении '''
+    serv = MsgTCPServer(('', 0))
+    socks = {name: socket.socketpair()[0] for name in ['alice', 'bob', 'bob2', 'carol']}
+    for name, sock in socks.items():
+        serv.new_client(sock)
+        serv.clients[sock] = name.rstrip('2')
+        serv.add_route(sock, name.rstrip('2'))
+        serv.states[sock] = STATE_READY
+    assert serv.users['bob'] == {socks['bob'], socks['bob2']}
+    serv.write_responses({socks['alice']: JIMMsg('msg', message='Hi, Bob!', to='bob').msg}, list(serv.clients))
+    assert serv.outbox[socks['bob']] and serv.outbox[socks['bob2']]
+    assert not serv.outbox[socks['carol']] and not serv.outbox[socks['alice']]
+    message = json.loads(serv.outbox[socks['bob']].messages[0].decode('utf-8'))
+    assert message['to'] == 'bob' and message['user']['account_name'] == 'alice'
+    serv.disconnect(socks['bob'])
+    serv.disconnect(socks['bob2'])
+    assert 'bob' not in serv.users
+    serv.s.close()
+
+
+def test_contact_list_delayed():
+    ''' Клиент без кадрирования не получает сообщений чата, пока ему не отправлен отложенный список контактов '''
+    serv = MsgTCPServer(('', 0))
+    pairs = [socket.socketpair() for i in range(2)]
+    socks = [pair[0] for pair in pairs]
+    for sock, name in zip(socks, ['alice', 'bob']):
+        sock.setblocking(False)
+        serv.new_client(sock)
+        serv.clients[sock] = name
+        serv.states[sock] = STATE_CONTACTS
+    serv.send_contact_list(socks[1], 0, JIMLiteMsg('contact_list', message=[]).to_template())
+    serv.states[socks[0]] = STATE_READY
+    serv.write_responses({socks[0]: JIMMsg('msg', message='Hi!').msg}, list(serv.clients))
+    assert serv.states[socks[1]] == STATE_CONTACTS
+    assert len(serv.outbox[socks[1]].messages) == 1  # только ответ 202
+    serv.timers[0] = (0,) + serv.timers[0][1:]
+    serv.run_timers()
+    # клиент готов к сообщениям чата, только когда список передан в сокет
+    serv.write_responses({socks[0]: JIMMsg('msg', message='Hi!').msg}, list(serv.clients))
+    assert serv.states[socks[1]] == STATE_CONTACTS
+    assert b'contact_list' in serv.outbox[socks[1]].messages[-1]
+    serv.flush_outbox(socks[1])
+    assert serv.states[socks[1]] == STATE_READY
+    assert b'contact_list' in pairs[1][1].recv(1024)
+    for sock in socks:
+        serv.disconnect(sock)
+    for pair in pairs:
+        pair[1].close()
+    serv.s.close()
+
+
+def test_pending_claimed_once(tmp_path):
+    ''' Очередь пользователя отправляется только одному подключению, а после его отключения - следующему '''
+    serv = MsgTCPServer(('', 0), pending=str(tmp_path))
+    for i in range(5):
+        serv.pending.put('bob', b'message %d' % i)
+    socks = [socket.socketpair()[0] for i in range(2)]
+    for sock in socks:
+        serv.new_client(sock)
+        serv.clients[sock] = 'bob'
+        serv.add_route(sock, 'bob')
+        serv.decoders[sock] = FrameDecoder()
+        serv.states[sock] = STATE_READY
+        serv.start_forwarding(sock)
+    assert list(serv.forwarding) == [socks[0]]
+    serv.forwarding[socks[0]][0].read(2)
+    serv.disconnect(socks[0])
+    assert list(serv.forwarding) == [socks[1]]
+    # сообщение, сохраненное во время отправки, отправляется следом за очередью
+    serv.pending.put('bob', b'new')
+    serv.forward_pending()
+    serv.forward_pending()
+    assert [m[4:] for m in serv.outbox[socks[1]].messages] == [b'message 2', b'message 3', b'message 4', b'new']
+    assert not serv.forwarding and not serv.claims
+    serv.disconnect(socks[1])
+    serv.s.close()
+
+
+class BusStub():
+    ''' Класс-заглушка для шины процессов-обработчиков (режим кластера)
+    '''
+    def __init__(self, index):
+        self.index = index
+        self.packets = []
+
+    def publish(self, data):
+        self.packets.append(data)
+
+
+def test_remote_message_during_handshake(tmp_path):
+    ''' Личное сообщение из другого процесса адресату, который еще не получил список контактов, сохраняется
+    в очереди одним процессом - процессом с наименьшим номером, к которому подключен адресат '''
+    for index, stored in ((0, True), (2, False)):
+        serv = MsgTCPServer(('', 0), pending=str(tmp_path / str(index)))
+        serv.bus = BusStub(index)
+        sock, peer = socket.socketpair()
+        serv.new_client(sock)
+        serv.clients[sock] = 'bob'
+        serv.add_route(sock, 'bob')
+        serv.states[sock] = STATE_CONTACTS
+        serv.update_remote_users('+bob', 1)
+        serv.deliver_remote(b'@bob\n' + b'Hi!')
+        reader = serv.pending.claim('bob')
+        assert (reader is not None and reader.read(10) == [b'Hi!']) == stored
+        serv.disconnect(sock)
+        peer.close()
+        serv.s.close()
+
+
+def test_group_message():
+    ''' Сообщение в группу получают только подключенные участники группы '''
+    serv = MsgTCPServer(('', 0))
+    socks = {name: socket.socketpair()[0] for name in ['alice', 'bob', 'carol']}
+    for name, sock in socks.items():
+        serv.new_client(sock)
+        serv.clients[sock] = name
+        serv.states[sock] = STATE_READY
+    serv.join(socks['alice'], 'python')
+    serv.join(socks['bob'], 'python')
+    serv.write_responses({socks['alice']: JIMMsg('msg', message='Hi!', group='python').msg}, list(serv.clients))
+    assert serv.outbox[socks['bob']] and not serv.outbox[socks['carol']]
+    message = json.loads(serv.outbox[socks['bob']].messages[0].decode('utf-8'))
+    assert message['group'] == 'python' and message['user']['account_name'] == 'alice'
+    # не участник группы получает ответ 400, сообщение никому не доставляется
+    serv.write_responses({socks['carol']: JIMMsg('msg', message='Hi!', group='python').msg}, list(serv.clients))
+    assert json.loads(serv.outbox[socks['carol']].messages[0].decode('utf-8'))['response'] == 400
+    assert len(serv.outbox[socks['bob']].messages) == 1
+    serv.disconnect(socks['bob'])
+    assert serv.groups['python'] == {socks['alice']}
+    serv.leave(socks['alice'], 'python')
+    assert 'python' not in serv.groups
+    serv.s.close()
+
+
+def test_db_call_pool():
+    ''' Запрос к БД выполняется в пуле потоков, чтение запросов клиента приостановлено до его завершения,
+    результат обрабатывается в потоке цикла, а при ошибке клиенту отправляется ответ 500 '''
+    serv = MsgTCPServer(('', 0))
+    serv.dwh = Repo(scoped_session(sessionmaker()))
+    serv.db_pool = ThreadPoolExecutor(max_workers=1)
+    serv.wakeup = socket.socketpair()
+    for sock in serv.wakeup:
+        sock.setblocking(False)
+    sock, peer = socket.socketpair()
+    serv.new_client(sock)
+    release = threading.Event()
+    results = []
+    serv.db_call(sock, lambda repo: release.wait() and 42, results.append)
+    assert sock in serv.paused and not serv.db_done
+    release.set()
+    serv.db_pool.submit(int).result()  # пул из одного потока: предыдущий запрос уже завершен
+    assert results == []
+    serv.run_db_callbacks()
+    assert results == [42] and sock not in serv.paused
+
+    serv.db_call(sock, lambda repo: 1 / 0, results.append)
+    serv.db_pool.submit(int).result()
+    serv.run_db_callbacks()
+    assert results == [42] and sock not in serv.paused
+    assert json.loads(serv.outbox[sock].messages[0].decode('utf-8'))['response'] == 500
+    serv.db_pool.shutdown()
+    serv.disconnect(sock)
+    peer.close()
+    serv.s.close()
+
+
+def test_contact_list_cache():
+    ''' Сериализованный список контактов берется из кеша при повторном запросе (из БД читается только версия)
+    и сбрасывается при изменении контактов, в том числе в обход сервера '''
+    class CountingRepo:
+        def __init__(self):
+            self.contacts = ['Leo']
+            self.version = 0
+            self.queries = 0
+            self.version_queries = 0
+
+        def get_contact_version(self, username):
+            self.version_queries += 1
+            return self.version
+
+        def get_contact_list(self, username):
+            self.queries += 1
+            return list(self.contacts), self.version
+
+        def get_contact_changes(self, username, version):
+            self.queries += 1
+            return self.version, self.contacts[len(self.contacts) - self.version + version:], []
+
+        def add_contact(self, username, contact):
+            self.contacts.append(contact)
+            self.version += 1
+
+    serv = MsgTCPServer(('', 0))
+    serv.dwh = CountingRepo()
+    sock, peer = socket.socketpair()
+    serv.new_client(sock)
+    serv.clients[sock] = 'Max'
+    serv.decoders[sock] = FrameDecoder()  # framed-клиент получает список без задержки
+    serv.send_contacts(sock)
+    serv.send_contacts(sock)
+    assert serv.dwh.queries == 1 and serv.dwh.version_queries == 1
+    lists = [json.loads(m[4:].decode('utf-8')) for m in serv.outbox[sock].messages if b'contact_list' in m]
+    assert [m['message'] for m in lists] == [['Leo'], ['Leo']]
+    serv.handle_add_contact(sock, {'user': {'account_name': 'Kate'}}, [])
+    serv.send_contacts(sock)
+    assert serv.dwh.queries == 2
+    assert b'"message": ["Leo", "Kate"], "version": 1' in serv.outbox[sock].messages[-1]
+    # копия клиента той же версии, что и список в кеше и в БД, - пустые изменения без чтения журнала
+    serv.sync_contacts(sock, 1)
+    assert serv.dwh.queries == 2
+    assert b'"message": [], "version": 1, "removed": []' in serv.outbox[sock].messages[-1]
+    # после изменения - только изменения после версии клиента
+    serv.handle_add_contact(sock, {'user': {'account_name': 'Ann'}}, [])
+    serv.sync_contacts(sock, 1)
+    assert serv.dwh.queries == 3
+    assert b'"action": "contact_changes"' in serv.outbox[sock].messages[-1]
+    assert b'"message": ["Ann"], "version": 2, "removed": []' in serv.outbox[sock].messages[-1]
+    # контакты загружены массово (bulk_import.py) - список в кеше устарел
+    serv.send_contacts(sock)
+    serv.dwh.contacts.append('Bob')
+    serv.dwh.version += 1
+    serv.sync_contacts(sock, 2)
+    assert b'"message": ["Bob"], "version": 3' in serv.outbox[sock].messages[-1]
+    serv.send_contacts(sock)
+    assert b'"message": ["Leo", "Kate", "Ann", "Bob"], "version": 3' in serv.outbox[sock].messages[-1]
+    serv.disconnect(sock)
+    peer.close()
+    serv.s.close()
+
+
+def test_msg_bus(tmp_path):
+    ''' Сообщение, отправленное в шину одним обработчиком, получают все остальные '''
+    from cluster import MsgBus
+    buses = [MsgBus(str(tmp_path), i, 3) for i in range(3)]
+    for bus in buses:
+        bus.connect()
+    buses[0].publish(b'Hello!')
+    assert not any(buses[0].pending.values())
+    assert buses[0].receive() == []
+    assert buses[1].receive() == [b'Hello!']
+    assert buses[2].receive() == [b'Hello!']
+    for bus in buses:
+        bus.close()
@@ -0,0 +1,73 @@
+"""Поток отложенной (write-behind) записи в БД: элементы ставятся в очередь, а поток записывает их пачками
+одной транзакцией раз в interval секунд и не реже, чем по накоплении batch_size элементов. Используется для
+истории входов на сервере (server_repo.LogonWriter) и истории сообщений клиента (client_repo.MsgHistoryWriter)"""
+import queue
+import threading
+import time
+
+
+class BatchWriter(threading.Thread):
+    """Поток отложенной записи пачками (пачку записывает метод write_batch подкласса)"""
+    # Что записывается (для сообщения об ошибке записи)
+    description = 'записи'
+
+    def __init__(self, session, name, interval, batch_size, limit):
+        """
+        :param session: сессия (scoped_session, чтобы у потока была своя сессия)
+        :param name: имя потока
+        :param interval: максимальное время хранения элемента в очереди, с
+        :param batch_size: максимальное количество элементов в одной транзакции
+        :param limit: максимальное количество элементов в очереди (при заполнении очереди добавление ждет записи)
+        """
+        super().__init__(name=name, daemon=True)
+        self.session = session
+        self.interval = interval
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=limit)
+
+    def run(self):
+        """Сбор элементов из очереди в пачки и их запись, пока не будет получен сигнал остановки (None)"""
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.write(batch)
+                    return
+                batch.append(item)
+            self.write(batch)
+
+    def write(self, batch):
+        """Запись пачки одной транзакцией"""
+        try:
+            self.write_batch(batch)
+        except Exception as e:
+            # Поток записи не должен останавливаться из-за ошибки БД, иначе очередь переполнится
+            self.session.rollback()
+            print('Не удалось записать {} ({} записей): {}'.format(self.description, len(batch), e))
+        finally:
+            self.session.close()
+
+    def write_batch(self, batch):
+        """Запись пачки элементов и фиксация транзакции (реализуется в подклассе)"""
+        raise NotImplementedError
+
+    def close(self):
+        """Запись всех накопленных элементов (при завершении программы)"""
+        if self.is_alive():
+            self.queue.put(None)
+            self.join()
+        batch = []
+        while not self.queue.empty():
+            item = self.queue.get()
+            if item is not None:
+                batch.append(item)
+        if batch:
+            self.write(batch)
@@ -47,6 +47,19 @@ class Client(Base):
         return self.Name == other.Name
 
 
+class ContactListVersion(Base):
+    """Версия копии списка контактов клиента, полученной с сервера (см. Repo.apply_contact_changes)"""
+    __tablename__ = 'ContactListVersion'
+    # id клиента
+    ClientId = Column(Integer, ForeignKey('Client.ClientId'), primary_key=True)
+    # Версия списка на сервере
+    Version = Column(Integer, nullable=False)
+
+    def __init__(self, client_id, version):
+        self.ClientId = client_id
+        self.Version = version
+
+
 class MsgHistory(Base):
     """История сообщений клиента"""
     __tablename__ = 'MsgHistory'
@@ -57,7 +70,7 @@ class MsgHistory(Base):
     # Сообщение клиента
     Message = Column(String, nullable=False)
     # Время сообщения
-    MsgTime = Column(DateTime, nullable=False)
+    MsgTime = Column(DateTime, nullable=False, index=True)
 
     def __init__(self, client_id, message, msg_time):
         self.ClientId = client_id
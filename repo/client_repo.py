@@ -1,5 +1,15 @@
-from .client_models import Client, ClientContact, MsgHistory
+from .client_models import Client, ClientContact, ContactListVersion, MsgHistory
 from .client_errors import ContactDoesNotExist
+from .batch_writer import BatchWriter
+from sqlalchemy import func
+
+
+# Сообщения пишутся в локальную историю (MsgHistory) отдельным потоком пачками: одной транзакцией раз в
+# MSG_FLUSH_INTERVAL секунд и не реже, чем по накоплении MSG_BATCH_SIZE сообщений, поэтому поток интерфейса
+# не ждет коммита на каждое сообщение
+MSG_FLUSH_INTERVAL = 0.5
+MSG_BATCH_SIZE = 200
+MSG_QUEUE_LIMIT = 10000
 
 
 class Repo:
@@ -70,3 +80,102 @@ class Repo:
                 contact = self.session.query(Client).filter(Client.ClientId == contact_client.ContactId).first()
                 result.append(contact)
         return result
+
+    def get_contact_list(self, client_username):
+        """Получение копии списка контактов клиента
+        :return: (список имен контактов в порядке добавления, версия списка; 0 - копии нет)
+        """
+        client = self.get_client_by_username(client_username)
+        if not client:
+            return [], 0
+        names = [row.Name for row in self.session.query(Client.Name).join(
+            ClientContact, ClientContact.ContactId == Client.ClientId).filter(
+            ClientContact.ClientId == client.ClientId).order_by(ClientContact.ClientContactId)]
+        version = self.session.query(ContactListVersion.Version).filter(
+            ContactListVersion.ClientId == client.ClientId).scalar()
+        return names, version or 0
+
+    def apply_contact_changes(self, client_username, version, added, removed=(), full=False):
+        """Применение к копии списка контактов изменений, полученных с сервера, одной транзакцией
+        (клиенты, которых еще нет, добавляются в Client)
+        :param version: версия списка на сервере после изменений
+        :param added: имена добавленных контактов (при full - полный список)
+        :param removed: имена удаленных контактов
+        :param full: added - полный список, копия заменяется им
+        """
+        names = set(added) | set(removed) | {client_username}
+        ids = dict(self.session.query(Client.Name, Client.ClientId).filter(Client.Name.in_(names)))
+        new_clients = [Client(username) for username in names if username not in ids]
+        if new_clients:
+            self.session.add_all(new_clients)
+            self.session.flush()
+            ids.update((client.Name, client.ClientId) for client in new_clients)
+        client_id = ids[client_username]
+        query = self.session.query(ClientContact).filter(ClientContact.ClientId == client_id)
+        if not full:
+            query = query.filter(ClientContact.ContactId.in_([ids[name] for name in list(added) + list(removed)]))
+        query.delete(synchronize_session=False)
+        self.session.add_all([ClientContact(client_id, ids[name]) for name in added])
+        self.session.merge(ContactListVersion(client_id, version))
+        self.session.commit()
+
+    def add_messages(self, messages):
+        """Добавление пачки сообщений в историю одной транзакцией (отправители, которых еще нет, добавляются в Client)
+        :param messages: список кортежей (имя отправителя, сообщение, время datetime)
+        """
+        names = {username for username, message, msg_time in messages}
+        ids = dict(self.session.query(Client.Name, Client.ClientId).filter(Client.Name.in_(names)))
+        new_clients = [Client(username) for username in names if username not in ids]
+        if new_clients:
+            self.session.add_all(new_clients)
+            self.session.flush()
+            ids.update((client.Name, client.ClientId) for client in new_clients)
+        self.session.bulk_insert_mappings(MsgHistory, [
+            {'ClientId': ids[username], 'Message': message, 'MsgTime': msg_time}
+            for username, message, msg_time in messages])
+        self.session.commit()
+
+    def get_messages(self, limit, before=None):
+        """Последние limit сообщений истории (раньше времени before)
+        :return: список кортежей (имя отправителя, сообщение, время) по возрастанию времени
+        """
+        query = self.session.query(Client.Name, MsgHistory.Message, MsgHistory.MsgTime).join(
+            Client, Client.ClientId == MsgHistory.ClientId)
+        if before is not None:
+            query = query.filter(MsgHistory.MsgTime < before)
+        rows = query.order_by(MsgHistory.MsgTime.desc(), MsgHistory.MsgHistoryId.desc()).limit(limit).all()
+        return [tuple(row) for row in reversed(rows)]
+
+    def last_message_time(self, exclude=None):
+        """Время последнего сообщения истории (без сообщений клиента exclude), None - таких сообщений нет"""
+        query = self.session.query(func.max(MsgHistory.MsgTime))
+        if exclude is not None:
+            query = query.join(Client, Client.ClientId == MsgHistory.ClientId).filter(Client.Name != exclude)
+        return query.scalar()
+
+
+class MsgHistoryWriter(BatchWriter):
+    """Поток отложенной (write-behind) записи истории сообщений клиента"""
+    description = 'историю сообщений'
+
+    def __init__(self, session, interval=MSG_FLUSH_INTERVAL, batch_size=MSG_BATCH_SIZE, limit=MSG_QUEUE_LIMIT):
+        """
+        :param session: сессия (scoped_session, чтобы у потока была своя сессия)
+        :param interval: максимальное время хранения сообщения в очереди, с
+        :param batch_size: максимальное количество сообщений в одной транзакции
+        :param limit: максимальное количество сообщений в очереди
+        """
+        super().__init__(session, 'history-writer', interval, batch_size, limit)
+        self.repo = Repo(session)
+
+    def add(self, username, message, msg_time):
+        """Постановка сообщения в очередь записи
+        :param username: имя отправителя
+        :param message: текст сообщения
+        :param msg_time: время сообщения (datetime)
+        """
+        self.queue.put((username, message, msg_time))
+
+    def write_batch(self, batch):
+        """Запись пачки сообщений одной транзакцией"""
+        self.repo.add_messages(batch)
@@ -0,0 +1,109 @@
+"""Версионные миграции структуры базы данных сервера.
+Версия структуры хранится в заголовке файла SQLite (PRAGMA user_version). Новая база создается
+сразу в последней версии, а в существующую базу при запуске сервера (или заранее, командой
+python -m repo.server_migrations [путь к базе]) последовательно применяются недостающие миграции.
+Миграции можно выполнять повторно (например, если процесс был прерван между изменением и записью версии)"""
+import argparse
+import os
+import time
+from sqlalchemy import create_engine, inspect, text
+from .server_models import Base, GroupMember
+
+
+# Список миграций (версия, описание, функция изменения структуры), заполняется декоратором migration
+MIGRATIONS = []
+
+
+def migration(version, description):
+    """Регистрация функции миграции function(connection), переводящей базу в версию version"""
+    def register(function):
+        assert not MIGRATIONS or MIGRATIONS[-1][0] < version, 'Миграции должны идти по возрастанию версий'
+        MIGRATIONS.append((version, description, function))
+        return function
+    return register
+
+
+@migration(1, 'уникальный индекс ClientContact (ClientId, ContactId)')
+def unique_client_contacts(connection):
+    # Дубликаты, появившиеся до индекса, удаляются (остается самая ранняя запись)
+    connection.execute(text('DELETE FROM ClientContact WHERE ClientContactId NOT IN '
+                            '(SELECT MIN(ClientContactId) FROM ClientContact GROUP BY ClientId, ContactId)'))
+    connection.execute(text('CREATE UNIQUE INDEX IF NOT EXISTS ix_ClientContact_ClientId_ContactId '
+                            'ON ClientContact (ClientId, ContactId)'))
+
+
+@migration(2, 'индекс LogonHistory (ClientId, LogonTime)')
+def logon_history_index(connection):
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_LogonHistory_ClientId_LogonTime '
+                            'ON LogonHistory (ClientId, LogonTime)'))
+
+
+@migration(3, 'версия списка контактов Client.ContactVersion (журнал изменений ContactChange)')
+def contact_versions(connection):
+    # Таблица ContactChange создается по модели, а в Client добавляется столбец
+    if 'ContactVersion' not in {column['name'] for column in inspect(connection).get_columns('Client')}:
+        connection.execute(text('ALTER TABLE Client ADD COLUMN ContactVersion INTEGER NOT NULL DEFAULT 0'))
+
+
+@migration(4, 'уникальная пара GroupMember (GroupName, MemberId) вместо уникального GroupName')
+def group_members_unique_pair(connection):
+    # Ограничение столбца в SQLite не удаляется, поэтому таблица пересоздается по модели с копированием данных
+    constraints = {tuple(constraint['column_names'])
+                   for constraint in inspect(connection).get_unique_constraints('GroupMember')}
+    if ('GroupName', 'MemberId') in constraints:
+        return
+    connection.execute(text('ALTER TABLE GroupMember RENAME TO GroupMember_old'))
+    GroupMember.__table__.create(connection)
+    connection.execute(text('INSERT INTO GroupMember (GroupId, GroupName, MemberId) '
+                            'SELECT GroupId, GroupName, MemberId FROM GroupMember_old WHERE GroupName IS NOT NULL'))
+    connection.execute(text('DROP TABLE GroupMember_old'))
+
+
+def get_version(connection):
+    """Версия структуры базы"""
+    return connection.execute(text('PRAGMA user_version')).scalar()
+
+
+def set_version(connection, version):
+    """Запись версии структуры базы"""
+    connection.execute(text('PRAGMA user_version = {:d}'.format(version)))
+
+
+def migrate(engine):
+    """Приведение структуры базы к последней версии
+    :param engine: движок базы данных
+    :return: список версий примененных миграций
+    """
+    with engine.begin() as connection:
+        if not inspect(connection).has_table('Client'):
+            # Новая база: структура создается по моделям, в которых уже есть все индексы
+            Base.metadata.create_all(connection)
+            set_version(connection, MIGRATIONS[-1][0])
+            return []
+    # Таблицы, которых нет в старой базе (например, GroupMember), создаются по моделям
+    Base.metadata.create_all(engine)
+    applied = []
+    for version, description, function in MIGRATIONS:
+        with engine.begin() as connection:
+            if get_version(connection) >= version:
+                continue
+            print('Миграция базы данных до версии {}: {}'.format(version, description))
+            started = time.time()
+            function(connection)
+            set_version(connection, version)
+            print('Миграция до версии {} выполнена за {:.1f} с'.format(version, time.time() - started))
+        applied.append(version)
+    return applied
+
+
+if __name__ == '__main__':
+    # Миграции можно применить заранее, пока работает предыдущая версия сервера: на время построения индекса
+    # SQLite блокирует запись в базу, но чтение продолжается
+    parser = argparse.ArgumentParser(description='Миграции базы данных сервера')
+    parser.add_argument('db', nargs='?', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.db'),
+                        help='путь к файлу базы данных (по умолчанию repo/server.db)')
+    namespace = parser.parse_args()
+    engine = create_engine('sqlite:///{}'.format(namespace.db))
+    applied = migrate(engine)
+    print('Версия базы данных: {}{}'.format(
+        MIGRATIONS[-1][0], '' if applied else ' (миграции не требуются)'))
@@ -1,6 +1,6 @@
 import datetime
 import os
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, create_engine
+from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, DateTime, UniqueConstraint, Index, create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, sessionmaker
 
@@ -11,6 +11,9 @@ class ClientContact(Base):
     """Связка контакт-клиент для хранения списка контактов"""
     # Название таблицы
     __tablename__ = 'ClientContact'
+    # Контакт может быть в списке клиента только один раз (индекс также ускоряет поиск контактов клиента).
+    # В существующие базы индексы добавляются миграциями (см. server_migrations)
+    __table_args__ = (Index('ix_ClientContact_ClientId_ContactId', 'ClientId', 'ContactId', unique=True),)
     # Первичный ключ
     ClientContactId = Column(Integer, primary_key=True)
     # id клиента
@@ -33,6 +36,8 @@ class Client(Base):
     Name = Column(String, unique=True)
     # Информация не обязательное поле
     Info = Column(String, nullable=True)
+    # Версия списка контактов клиента (увеличивается при каждом изменении списка, см. ContactChange)
+    ContactVersion = Column(Integer, nullable=False, default=0, server_default='0')
 
     def __init__(self, name, info=None):
         self.Name = name
@@ -47,9 +52,35 @@ class Client(Base):
         return self.Name == other.Name
 
 
+class ContactChange(Base):
+    """Изменение списка контактов клиента: по журналу изменений клиенту отправляются только изменения
+    после версии его копии списка (см. Repo.get_contact_changes). Массовые изменения в журнал не пишутся"""
+    __tablename__ = 'ContactChange'
+    # Изменения выбираются по клиенту и версии
+    __table_args__ = (Index('ix_ContactChange_ClientId_Version', 'ClientId', 'Version', unique=True),)
+    # Первичный ключ
+    ContactChangeId = Column(Integer, primary_key=True)
+    # id клиента
+    ClientId = Column(Integer, ForeignKey('Client.ClientId'))
+    # Версия списка после изменения
+    Version = Column(Integer, nullable=False)
+    # id добавленного или удаленного контакта
+    ContactId = Column(Integer, ForeignKey('Client.ClientId'))
+    # Контакт добавлен (иначе удален)
+    Added = Column(Boolean, nullable=False)
+
+    def __init__(self, client_id, version, contact_id, added):
+        self.ClientId = client_id
+        self.Version = version
+        self.ContactId = contact_id
+        self.Added = added
+
+
 class LogonHistory(Base):
     """История входов клиента"""
     __tablename__ = 'LogonHistory'
+    # Индекс для выборки истории входов клиента по времени
+    __table_args__ = (Index('ix_LogonHistory_ClientId_LogonTime', 'ClientId', 'LogonTime'),)
     # Первичный ключ
     ClientHistoryId = Column(Integer, primary_key=True)
     # id клиента
@@ -66,12 +97,14 @@ class LogonHistory(Base):
 
 
 class GroupMember(Base):
-    """Группа пользователей (чат)"""
+    """Участник группы пользователей (чата)"""
     __tablename__ = 'GroupMember'
+    # Клиент может быть участником группы только один раз
+    __table_args__ = (UniqueConstraint('GroupName', 'MemberId'),)
     # Первичный ключ
     GroupId = Column(Integer, primary_key=True)
     # Имя группы
-    GroupName = Column(String, unique=True)
+    GroupName = Column(String, nullable=False)
     # id члена группы
     MemberId = Column(Integer, ForeignKey('Client.ClientId'))
 
@@ -0,0 +1,407 @@
+"""Журнал сообщений сервера: файл, в который сообщения только дописываются, разбитый на сегменты.
+Запись журнала - заголовок RECORD_HEADER (контрольная сумма, номер записи, время, длины имени отправителя,
+адресата и сообщения), затем имя отправителя, адресат ('@' + username, '#' + группа или пусто для сообщения в чат)
+и байты сообщения. Сегмент <номер первой записи>.log сопровождается разреженным индексом <номер первой записи>.idx:
+пара (номер, смещение) на каждые INDEX_INTERVAL байт сегмента. Записи читаются через mmap.
+Журнал пишет только поток основного цикла сервера: записи попадают в файл при вызове flush (раз в итерацию цикла),
+а на диск (fsync) - при смене сегмента и закрытии журнала.
+Для чтения истории переписки (пользователя с пользователем, группы или общего чата) у каждой переписки есть свой
+индекс conversations/<хеш ключа переписки>.idx - пары (номер, смещение) всех ее записей по возрастанию номера,
+поэтому страница истории читается двоичным поиском по индексу переписки, а не перебором журнала.
+Страницы истории задаются курсором - номерами записей, с которых продолжается чтение, в каждом из читаемых журналов
+(в режиме кластера у каждого процесса-обработчика свой журнал, журналы остальных процессов открываются только для чтения)"""
+import glob
+import hashlib
+import mmap
+import os
+import struct
+import time
+import zlib
+from array import array
+from bisect import bisect_right
+from collections import namedtuple
+from itertools import islice
+
+
+# Заголовок записи: CRC32 остальной части записи, номер, время, длины отправителя, адресата и сообщения
+RECORD_HEADER = struct.Struct('!IQdHHI')
+# Запись разреженного индекса: номер записи, смещение записи в сегменте
+INDEX_ENTRY = struct.Struct('!QQ')
+# Размер сегмента, при превышении которого начинается новый сегмент, байт
+SEGMENT_SIZE = 64 * 1024 * 1024
+# Расстояние между записями, попадающими в индекс, байт
+INDEX_INTERVAL = 4096
+# Каталог индексов переписок (внутри каталога журнала)
+CONVERSATIONS_DIR = 'conversations'
+
+# Запись журнала
+LogRecord = namedtuple('LogRecord', 'seq time sender target payload')
+
+
+def read_record(buf, offset):
+    """Чтение записи из буфера
+    :return: (запись, смещение следующей записи)
+    """
+    crc, seq, timestamp, sender_len, target_len, payload_len = RECORD_HEADER.unpack_from(buf, offset)
+    start = offset + RECORD_HEADER.size
+    target_start = start + sender_len
+    payload_start = target_start + target_len
+    end = payload_start + payload_len
+    record = LogRecord(seq, timestamp, str(buf[start:target_start], 'utf-8'), str(buf[target_start:payload_start], 'utf-8'),
+                       bytes(buf[payload_start:end]))
+    return record, end
+
+
+def conversation(sender, target):
+    """Ключ переписки, к которой относится сообщение: для личного сообщения - пара пользователей
+    (одна и та же для обоих направлений), иначе адресат ('#' + группа или пусто для общего чата)"""
+    if target.startswith('@'):
+        return '@' + '\0'.join(sorted((sender, target[1:])))
+    return target
+
+
+def parse_cursor(text):
+    """Разбор курсора страницы истории '<журнал>:<номер>,...'
+    :return: словарь журнал-номер записи, с которой продолжается чтение (None - чтение с конца журналов)
+    :raises ValueError: недопустимый курсор
+    """
+    if text is None:
+        return None
+    cursor = {}
+    for item in text.split(',') if text else ():
+        name, separator, seq = item.rpartition(':')
+        if not separator:
+            raise ValueError('Недопустимый курсор истории: {}'.format(text))
+        cursor[name] = int(seq)
+    return cursor
+
+
+def format_cursor(cursor):
+    """Курсор страницы истории в виде строки (None - история прочитана до начала)"""
+    if not cursor:
+        return None
+    return ','.join('{}:{}'.format(name, seq) for name, seq in sorted(cursor.items()))
+
+
+def read_history(logs, key, cursor=None, limit=50):
+    """Страница истории переписки из нескольких журналов (записи разных журналов упорядочиваются по времени)
+    :param logs: словарь имя-журнал (MessageLog)
+    :param key: ключ переписки (см. conversation)
+    :param cursor: курсор предыдущей страницы (см. parse_cursor), None - последние записи
+    :param limit: максимальное количество записей
+    :return: (список записей по возрастанию времени, курсор следующей страницы)
+    """
+    candidates = []
+    for name, log in logs.items():
+        if cursor is not None and name not in cursor:
+            continue  # журнал уже прочитан до начала
+        records = log.history(key, None if cursor is None else cursor[name], limit)
+        candidates.extend((record.time, name, record) for record in records)
+    candidates.sort(key=lambda candidate: candidate[:2] + (candidate[2].seq,))
+    page = candidates[-limit:]
+    next_cursor = {}
+    for name in logs:
+        seqs = [record.seq for timestamp, log_name, record in candidates if log_name == name]
+        taken = [record.seq for timestamp, log_name, record in page if log_name == name]
+        if taken and (len(seqs) > len(taken) or len(seqs) == limit):
+            next_cursor[name] = min(taken)
+        elif seqs and not taken:
+            next_cursor[name] = max(seqs) + 1  # ни одна запись журнала не попала на страницу
+    return [record for timestamp, name, record in page], next_cursor
+
+
+class Segment:
+    """Сегмент журнала с разреженным индексом"""
+
+    def __init__(self, directory, first_seq):
+        """
+        :param directory: каталог журнала
+        :param first_seq: номер первой записи сегмента
+        """
+        self.first_seq = first_seq
+        self.path = os.path.join(directory, '{:020d}.log'.format(first_seq))
+        self.index_path = os.path.join(directory, '{:020d}.idx'.format(first_seq))
+        self.seqs = array('Q') # номера записей индекса
+        self.offsets = array('Q') # смещения записей индекса
+        self.size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        self.map = None # отображение сегмента в память (mmap)
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'rb') as f:
+                data = f.read()
+            # Неполная последняя запись индекса (при аварийном завершении) отбрасывается
+            for seq, offset in INDEX_ENTRY.iter_unpack(data[:len(data) - len(data) % INDEX_ENTRY.size]):
+                self.seqs.append(seq)
+                self.offsets.append(offset)
+
+    def view(self):
+        """Отображение сегмента в память (при росте сегмента отображение создается заново,
+        старое закрывается, когда его перестают читать)"""
+        if self.map is None or len(self.map) < self.size:
+            with open(self.path, 'rb') as f:
+                self.map = mmap.mmap(f.fileno(), self.size, access=mmap.ACCESS_READ)
+        return self.map
+
+    def positions(self):
+        """Все записи сегмента вместе с их смещениями
+        :return: генератор пар (запись, смещение)
+        """
+        if not self.size:
+            return
+        buf = self.view()
+        offset = 0
+        while offset < self.size:
+            record, end = read_record(buf, offset)
+            yield record, offset
+            offset = end
+
+    def records(self, from_seq):
+        """Записи сегмента, начиная с номера from_seq"""
+        end = self.size
+        if not end:
+            return
+        buf = self.view()
+        i = bisect_right(self.seqs, from_seq) - 1
+        offset = self.offsets[i] if i >= 0 else 0
+        while offset < end:
+            record, offset = read_record(buf, offset)
+            if record.seq >= from_seq:
+                yield record
+
+    def recover(self):
+        """Проверка конца сегмента после аварийного завершения: недописанная или поврежденная запись
+        и все следующие за ней отбрасываются вместе с их записями индекса
+        :return: номер следующей записи
+        """
+        next_seq = self.first_seq
+        offset = 0
+        if not os.path.exists(self.path):
+            return next_seq
+        if self.offsets:
+            # До последней записи индекса сегмент уже был записан целиком
+            next_seq, offset = self.seqs[-1], self.offsets[-1]
+        if offset > self.size:
+            next_seq, offset = self.first_seq, 0
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+        position = 0
+        while position + RECORD_HEADER.size <= len(data):
+            crc, seq, timestamp, sender_len, target_len, payload_len = RECORD_HEADER.unpack_from(data, position)
+            end = position + RECORD_HEADER.size + sender_len + target_len + payload_len
+            if seq != next_seq or end > len(data) or zlib.crc32(data[position + 4:end]) != crc:
+                break
+            next_seq += 1
+            position = end
+        if offset + position < self.size:
+            print('Журнал сообщений: отброшен поврежденный конец сегмента {} ({} байт)'.format(
+                self.path, self.size - offset - position))
+            os.truncate(self.path, offset + position)
+            self.size = offset + position
+        while self.offsets and self.offsets[-1] >= self.size:
+            self.seqs.pop()
+            self.offsets.pop()
+        with open(self.index_path, 'wb') as f:
+            for seq, offset in zip(self.seqs, self.offsets):
+                f.write(INDEX_ENTRY.pack(seq, offset))
+        return next_seq
+
+
+class MessageLog:
+    """Сегментированный журнал сообщений"""
+
+    def __init__(self, directory, segment_size=SEGMENT_SIZE, index_interval=INDEX_INTERVAL, readonly=False):
+        """
+        :param directory: каталог журнала (создается, если его нет)
+        :param segment_size: размер сегмента, байт
+        :param index_interval: расстояние между записями индекса, байт
+        :param readonly: журнал только читается (журнал другого процесса-обработчика, который его пишет)
+        """
+        self.directory = directory
+        self.segment_size = segment_size
+        self.index_interval = index_interval
+        self.readonly = readonly
+        self.conversations = {} # ключ переписки - записи индекса переписки, еще не переданные в файл
+        self.file = None
+        self.index_file = None
+        self.segments = []
+        if readonly:
+            self.refresh()
+            return
+        os.makedirs(directory, exist_ok=True)
+        self.segments = [Segment(directory, int(name[:-4]))
+                         for name in sorted(os.listdir(directory)) if name.endswith('.log')]
+        if not self.segments:
+            self.segments.append(Segment(directory, 1))
+        self.next_seq = self.segments[-1].recover()
+        self.open_active()
+        if not os.path.isdir(os.path.join(directory, CONVERSATIONS_DIR)):
+            # Журнал, записанный без индексов переписок, индексируется один раз
+            os.makedirs(os.path.join(directory, CONVERSATIONS_DIR))
+            for segment in self.segments:
+                for record, offset in segment.positions():
+                    self.conversations.setdefault(conversation(record.sender, record.target), []).append(
+                        INDEX_ENTRY.pack(record.seq, offset))
+                self.flush()
+
+    @property
+    def first_seq(self):
+        """Номер первой записи журнала"""
+        return self.segments[0].first_seq
+
+    def refresh(self):
+        """Обновление списка и размеров сегментов журнала, открытого только для чтения
+        (процесс, который пишет журнал, дописывает последний сегмент и начинает новые)"""
+        known = {segment.first_seq for segment in self.segments}
+        start = max(len(self.segments) - 1, 0)
+        for path in sorted(glob.glob(os.path.join(self.directory, '*.log'))):
+            first_seq = int(os.path.basename(path)[:-4])
+            if first_seq not in known:
+                self.segments.append(Segment(self.directory, first_seq))
+        for segment in self.segments[start:]:
+            segment.size = os.path.getsize(segment.path)
+
+    def conversation_path(self, key):
+        """Путь к индексу переписки (ключ хешируется: имена пользователей могут быть длинными
+        и содержать недопустимые в пути символы)"""
+        name = hashlib.blake2b(key.encode('utf-8'), digest_size=16).hexdigest()
+        return os.path.join(self.directory, CONVERSATIONS_DIR, name + '.idx')
+
+    def open_active(self):
+        """Открытие файлов последнего (текущего) сегмента для дописывания"""
+        active = self.segments[-1]
+        self.file = open(active.path, 'ab')
+        self.index_file = open(active.index_path, 'ab')
+
+    def append(self, sender, target, payload, timestamp=None):
+        """Добавление сообщения в журнал
+        :param sender: имя отправителя
+        :param target: адресат ('@' + username, '#' + группа или пусто)
+        :param payload: байты сообщения
+        :param timestamp: время сообщения (по умолчанию - текущее)
+        :return: номер записи
+        """
+        seq = self.next_seq
+        sender = sender.encode('utf-8')
+        target = target.encode('utf-8')
+        header = RECORD_HEADER.pack(0, seq, time.time() if timestamp is None else timestamp,
+                                    len(sender), len(target), len(payload))
+        crc = zlib.crc32(payload, zlib.crc32(target, zlib.crc32(sender, zlib.crc32(header[4:]))))
+        active = self.segments[-1]
+        if not active.offsets or active.size - active.offsets[-1] >= self.index_interval:
+            active.seqs.append(seq)
+            active.offsets.append(active.size)
+            self.index_file.write(INDEX_ENTRY.pack(seq, active.size))
+        self.conversations.setdefault(conversation(sender.decode('utf-8'), target.decode('utf-8')), []).append(
+            INDEX_ENTRY.pack(seq, active.size))
+        self.file.write(b''.join((struct.pack('!I', crc), header[4:], sender, target, payload)))
+        active.size += RECORD_HEADER.size + len(sender) + len(target) + len(payload)
+        self.next_seq += 1
+        if active.size >= self.segment_size:
+            self.roll()
+        return seq
+
+    def flush(self):
+        """Передача дописанных записей в файлы сегмента, а затем их записей индекса - в индексы переписок
+        (после этого они доступны для чтения)"""
+        if self.readonly:
+            return
+        self.file.flush()
+        self.index_file.flush()
+        for key, entries in self.conversations.items():
+            with open(self.conversation_path(key), 'ab') as f:
+                size = f.tell()
+                if size % INDEX_ENTRY.size:
+                    # Неполная последняя запись индекса (при аварийном завершении) отбрасывается
+                    f.truncate(size - size % INDEX_ENTRY.size)
+                f.write(b''.join(entries))
+        self.conversations.clear()
+
+    def sync(self):
+        """Запись текущего сегмента на диск"""
+        self.flush()
+        os.fsync(self.file.fileno())
+        os.fsync(self.index_file.fileno())
+
+    def roll(self):
+        """Завершение текущего сегмента и начало нового"""
+        self.sync()
+        self.file.close()
+        self.index_file.close()
+        self.segments.append(Segment(self.directory, self.next_seq))
+        self.open_active()
+
+    def records(self, from_seq=1):
+        """Записи журнала, начиная с номера from_seq (генератор, читающий сегменты по мере обхода)"""
+        self.flush()
+        i = max(bisect_right([segment.first_seq for segment in self.segments], from_seq) - 1, 0)
+        for segment in self.segments[i:]:
+            yield from segment.records(from_seq)
+
+    def read(self, from_seq=1, limit=None):
+        """Список не более limit записей журнала, начиная с номера from_seq"""
+        return list(islice(self.records(from_seq), limit))
+
+    def history(self, key, before=None, limit=50):
+        """Последние limit записей переписки с номерами меньше before (двоичный поиск по индексу переписки,
+        поэтому чтение любой страницы стоит одинаково)
+        :param key: ключ переписки (см. conversation)
+        :param before: номер записи, до которой читается история (None - до конца журнала)
+        :param limit: максимальное количество записей
+        :return: список записей по возрастанию номера
+        """
+        if self.readonly:
+            self.refresh()
+        else:
+            self.flush()
+        try:
+            f = open(self.conversation_path(key), 'rb')
+        except FileNotFoundError:
+            return []
+        with f:
+            count = os.fstat(f.fileno()).st_size // INDEX_ENTRY.size
+            if not count:
+                return []
+            with mmap.mmap(f.fileno(), count * INDEX_ENTRY.size, access=mmap.ACCESS_READ) as buf:
+                low, high = 0, count
+                while before is not None and low < high:
+                    middle = (low + high) // 2
+                    if INDEX_ENTRY.unpack_from(buf, middle * INDEX_ENTRY.size)[0] < before:
+                        low = middle + 1
+                    else:
+                        high = middle
+                entries = [INDEX_ENTRY.unpack_from(buf, i * INDEX_ENTRY.size) for i in range(max(high - limit, 0), high)]
+        first_seqs = [segment.first_seq for segment in self.segments]
+        records = {}
+        for seq, offset in entries:
+            record = self.record_at(first_seqs, seq, offset)
+            # Записи индекса, оставшиеся от отброшенного при восстановлении конца журнала, пропускаются,
+            # а номер отброшенной записи, доставшийся новой записи, попадает в историю один раз
+            if record is not None and conversation(record.sender, record.target) == key:
+                records[seq] = record
+        return [records[seq] for seq in sorted(records)]
+
+    def record_at(self, first_seqs, seq, offset):
+        """Чтение записи по номеру и смещению из индекса переписки
+        :param first_seqs: номера первых записей сегментов
+        :return: запись или None, если такой записи в журнале нет
+        """
+        i = bisect_right(first_seqs, seq) - 1
+        if i < 0 or offset + RECORD_HEADER.size > self.segments[i].size:
+            return None
+        segment = self.segments[i]
+        try:
+            record, end = read_record(segment.view(), offset)
+        except (ValueError, struct.error):
+            return None
+        if record.seq != seq or end > segment.size:
+            return None
+        return record
+
+    def close(self):
+        """Запись журнала на диск и закрытие файлов"""
+        if not self.readonly:
+            self.sync()
+            self.file.close()
+            self.index_file.close()
+        for segment in self.segments:
+            segment.map = None
@@ -0,0 +1,163 @@
+"""Очереди сообщений для пользователей, которые не подключены к серверу (store-and-forward).
+Очередь пользователя - файл <имя пользователя в hex>.q, в который дописываются сообщения (4 байта длины + байты).
+При подключении пользователя очередь забирается переименованием в <имя в hex>.<время>.claimed (новые сообщения
+пишутся уже в новый файл очереди), а каждый забранный файл - переименованием в <имя в hex>.<время>.<pid>.reading,
+поэтому файл читает только один процесс (режим кластера), и отправляется клиенту частями. Если клиент отключился
+до конца отправки, смещение неотправленной части сохраняется в файле .pos, файл возвращается в .claimed,
+и при следующем подключении отправка продолжается с него. Очередь могут дописывать несколько процессов:
+сообщение записывается одним вызовом write в режиме дописывания"""
+import glob
+import os
+import struct
+import time
+from collections import deque
+
+
+# Заголовок сообщения в файле очереди: длина сообщения
+PENDING_HEADER = struct.Struct('!I')
+# Максимальный размер очереди пользователя, байт (при превышении новые сообщения отбрасываются)
+PENDING_LIMIT = 16 * 1024 * 1024
+
+
+class PendingReader:
+    """Чтение забранных очередей пользователя частями"""
+
+    def __init__(self, paths):
+        """
+        :param paths: пути к забранным файлам очереди в порядке их создания
+        """
+        self.paths = deque(paths)
+        self.file = None
+
+    @property
+    def done(self):
+        """Все сообщения прочитаны"""
+        return self.file is None and not self.paths
+
+    def read(self, count):
+        """Чтение не более count следующих сообщений
+        :return: список байтов сообщений
+        """
+        messages = []
+        while len(messages) < count and not self.done:
+            if self.file is None:
+                self.file = open(self.paths[0], 'rb')
+                if os.path.exists(self.paths[0] + '.pos'):
+                    with open(self.paths[0] + '.pos') as f:
+                        self.file.seek(int(f.read()))
+            header = self.file.read(PENDING_HEADER.size)
+            data = None
+            if len(header) == PENDING_HEADER.size:
+                size, = PENDING_HEADER.unpack(header)
+                data = self.file.read(size)
+                if len(data) < size:
+                    data = None
+            if data is None:
+                # Конец файла (недописанное при аварийном завершении сообщение отбрасывается)
+                self.file.close()
+                self.file = None
+                path = self.paths.popleft()
+                os.remove(path)
+                if os.path.exists(path + '.pos'):
+                    os.remove(path + '.pos')
+                continue
+            messages.append(data)
+        return messages
+
+    def close(self):
+        """Сохранение смещения неотправленной части (если прочитаны не все сообщения) и возврат неотправленных
+        файлов в забранные очереди пользователя (их заберет следующее подключение)"""
+        if self.file is not None:
+            with open(self.paths[0] + '.pos', 'w') as f:
+                f.write(str(self.file.tell()))
+            self.file.close()
+            self.file = None
+        while self.paths:
+            path = self.paths.popleft()
+            claimed = path.rsplit('.', 2)[0] + '.claimed'
+            # Смещение возвращается раньше файла: забравший файл процесс должен найти и его
+            if os.path.exists(path + '.pos'):
+                os.rename(path + '.pos', claimed + '.pos')
+            os.rename(path, claimed)
+
+
+class PendingStore:
+    """Каталог очередей сообщений пользователей"""
+
+    def __init__(self, directory, limit=PENDING_LIMIT):
+        """
+        :param directory: каталог очередей (создается, если его нет)
+        :param limit: максимальный размер очереди пользователя, байт
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.limit = limit
+
+    def prefix(self, username):
+        """Начало имен файлов очереди пользователя (имя в hex не содержит недопустимых в пути символов)"""
+        return os.path.join(self.directory, username.encode('utf-8').hex())
+
+    def put(self, username, data):
+        """Добавление сообщения в очередь пользователя
+        :return: False, если очередь переполнена и сообщение не добавлено
+        """
+        path = self.prefix(username) + '.q'
+        try:
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            size = 0
+        if size + PENDING_HEADER.size + len(data) > self.limit:
+            return False
+        with open(path, 'ab') as f:
+            f.write(PENDING_HEADER.pack(len(data)) + data)
+        return True
+
+    def claim(self, username):
+        """Забирает очередь пользователя для отправки
+        :return: PendingReader или None, если сообщений для пользователя нет
+        """
+        prefix = self.prefix(username)
+        try:
+            os.rename(prefix + '.q', '{}.{:020d}.claimed'.format(prefix, time.time_ns()))
+        except FileNotFoundError:
+            pass
+        # Файлы, которые читали завершившиеся аварийно процессы, забираются заново
+        for path in glob.glob(prefix + '.*.reading'):
+            if not process_alive(int(path.rsplit('.', 2)[1])):
+                self.take(path, path.rsplit('.', 2)[0] + '.claimed')
+        # Вместе с новой забираются и не отправленные до конца при прошлых подключениях очереди (в одном процессе
+        # сервер не забирает очередь пользователя, пока ее отправка другому подключению не закончилась,
+        # см. MsgTCPServer.start_forwarding, а файл, который забрал другой процесс, пропускается)
+        paths = []
+        for path in sorted(glob.glob(prefix + '.*.claimed')):
+            reading = '{}.{}.reading'.format(path.rsplit('.', 1)[0], os.getpid())
+            if self.take(path, reading):
+                paths.append(reading)
+        return PendingReader(paths) if paths else None
+
+    @staticmethod
+    def take(path, new_path):
+        """Атомарное переименование забранного файла очереди (вместе с файлом смещения)
+        :return: False, если файл уже переименовал другой процесс
+        """
+        try:
+            os.rename(path, new_path)
+        except FileNotFoundError:
+            return False
+        if os.path.exists(path + '.pos'):
+            os.rename(path + '.pos', new_path + '.pos')
+        return True
+
+
+def process_alive(pid):
+    """Проверка, что процесс pid на этой машине еще работает"""
+    if os.name == 'nt':
+        # В Windows нет режима кластера (SO_REUSEPORT): файлы других процессов остались от прошлых запусков
+        return pid == os.getpid()
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
@@ -1,48 +1,251 @@
-from .server_models import Client, ClientContact, LogonHistory
+from .server_models import Client, ClientContact, ContactChange, LogonHistory, GroupMember
 from .server_errors import ContactDoesNotExist
+from .batch_writer import BatchWriter
+from collections import Counter, OrderedDict
+from itertools import islice
+from sqlalchemy import bindparam
+from sqlalchemy.exc import IntegrityError
 import datetime
+import threading
+
+
+# Отложенная запись истории входов: записи пишутся в БД одной транзакцией не реже, чем раз в
+# LOGON_FLUSH_INTERVAL секунд, и не реже, чем по накоплении LOGON_BATCH_SIZE записей.
+# При аварийном завершении сервера теряется не больше LOGON_QUEUE_LIMIT записей (и не больше, чем за LOGON_FLUSH_INTERVAL,
+# если БД успевает их записывать); при заполнении очереди вход клиентов ждет записи накопленных записей
+LOGON_FLUSH_INTERVAL = 1.0
+LOGON_BATCH_SIZE = 500
+LOGON_QUEUE_LIMIT = 10000
+# Максимальное количество имен в кеше идентификаторов клиентов (при превышении вытесняются давно не использованные)
+CLIENT_CACHE_SIZE = 10000
+# Массовые операции: записи обрабатываются частями по BULK_CHUNK_SIZE (один запрос существующих записей
+# и одна вставка executemany на часть; в запросе не больше 999 параметров - ограничение старых версий SQLite),
+# транзакция фиксируется после каждых BULK_COMMIT_SIZE записей
+BULK_CHUNK_SIZE = 400
+BULK_COMMIT_SIZE = 50000
+# Сколько последних изменений списка контактов клиента хранится в журнале (клиенту с более старой копией
+# списка отправляется полный список)
+CONTACT_CHANGES_KEEP = 1000
+
+
+class LogonWriter(BatchWriter):
+    """Поток отложенной (write-behind) записи истории входов"""
+    description = 'историю входов'
+
+    def __init__(self, session, interval=LOGON_FLUSH_INTERVAL, batch_size=LOGON_BATCH_SIZE, limit=LOGON_QUEUE_LIMIT):
+        """
+        :param session: сессия (scoped_session, чтобы у потока была своя сессия)
+        :param interval: максимальное время хранения записи в очереди, с
+        :param batch_size: максимальное количество записей в одной транзакции
+        :param limit: максимальное количество записей в очереди
+        """
+        super().__init__(session, 'logon-writer', interval, batch_size, limit)
+
+    def add(self, username, logon_time, client_ip):
+        """Постановка записи о входе клиента в очередь"""
+        self.queue.put((username, logon_time, client_ip))
+
+    def write_batch(self, batch):
+        """Запись пачки записей о входах одной транзакцией"""
+        names = {username for username, logon_time, client_ip in batch}
+        ids = dict(self.session.query(Client.Name, Client.ClientId).filter(Client.Name.in_(names)))
+        self.session.bulk_insert_mappings(LogonHistory, [
+            {'ClientId': ids[username], 'LogonTime': logon_time, 'ClientIP': client_ip}
+            for username, logon_time, client_ip in batch if username in ids])
+        self.session.commit()
+
+
+class ClientIdCache:
+    """Кеш имя клиента -> ClientId с вытеснением давно не использованных записей (LRU).
+    Клиенты не удаляются из БД, а имя клиента не меняется, поэтому найденный идентификатор не устаревает;
+    отсутствие клиента не кешируется (клиента может добавить другой процесс сервера).
+    Кешем пользуются все потоки пула запросов к БД, поэтому доступ к нему защищен блокировкой"""
+
+    def __init__(self, size=CLIENT_CACHE_SIZE):
+        """
+        :param size: максимальное количество записей
+        """
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0 # количество найденных в кеше имен
+        self.misses = 0 # количество имен, за которыми пришлось обратиться к БД
+
+    def get(self, username):
+        """Получение ClientId из кеша (None, если имени в кеше нет)"""
+        with self.lock:
+            client_id = self.items.get(username)
+            if client_id is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.items.move_to_end(username)
+            return client_id
+
+    def put(self, username, client_id):
+        """Добавление записи в кеш"""
+        with self.lock:
+            self.items[username] = client_id
+            self.items.move_to_end(username)
+            if len(self.items) > self.size:
+                self.items.popitem(last=False)
 
 
 class Repo:
     """Серверное хранилище"""
 
-    def __init__(self, session):
+    def __init__(self, session, logon_writer=None, cache_size=CLIENT_CACHE_SIZE):
         """
         Запоминаем сессию, чтобы было удобно с ней работать
         :param session:
+        :param logon_writer: поток отложенной записи истории входов (None - записи пишутся сразу)
+        :param cache_size: размер кеша идентификаторов клиентов
         """
         self.session = session
+        self.logon_writer = logon_writer
+        self.client_ids = ClientIdCache(cache_size)
+
+    def close(self):
+        """Запись данных, отложенных потоком записи истории входов"""
+        if self.logon_writer is not None:
+            self.logon_writer.close()
 
     def add_client(self, username, info=None):
         """Добавление клиента"""
         new_item = Client(username, info)
         self.session.add(new_item)
         self.session.commit()
+        self.client_ids.put(username, new_item.ClientId)
 
     def client_exists(self, username):
         """Проверка, что клиент уже есть"""
-        result = self.session.query(Client).filter(Client.Name == username).count() > 0
+        result = self.get_client_id(username) is not None
         return result
 
+    def get_client_id(self, username):
+        """Получение ClientId клиента по имени (None, если клиента нет) через кеш"""
+        client_id = self.client_ids.get(username)
+        if client_id is None:
+            client_id = self.session.query(Client.ClientId).filter(Client.Name == username).scalar()
+            if client_id is not None:
+                self.client_ids.put(username, client_id)
+        return client_id
+
     def get_client_by_username(self, username):
         """Получение клиента по имени"""
         client = self.session.query(Client).filter(Client.Name == username).first()
         return client
 
+    def add_clients_bulk(self, clients, chunk_size=BULK_CHUNK_SIZE, commit_size=BULK_COMMIT_SIZE):
+        """Массовое добавление клиентов, уже существующие пропускаются
+        :param clients: поток пар (имя, информация), информация может быть None
+        :return: Counter с количеством добавленных (added) и пропущенных (exists) клиентов
+        """
+        counts = Counter()
+        for chunk in self.bulk_chunks(clients, chunk_size, commit_size):
+            infos = dict(chunk)
+            existing = {row.Name for row in self.session.query(Client.Name).filter(Client.Name.in_(infos))}
+            rows = [{'Name': name, 'Info': info} for name, info in infos.items() if name not in existing]
+            if rows:
+                self.session.execute(Client.__table__.insert(), rows)
+            counts['added'] += len(rows)
+            counts['exists'] += len(chunk) - len(rows)
+        return counts
+
+    def add_contacts_bulk(self, pairs, chunk_size=BULK_CHUNK_SIZE, commit_size=BULK_COMMIT_SIZE):
+        """Массовое добавление контактов, уже существующие пропускаются
+        :param pairs: поток пар (имя клиента, имя контакта)
+        :return: Counter с количеством добавленных (added), уже существующих (exists) контактов
+            и пар с неизвестным клиентом или контактом (unknown)
+        """
+        counts = Counter()
+        for chunk in self.bulk_chunks(pairs, chunk_size, commit_size):
+            ids, unknown, existing = self.resolve_contacts(chunk)
+            rows = [{'ClientId': client_id, 'ContactId': contact_id}
+                    for client_id, contact_id in ids if (client_id, contact_id) not in existing]
+            if rows:
+                self.session.execute(ClientContact.__table__.insert(), rows)
+                self.bump_contact_versions({row['ClientId'] for row in rows})
+            counts['added'] += len(rows)
+            counts['exists'] += len(chunk) - unknown - len(rows)
+            counts['unknown'] += unknown
+        return counts
+
+    def del_contacts_bulk(self, pairs, chunk_size=BULK_CHUNK_SIZE, commit_size=BULK_COMMIT_SIZE):
+        """Массовое удаление контактов
+        :param pairs: поток пар (имя клиента, имя контакта)
+        :return: Counter с количеством удаленных (deleted), отсутствующих в списках (absent) контактов
+            и пар с неизвестным клиентом или контактом (unknown)
+        """
+        counts = Counter()
+        delete = ClientContact.__table__.delete().where(
+            ClientContact.ClientId == bindparam('client_id')).where(
+            ClientContact.ContactId == bindparam('contact_id'))
+        for chunk in self.bulk_chunks(pairs, chunk_size, commit_size):
+            ids, unknown, existing = self.resolve_contacts(chunk)
+            rows = [{'client_id': client_id, 'contact_id': contact_id}
+                    for client_id, contact_id in ids if (client_id, contact_id) in existing]
+            if rows:
+                self.session.execute(delete, rows)
+                self.bump_contact_versions({row['client_id'] for row in rows})
+            counts['deleted'] += len(rows)
+            counts['absent'] += len(chunk) - unknown - len(rows)
+            counts['unknown'] += unknown
+        return counts
+
+    def bulk_chunks(self, items, chunk_size, commit_size):
+        """Чтение потока записей частями по chunk_size записей с фиксацией транзакции
+        после каждых commit_size записей и после последней части"""
+        items = iter(items)
+        uncommitted = 0
+        while True:
+            chunk = list(islice(items, chunk_size))
+            if not chunk:
+                break
+            yield chunk
+            uncommitted += len(chunk)
+            if uncommitted >= commit_size:
+                self.session.commit()
+                uncommitted = 0
+        self.session.commit()
+
+    def resolve_contacts(self, pairs):
+        """Перевод пар имен (клиент, контакт) в пары ClientId одним запросом
+        :return: список пар id без повторов, количество пар с неизвестным клиентом или контактом
+            и множество пар id, которые уже есть в списках контактов
+        """
+        names = {name for pair in pairs for name in pair}
+        ids = dict(self.session.query(Client.Name, Client.ClientId).filter(Client.Name.in_(names)))
+        known = [(ids[client], ids[contact]) for client, contact in pairs if client in ids and contact in ids]
+        unique = list(dict.fromkeys(known))
+        existing = set()
+        if unique:
+            # Условие только по клиентам: с условием и по контактам SQLite перебирает все их сочетания
+            existing = {(row.ClientId, row.ContactId) for row in self.session.query(
+                ClientContact.ClientId, ClientContact.ContactId).filter(
+                ClientContact.ClientId.in_({client_id for client_id, contact_id in unique}))}
+        return unique, len(pairs) - len(known), existing
+
     def add_contact(self, client_username, contact_username):
         """Добавление контакта"""
-        contact = self.get_client_by_username(contact_username)
-        if contact:
-            client = self.get_client_by_username(client_username)
-            if client:
+        contact_id = self.get_client_id(contact_username)
+        if contact_id is not None:
+            client_id = self.get_client_id(client_username)
+            if client_id is not None:
                 is_exists = self.session.query(ClientContact).filter(
-                    ClientContact.ClientId == client.ClientId).filter(
-                    ClientContact.ContactId == contact.ClientId).first()
+                    ClientContact.ClientId == client_id).filter(
+                    ClientContact.ContactId == contact_id).first()
                 if not is_exists:
-                    cc = ClientContact(client_id=client.ClientId, contact_id=contact.ClientId)
+                    cc = ClientContact(client_id=client_id, contact_id=contact_id)
                     self.session.add(cc)
-                    self.session.commit()
-                else:
+                    self.record_contact_change(client_id, contact_id, True)
+                    try:
+                        self.session.commit()
+                    except IntegrityError:
+                        # Контакт добавлен одновременно другим запросом (дубликаты запрещает уникальный индекс)
+                        self.session.rollback()
+                        is_exists = True
+                if is_exists:
                     print('Contact', contact_username, 'already exists in client contact list')
                     raise Exception('Такой контакт уже есть у клиента!')
             else:
@@ -52,14 +255,15 @@ class Repo:
 
     def del_contact(self, client_username, contact_username):
         """Удаление контакта"""
-        contact = self.get_client_by_username(contact_username)
-        if contact:
-            client = self.get_client_by_username(client_username)
-            if client:
+        contact_id = self.get_client_id(contact_username)
+        if contact_id is not None:
+            client_id = self.get_client_id(client_username)
+            if client_id is not None:
                 cc = self.session.query(ClientContact).filter(
-                    ClientContact.ClientId == client.ClientId).filter(
-                    ClientContact.ContactId == contact.ClientId).first()
+                    ClientContact.ClientId == client_id).filter(
+                    ClientContact.ContactId == contact_id).first()
                 self.session.delete(cc)
+                self.record_contact_change(client_id, contact_id, False)
                 self.session.commit()
             else:
                 print(client_username, 'doesn not exist')
@@ -70,21 +274,97 @@ class Repo:
 
     def get_contacts(self, client_username):
         """Получение контактов клиента"""
-        client = self.get_client_by_username(client_username)
+        client_id = self.get_client_id(client_username)
         result = []
-        if client:
-            # Тут нету relationship поэтому берем запросом
-            contacts_clients = self.session.query(ClientContact).filter(ClientContact.ClientId == client.ClientId)
-            for contact_client in contacts_clients:
-                contact = self.session.query(Client).filter(Client.ClientId == contact_client.ContactId).first()
-                result.append(contact)
+        if client_id is not None:
+            # Тут нету relationship поэтому берем запросом (одним, с соединением таблиц)
+            result = self.contacts_query(Client, client_id).all()
         return result
 
+    def get_contact_names(self, client_username):
+        """Получение имен контактов клиента (без загрузки объектов Client)"""
+        client_id = self.get_client_id(client_username)
+        result = []
+        if client_id is not None:
+            result = [contact.Name for contact in self.contacts_query(Client.Name, client_id)]
+        return result
+
+    def get_contact_list(self, client_username):
+        """Получение имен контактов клиента вместе с версией списка
+        :return: (список имен, версия)
+        """
+        client_id = self.get_client_id(client_username)
+        if client_id is None:
+            return [], 0
+        version = self.session.query(Client.ContactVersion).filter(Client.ClientId == client_id).scalar()
+        return [contact.Name for contact in self.contacts_query(Client.Name, client_id)], version
+
+    def get_contact_version(self, client_username):
+        """Получение версии списка контактов клиента (0, если клиента нет) - для проверки кеша списков контактов"""
+        client_id = self.get_client_id(client_username)
+        if client_id is None:
+            return 0
+        return self.session.query(Client.ContactVersion).filter(Client.ClientId == client_id).scalar()
+
+    def get_contact_changes(self, client_username, version):
+        """Изменения списка контактов клиента после версии version
+        :return: (версия, список добавленных, список удаленных имен) или None, если изменений после version
+            в журнале нет (версия неизвестна, изменения удалены из журнала или список изменен массово) и клиенту
+            нужен полный список
+        """
+        client_id = self.get_client_id(client_username)
+        if client_id is None:
+            return None
+        current = self.session.query(Client.ContactVersion).filter(Client.ClientId == client_id).scalar()
+        if version > current:
+            return None
+        changes = self.session.query(ContactChange.Added, Client.Name).join(
+            Client, Client.ClientId == ContactChange.ContactId).filter(
+            ContactChange.ClientId == client_id).filter(
+            ContactChange.Version > version).order_by(ContactChange.Version).all()
+        if len(changes) != current - version:
+            return None
+        # Контакт, добавленный и удаленный после version, клиенту не отправляется
+        added = OrderedDict()
+        removed = OrderedDict()
+        for is_added, name in changes:
+            if is_added:
+                if removed.pop(name, None) is None:
+                    added[name] = True
+            elif added.pop(name, None) is None:
+                removed[name] = True
+        return current, list(added), list(removed)
+
+    def record_contact_change(self, client_id, contact_id, added):
+        """Запись изменения списка контактов клиента в журнал (в транзакции изменения списка):
+        версия списка увеличивается, а изменения старше CONTACT_CHANGES_KEEP версий удаляются"""
+        # Обновление первым запросом блокирует запись в базу, поэтому версии клиента не повторяются
+        self.session.query(Client).filter(Client.ClientId == client_id).update(
+            {Client.ContactVersion: Client.ContactVersion + 1}, synchronize_session=False)
+        version = self.session.query(Client.ContactVersion).filter(Client.ClientId == client_id).scalar()
+        self.session.add(ContactChange(client_id, version, contact_id, added))
+        self.session.query(ContactChange).filter(ContactChange.ClientId == client_id).filter(
+            ContactChange.Version <= version - CONTACT_CHANGES_KEEP).delete(synchronize_session=False)
+
+    def bump_contact_versions(self, client_ids):
+        """Увеличение версий списков контактов клиентов при массовом изменении: в журнал изменения не пишутся,
+        поэтому клиентам с более старой копией списка отправляется полный список"""
+        self.session.query(Client).filter(Client.ClientId.in_(client_ids)).update(
+            {Client.ContactVersion: Client.ContactVersion + 1}, synchronize_session=False)
+
+    def contacts_query(self, entity, client_id):
+        """Запрос контактов клиента в порядке их добавления"""
+        return self.session.query(entity).join(ClientContact, ClientContact.ContactId == Client.ClientId).filter(
+            ClientContact.ClientId == client_id).order_by(ClientContact.ClientContactId)
+
     def add_logon(self, client_username, client_ip):
         """Добавление записи с временем входа клиента"""
-        client = self.get_client_by_username(client_username)
-        if client:
-            lh = LogonHistory(client_id=client.ClientId, logon_time=datetime.datetime.now(), client_ip=client_ip)
+        if self.logon_writer is not None:
+            self.logon_writer.add(client_username, datetime.datetime.now(), client_ip)
+            return
+        client_id = self.get_client_id(client_username)
+        if client_id is not None:
+            lh = LogonHistory(client_id=client_id, logon_time=datetime.datetime.now(), client_ip=client_ip)
             self.session.add(lh)
             self.session.commit()
         else:
@@ -92,12 +372,44 @@ class Repo:
 
     def get_logon_history(self, username):
         """Получение истории входов клиента"""
-        client = self.get_client_by_username(username)
+        client_id = self.get_client_id(username)
         result = {}
-        if client:
-            logons = self.session.query(LogonHistory).filter(LogonHistory.ClientId == client.ClientId).all()
+        if client_id is not None:
+            logons = self.session.query(LogonHistory).filter(LogonHistory.ClientId == client_id).all()
             for logon in logons:
                 result[logon.LogonTime] = logon.ClientIP
                 print(logon.LogonTime, logon.ClientIP)
         return result
 
+    def join_group(self, username, group_name):
+        """Добавление клиента в группу (повторное вступление ничего не меняет)"""
+        client_id = self.get_client_id(username)
+        if client_id is not None:
+            is_member = self.session.query(GroupMember).filter(
+                GroupMember.GroupName == group_name).filter(
+                GroupMember.MemberId == client_id).first()
+            if not is_member:
+                self.session.add(GroupMember(group_name, client_id))
+                self.session.commit()
+        else:
+            raise ContactDoesNotExist(username)
+
+    def leave_group(self, username, group_name):
+        """Удаление клиента из группы"""
+        client_id = self.get_client_id(username)
+        if client_id is not None:
+            self.session.query(GroupMember).filter(
+                GroupMember.GroupName == group_name).filter(
+                GroupMember.MemberId == client_id).delete()
+            self.session.commit()
+        else:
+            raise ContactDoesNotExist(username)
+
+    def get_groups(self, username):
+        """Получение имен групп, в которых состоит клиент"""
+        client_id = self.get_client_id(username)
+        result = []
+        if client_id is not None:
+            members = self.session.query(GroupMember.GroupName).filter(GroupMember.MemberId == client_id)
+            result = [member.GroupName for member in members]
+        return result
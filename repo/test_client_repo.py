@@ -0,0 +1,43 @@
+import datetime
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker, scoped_session
+from .client_models import Base
+from .client_repo import Repo, MsgHistoryWriter
+
+
+def test_history_writer(tmp_path):
+    engine = create_engine('sqlite:///{}'.format(tmp_path / 'client.db'))
+    Base.metadata.create_all(engine)
+    Session = scoped_session(sessionmaker(bind=engine))
+    repo = Repo(Session)
+    writer = MsgHistoryWriter(Session, interval=10)
+    writer.start()
+    start = datetime.datetime(2017, 7, 14, 12, 0)
+    for i in range(250):
+        writer.add('Max' if i % 2 else 'Leo', 'message {}'.format(i), start + datetime.timedelta(seconds=i))
+    # сообщения записываются пачками, а при закрытии записываются все оставшиеся
+    writer.close()
+    assert repo.get_messages(3) == [('Max', 'message 247', start + datetime.timedelta(seconds=247)),
+                                    ('Leo', 'message 248', start + datetime.timedelta(seconds=248)),
+                                    ('Max', 'message 249', start + datetime.timedelta(seconds=249))]
+    older = repo.get_messages(2, before=start + datetime.timedelta(seconds=247))
+    assert [message for username, message, msg_time in older] == ['message 245', 'message 246']
+    assert repo.last_message_time() == start + datetime.timedelta(seconds=249)
+    assert repo.last_message_time(exclude='Max') == start + datetime.timedelta(seconds=248)
+    assert repo.client_exists('Leo') and repo.client_exists('Max')
+    Session.remove()
+
+
+def test_contact_changes(tmp_path):
+    engine = create_engine('sqlite:///{}'.format(tmp_path / 'client.db'))
+    Base.metadata.create_all(engine)
+    repo = Repo(sessionmaker(bind=engine)())
+    # копии списка еще нет
+    assert repo.get_contact_list('Max') == ([], 0)
+    repo.apply_contact_changes('Max', 3, ['Leo', 'Kate'], full=True)
+    assert repo.get_contact_list('Max') == (['Leo', 'Kate'], 3)
+    # повторно добавленный контакт не дублируется
+    repo.apply_contact_changes('Max', 5, ['Ann', 'Kate'], ['Leo'])
+    assert repo.get_contact_list('Max') == (['Ann', 'Kate'], 5)
+    repo.apply_contact_changes('Max', 6, ['Bob'], full=True)
+    assert repo.get_contact_list('Max') == (['Bob'], 6)
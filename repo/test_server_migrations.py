@@ -0,0 +1,51 @@
+from sqlalchemy import create_engine, inspect, text
+from .server_migrations import migrate, get_version, MIGRATIONS
+
+
+def create_old_db():
+    """База в структуре до миграций: без индексов, с повторяющимся контактом и уникальным именем группы"""
+    engine = create_engine('sqlite:///:memory:', echo=False)
+    with engine.begin() as connection:
+        connection.execute(text('CREATE TABLE Client (ClientId INTEGER PRIMARY KEY, Name VARCHAR UNIQUE, Info VARCHAR)'))
+        connection.execute(text('CREATE TABLE ClientContact (ClientContactId INTEGER PRIMARY KEY, '
+                                'ClientId INTEGER REFERENCES Client (ClientId), ContactId INTEGER REFERENCES Client (ClientId))'))
+        connection.execute(text('CREATE TABLE LogonHistory (ClientHistoryId INTEGER PRIMARY KEY, '
+                                'ClientId INTEGER REFERENCES Client (ClientId), LogonTime DATETIME NOT NULL, ClientIP VARCHAR NOT NULL)'))
+        connection.execute(text('CREATE TABLE GroupMember (GroupId INTEGER PRIMARY KEY, GroupName VARCHAR UNIQUE, '
+                                'MemberId INTEGER REFERENCES Client (ClientId))'))
+        connection.execute(text("INSERT INTO Client (Name) VALUES ('Max'), ('Leo')"))
+        connection.execute(text("INSERT INTO GroupMember (GroupName, MemberId) VALUES ('python', 1)"))
+        connection.execute(text('INSERT INTO ClientContact (ClientId, ContactId) VALUES (1, 2), (1, 2), (2, 1)'))
+    return engine
+
+
+def index_names(engine):
+    inspector = inspect(engine)
+    return {index['name'] for table in ('ClientContact', 'LogonHistory') for index in inspector.get_indexes(table)}
+
+
+def test_migrate_old_db():
+    engine = create_old_db()
+    assert migrate(engine) == [version for version, description, function in MIGRATIONS]
+    with engine.connect() as connection:
+        assert get_version(connection) == MIGRATIONS[-1][0]
+        # дубликат удален, остальные контакты на месте
+        rows = connection.execute(text('SELECT ClientContactId, ClientId, ContactId FROM ClientContact')).fetchall()
+        assert [tuple(row) for row in rows] == [(1, 1, 2), (3, 2, 1)]
+    assert index_names(engine) == {'ix_ClientContact_ClientId_ContactId', 'ix_LogonHistory_ClientId_LogonTime'}
+    # в группе может быть несколько участников, участники старой базы сохранены
+    with engine.begin() as connection:
+        connection.execute(text("INSERT INTO GroupMember (GroupName, MemberId) VALUES ('python', 2)"))
+        rows = connection.execute(text('SELECT GroupName, MemberId FROM GroupMember ORDER BY GroupId')).fetchall()
+        assert [tuple(row) for row in rows] == [('python', 1), ('python', 2)]
+    # повторный запуск ничего не меняет
+    assert migrate(engine) == []
+
+
+def test_migrate_new_db():
+    # новая база сразу создается в последней версии с теми же индексами, что и после миграций
+    engine = create_engine('sqlite:///:memory:', echo=False)
+    assert migrate(engine) == []
+    with engine.connect() as connection:
+        assert get_version(connection) == MIGRATIONS[-1][0]
+    assert index_names(engine) == {'ix_ClientContact_ClientId_ContactId', 'ix_LogonHistory_ClientId_LogonTime'}
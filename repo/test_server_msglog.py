@@ -0,0 +1,75 @@
+import os
+from .server_msglog import MessageLog, conversation, format_cursor, parse_cursor, read_history
+
+
+def test_append_read(tmp_path):
+    # маленькие сегменты и частый индекс, чтобы проверить смену сегментов и поиск по индексу
+    log = MessageLog(str(tmp_path), segment_size=1000, index_interval=100)
+    for i in range(100):
+        assert log.append('Max', '@Leo' if i % 2 else '', b'message %d' % i, timestamp=1500000000.0 + i) == i + 1
+    assert len(log.segments) > 2
+    assert all(len(segment.seqs) > 1 for segment in log.segments[:-1])
+    records = log.read()
+    assert [record.seq for record in records] == list(range(1, 101))
+    assert records[1] == (2, 1500000001.0, 'Max', '@Leo', b'message 1')
+    assert [record.payload for record in log.read(from_seq=42, limit=3)] == [b'message 41', b'message 42', b'message 43']
+    assert log.read(from_seq=101) == []
+    # записи доступны для чтения сразу после добавления
+    log.append('Leo', '#group', b'new')
+    assert log.read(from_seq=101)[0].target == '#group'
+    log.close()
+
+
+def test_reopen_recover(tmp_path):
+    log = MessageLog(str(tmp_path), segment_size=1000, index_interval=100)
+    for i in range(30):
+        log.append('Max', '', b'message %d' % i)
+    log.close()
+    # аварийное завершение посреди записи: от последней записи остался только заголовок
+    last = log.segments[-1].path
+    os.truncate(last, os.path.getsize(last) - len(b'message 29'))
+    log = MessageLog(str(tmp_path), segment_size=1000, index_interval=100)
+    assert log.next_seq == 30
+    assert log.read()[-1].payload == b'message 28'
+    assert log.append('Max', '', b'again') == 30
+    assert [record.payload for record in log.read(from_seq=29)] == [b'message 28', b'again']
+    log.close()
+
+
+def test_history(tmp_path):
+    log = MessageLog(str(tmp_path / 'worker-0'), segment_size=1000, index_interval=100)
+    for i in range(60):
+        sender, target = [('Max', '@Leo'), ('Leo', '@Max'), ('Max', '#group'), ('Ann', '@Leo')][i % 4]
+        log.append(sender, target, b'message %d' % i, timestamp=1500000000.0 + i)
+    key = conversation('Leo', '@Max')
+    # переписка пользователей - сообщения в обоих направлениях
+    assert [record.payload for record in log.history(key, limit=3)] == [b'message 53', b'message 56', b'message 57']
+    page = log.history(key, before=log.history(key, limit=3)[0].seq, limit=2)
+    assert [record.payload for record in page] == [b'message 49', b'message 52']
+    assert [record.target for record in log.history(conversation('Ann', '#group'))] == ['#group'] * 15
+    assert log.history(conversation('Ann', '@Max')) == []
+    # курсор ведет по журналам нескольких процессов-обработчиков, второй журнал читается только для чтения
+    other = MessageLog(str(tmp_path / 'worker-1'))
+    other.append('Max', '@Leo', b'other', timestamp=1500000030.5)
+    other.close()
+    logs = {'worker-0': log, 'worker-1': MessageLog(str(tmp_path / 'worker-1'), readonly=True)}
+    pages = []
+    cursor = None
+    while True:
+        records, next_cursor = read_history(logs, key, cursor, limit=7)
+        pages.append([record.payload for record in records])
+        if not next_cursor:
+            break
+        cursor = parse_cursor(format_cursor(next_cursor))
+    assert pages[0][-1] == b'message 57' and len(pages[0]) == 7
+    history = [payload for page in reversed(pages) for payload in page]
+    assert history[:3] == [b'message 0', b'message 1', b'message 4']
+    assert len(history) == 31 and b'other' in history
+    log.close()
+    # индекс переписок журнала, записанного без них, строится при открытии
+    for path in (tmp_path / 'worker-0' / 'conversations').iterdir():
+        path.unlink()
+    (tmp_path / 'worker-0' / 'conversations').rmdir()
+    log = MessageLog(str(tmp_path / 'worker-0'), segment_size=1000, index_interval=100)
+    assert len(log.history(key, limit=100)) == 30
+    log.close()
@@ -0,0 +1,69 @@
+import glob
+import os
+import subprocess
+import sys
+from .server_pending import PendingStore
+
+
+def test_put_claim(tmp_path):
+    store = PendingStore(str(tmp_path), limit=100)
+    assert store.claim('Leo') is None
+    for i in range(5):
+        assert store.put('Leo', b'message %d' % i)
+    # очередь переполнена: сообщение не добавляется
+    assert not store.put('Leo', b'x' * 100)
+    reader = store.claim('Leo')
+    # после того как очередь забрана, новые сообщения пишутся в новый файл
+    assert store.put('Leo', b'new')
+    assert reader.read(2) == [b'message 0', b'message 1']
+    assert reader.read(10) == [b'message 2', b'message 3', b'message 4']
+    assert reader.done
+    assert store.claim('Leo').read(10) == [b'new']
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_resume(tmp_path):
+    store = PendingStore(str(tmp_path))
+    for i in range(5):
+        store.put('Лев', b'message %d' % i)
+    reader = store.claim('Лев')
+    assert reader.read(2) == [b'message 0', b'message 1']
+    # клиент отключился: неотправленная часть отправляется при следующем подключении
+    reader.close()
+    store.put('Лев', b'new')
+    reader = store.claim('Лев')
+    assert reader.read(10) == [b'message 2', b'message 3', b'message 4', b'new']
+    assert reader.done
+
+
+def test_claimed_twice(tmp_path):
+    store = PendingStore(str(tmp_path))
+    for i in range(5):
+        store.put('Leo', b'message %d' % i)
+    first = store.claim('Leo')
+    assert first.read(2) == [b'message 0', b'message 1']
+    # очередь забирается еще раз (другим процессом): файл, который читает первый читатель, не забирается
+    store.put('Leo', b'new')
+    second = store.claim('Leo')
+    assert second.read(10) == [b'new']
+    assert store.claim('Leo') is None
+    assert first.read(10) == [b'message 2', b'message 3', b'message 4']
+    assert first.done
+    first.close()
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_dead_reader(tmp_path):
+    store = PendingStore(str(tmp_path))
+    for i in range(5):
+        store.put('Leo', b'message %d' % i)
+    reader = store.claim('Leo')
+    assert reader.read(2) == [b'message 0', b'message 1']
+    reader.close()
+    # процесс, забравший файл, завершился аварийно: файл забирается заново с сохраненного смещения
+    process = subprocess.Popen([sys.executable, '-c', ''])
+    process.wait()
+    path, = glob.glob(os.path.join(str(tmp_path), '*.claimed'))
+    os.rename(path, '{}.{}.reading'.format(path.rsplit('.', 1)[0], process.pid))
+    os.rename(path + '.pos', '{}.{}.reading.pos'.format(path.rsplit('.', 1)[0], process.pid))
+    assert store.claim('Leo').read(10) == [b'message 2', b'message 3', b'message 4']
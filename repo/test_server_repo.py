@@ -2,7 +2,7 @@ from pytest import raises
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from .server_models import Base, Client, ClientContact
-from .server_repo import Repo
+from .server_repo import Repo, LogonWriter
 from .server_errors import ContactDoesNotExist
 
 
@@ -73,6 +73,21 @@ class TestRepo:
         self.repo.add_client('New')
         assert self.repo.client_exists('New')
 
+    def test_client_id_cache(self):
+        repo = Repo(self.session, cache_size=2)
+        # первое обращение - запрос к БД, повторное - из кеша
+        assert repo.get_client_id('Leo') == 2
+        assert repo.get_client_id('Leo') == 2
+        assert (repo.client_ids.hits, repo.client_ids.misses) == (1, 1)
+        # отсутствие клиента не кешируется
+        assert repo.get_client_id('None') is None
+        assert 'None' not in repo.client_ids.items
+        # новый клиент попадает в кеш при добавлении, а давно не использованный вытесняется
+        repo.get_client_id('Max')
+        repo.add_client('New')
+        assert list(repo.client_ids.items) == ['Max', 'New']
+        assert repo.client_exists('New')
+
     def test_get_contacts(self):
         # возьмем контакты Kate
         contacts = self.repo.get_contacts('Kate')
@@ -87,6 +102,9 @@ class TestRepo:
         # контакты неизвестного человека
         contacts = self.repo.get_contacts('None')
         assert [] == contacts
+        # только имена, в порядке добавления
+        assert self.repo.get_contact_names('Max') == ['Leo', 'Kate']
+        assert self.repo.get_contact_names('None') == []
 
     def test_add_del_contact(self):
         # создадим нового пользователя
@@ -108,6 +126,69 @@ class TestRepo:
         # что будет если добавить контакт клиенту которого нет в базе?
         # такое поведение не должно быть возможно впринципе, поэтому проверять пока не будем
 
+    def test_bulk(self):
+        # маленькие части и транзакции, чтобы проверить переходы между ними
+        counts = self.repo.add_clients_bulk([('Max', None), ('Ann', 'info'), ('Bob', None), ('Ann', None)],
+                                            chunk_size=2, commit_size=2)
+        assert counts == {'added': 2, 'exists': 2}
+        assert self.repo.client_exists('Bob')
+        counts = self.repo.add_contacts_bulk([('Ann', 'Bob'), ('Max', 'Leo'), ('Ann', 'Bob'), ('Ann', 'None')],
+                                             chunk_size=3, commit_size=3)
+        assert counts == {'added': 1, 'exists': 2, 'unknown': 1}
+        assert self.repo.get_contact_names('Ann') == ['Bob']
+        counts = self.repo.del_contacts_bulk(iter([('Max', 'Leo'), ('Ann', 'Max'), ('None', 'Max')]))
+        assert counts == {'deleted': 1, 'absent': 1, 'unknown': 1}
+        assert self.repo.get_contact_names('Max') == ['Kate']
+
+    def test_contact_changes(self):
+        # начальный список - версия 0
+        assert self.repo.get_contact_list('Max') == (['Leo', 'Kate'], 0)
+        self.repo.add_client('New')
+        self.repo.del_contact('Max', 'Leo')
+        self.repo.add_contact('Max', 'New')
+        self.repo.add_contact('Max', 'Leo')
+        self.repo.del_contact('Max', 'New')
+        assert self.repo.get_contact_list('Max') == (['Kate', 'Leo'], 4)
+        # контакт, добавленный и удаленный после версии клиента, не отправляется
+        assert self.repo.get_contact_changes('Max', 0) == (4, [], [])
+        assert self.repo.get_contact_changes('Max', 1) == (4, ['Leo'], [])
+        assert self.repo.get_contact_changes('Max', 2) == (4, ['Leo'], ['New'])
+        assert self.repo.get_contact_changes('Max', 4) == (4, [], [])
+        # неизвестная версия и массовое изменение - нужен полный список
+        assert self.repo.get_contact_changes('Max', 5) is None
+        self.repo.del_contacts_bulk([('Max', 'Kate')])
+        assert self.repo.get_contact_list('Max') == (['Leo'], 5)
+        assert self.repo.get_contact_version('Max') == 5
+        assert self.repo.get_contact_version('None') == 0
+        assert self.repo.get_contact_changes('Max', 4) is None
+        assert self.repo.get_contact_changes('None', 0) is None
+
+    def test_join_leave_group(self):
+        # в группе может быть несколько участников, повторное вступление ничего не меняет
+        self.repo.join_group('Max', 'python')
+        self.repo.join_group('Leo', 'python')
+        self.repo.join_group('Max', 'python')
+        self.repo.join_group('Max', 'music')
+        assert sorted(self.repo.get_groups('Max')) == ['music', 'python']
+        assert self.repo.get_groups('Leo') == ['python']
+        self.repo.leave_group('Max', 'python')
+        assert self.repo.get_groups('Max') == ['music']
+        assert self.repo.get_groups('Kate') == []
+        with raises(ContactDoesNotExist):
+            self.repo.join_group('None', 'python')
+
+
+    def test_logon_writer(self):
+        # записи о входах копятся в очереди и пишутся в БД одной пачкой при закрытии хранилища
+        # (поток записи не запускаем, чтобы проверить запись оставшихся в очереди записей)
+        repo = Repo(self.session, logon_writer=LogonWriter(self.session))
+        repo.add_logon('Max', '127.0.0.1')
+        repo.add_logon('Leo', '127.0.0.2')
+        repo.add_logon('None', '127.0.0.3')
+        assert repo.get_logon_history('Max') == {}
+        repo.close()
+        assert list(repo.get_logon_history('Max').values()) == ['127.0.0.1']
+        assert list(repo.get_logon_history('Leo').values()) == ['127.0.0.2']
 
     def teardown(self):
         # не забываем удалить тестовые объекты и откатить измененея
@@ -3,26 +3,97 @@
 # 2) читает запросы клиентов-писалетей на запись в чат,
 # 3) отправляет клиентам-получателям сообщения клиентов-писателей.
 #
-# Параметры командной строки для запуска: server.py -p <port> -a <host>
+# Параметры командной строки для запуска: server.py -p <port> -a <host> [-m select|reactor|async]
+#                                          [--high-water <bytes>] [--low-water <bytes>] [--slow-policy drop|disconnect|pause]
+#                                          [--workers <N>] [--db-workers <N>]
+#                                          [--storage default|wal] [--storage-config <file.json>] [--msglog <dir>]
+#                                          [--pending <dir>]
 
 from os import path
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from glob import glob
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import NullPool, QueuePool
+from sqlalchemy.orm import sessionmaker, scoped_session
 import logging
 import log_config
 import argparse
-from socket import socket, AF_INET, SOCK_STREAM
+from socket import socket, socketpair, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEPORT, IPPROTO_TCP, TCP_NODELAY
 import select
-from jim.config import JIMResponse, JIMMsg
+import selectors
+from jim.config import JIMLiteMsg, response_bytes, history_bytes
+from jim.utils import FrameDecoder, InvalidMessage, pack_frame, decode_message, compile_validator, BUFFER_SIZE
 import json
-from repo.server_models import Client, ClientContact, Base
-from repo.server_repo import Repo
+from repo.server_repo import Repo, LogonWriter
+from repo.server_migrations import migrate
+from repo.server_msglog import MessageLog, conversation, read_history, parse_cursor, format_cursor
+from repo.server_pending import PendingStore
 from repo.server_errors import ContactDoesNotExist
 import time
+import signal
+import heapq
+from itertools import count, islice
+from collections import deque, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 
 # Получаем ссылку на объект getLogger('server')
 logger = logging.getLogger('server')
 
+# Состояния подключения клиента (процедура подключения: presence -> get_contacts -> работа в чате)
+STATE_PRESENCE = 'presence' # ожидается presence-сообщение
+STATE_CONTACTS = 'contacts' # ожидается запрос get_contacts
+STATE_READY = 'ready' # процедура подключения завершена
+
+# Задержка отправки списка контактов клиенту без кадрирования (чтобы ответ 202 и список контактов не склеились)
+CONTACTS_DELAY = 0.1
+
+# Ограничения очереди исходящих сообщений клиента, байт
+HIGH_WATER = 256 * 1024 # верхняя граница: при ее превышении применяется политика для медленного клиента
+LOW_WATER = 64 * 1024 # нижняя граница: после опустошения очереди до нее приостановленные отправители возобновляются
+# Политики для медленного клиента (очередь которого превысила верхнюю границу)
+POLICY_DROP = 'drop' # отбросить самые старые неотправленные сообщения
+POLICY_DISCONNECT = 'disconnect' # отключить клиента
+POLICY_PAUSE = 'pause' # приостановить чтение запросов отправителя, пока очередь не опустеет до нижней границы
+SLOW_POLICIES = (POLICY_DROP, POLICY_DISCONNECT, POLICY_PAUSE)
+# Максимальное количество буферов в одном вызове sendmsg (IOV_MAX в Linux)
+IOV_MAX = 1024
+# Количество потоков пула, выполняющих запросы к БД
+DB_WORKERS = 4
+# Максимальное количество пользователей, сериализованные списки контактов которых хранятся в кеше
+CONTACT_CACHE_SIZE = 10000
+
+# Профили хранилища: настройки подключений к SQLite (PRAGMA) и размер пула подключений
+# (pool_size: 0 - подключение открывается для каждой сессии, None - по одному на каждый поток, работающий с БД)
+STORAGE_PROFILES = {
+    # Настройки SQLite по умолчанию: журнал отката (пока идет запись, чтение ждет) и fsync при каждой фиксации
+    'default': {'pool_size': 0},
+    # Журнал WAL: чтение не ждет записи, а fsync выполняется только при переносе журнала в базу
+    # (при сбое питания могут потеряться последние транзакции, но база остается целостной)
+    'wal': {'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'cache_size': -16000, 'mmap_size': 256 * 1024 * 1024,
+            'busy_timeout': 5000, 'pool_size': None},
+}
+STORAGE_PROFILE = 'wal'
+STORAGE_PRAGMAS = ('journal_mode', 'synchronous', 'cache_size', 'mmap_size', 'busy_timeout')
+# Каталог журнала сообщений (относительно каталога сервера)
+MSGLOG_DIR = 'repo/msglog'
+# Количество сообщений на странице истории по умолчанию и максимальное (get_history)
+HISTORY_PAGE = 50
+HISTORY_MAX_PAGE = 500
+# Каталог очередей сообщений для неподключенных пользователей (относительно каталога сервера)
+PENDING_DIR = 'repo/pending'
+# Максимальное количество сообщений из очереди, отправляемых клиенту с кадрированием за одну итерацию цикла
+# (клиенту без кадрирования сообщения из очереди отправляются по одному раз в CONTACTS_DELAY)
+FORWARD_BATCH = 100
+# Максимальное время ожидания событий, пока клиентам отправляются сообщения из очередей, с
+FORWARD_INTERVAL = 0.01
+# Длина очереди входящих подключений слушающего сокета (при массовом входе клиентов подключения
+# ждут в ней, пока цикл их не примет)
+BACKLOG = 1024
+
+# Реестр действий JIM-протокола: action -> (обработчик, функция проверки запроса, состояния подключения,
+# в которых действие допустимо, обрабатывается ли запрос отложенно функцией write_responses).
+# Заполняется декоратором action, поэтому разбор запроса - один поиск в словаре независимо от количества действий
+ACTIONS = {}
+
 def log(func):
     """ Декорирует функцию func для логгирования ее имени и аргументов согласно настройкам объекта logger.
 
@@ -35,53 +106,408 @@ def log(func):
     return decorated
 
 
+def action(name, schema, optional=None, states=(STATE_READY,), deferred=True):
+    """ Регистрирует метод сервера как обработчик действия name в реестре ACTIONS.
+    Обработчик вызывается с аргументами (сервер, сокет клиента, словарь запроса, список клиентов-читателей).
+
+    :param name: значение поля action
+    :param schema: обязательные поля запроса (см. jim.utils.compile_validator)
+    :param optional: необязательные поля запроса
+    :param states: состояния подключения клиента, в которых допустимо действие
+    :param deferred: запрос обрабатывается функцией write_responses (иначе сразу функцией process_request)
+    :return: декоратор
+    """
+    validator = compile_validator(schema, optional)
+
+    def register(handler):
+        ACTIONS[name] = (handler, validator, frozenset(states), deferred)
+        return handler
+    return register
+
+
 @log
 def create_parser():
-    """ Возвращает парсер двух аргуметов командной строки: порт и IP-адрес.
-    Оба аргумента необязательные (по умолчанию порт задается как 7777, IP-адреса прослушиваются все).
+    """ Возвращает парсер аргуметов командной строки: порт, IP-адрес, режим работы основного цикла,
+    границы очереди исходящих сообщений клиента, политика для медленного клиента и количество процессов-обработчиков.
+    Все аргументы необязательные (по умолчанию порт задается как 7777, IP-адреса прослушиваются все,
+    режим работы - select). В режиме async сервер работает на asyncio (см. async_server.py).
+    При количестве процессов-обработчиков больше 1 сервер запускается в режиме кластера (см. cluster.py).
+    Запросы к БД выполняются в пуле из --db-workers потоков. Профиль хранилища (--storage, по умолчанию wal)
+    можно дополнить настройками из JSON-файла --storage-config (см. STORAGE_PROFILES).
+    Сообщения записываются в журнал в каталоге --msglog (пустая строка - без журнала).
+    Личные сообщения неподключенным пользователям сохраняются в очередях в каталоге --pending
+    (пустая строка - сообщения не сохраняются).
 
     Следующий тест сработает, если в командной строке ничего не передавать.
     >>> create_parser().parse_args()
-    Namespace(a='', p='7777')
+    Namespace(p='7777', a='', m='select', high_water=262144, low_water=65536, slow_policy='disconnect', workers=1, db_workers=4, storage='wal', storage_config=None, msglog='repo/msglog', pending='repo/pending')
 
-    :return: парсер двух аргументов (адрес - обязательный, порт - необязательный)
+    :return: парсер аргументов
     """
     parser = argparse.ArgumentParser()
     parser.add_argument('-p', default='7777')
     parser.add_argument('-a', default='')
+    parser.add_argument('-m', default='select', choices=['select', 'reactor', 'async'])
+    parser.add_argument('--high-water', type=int, default=HIGH_WATER)
+    parser.add_argument('--low-water', type=int, default=LOW_WATER)
+    parser.add_argument('--slow-policy', default=POLICY_DISCONNECT, choices=SLOW_POLICIES)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--db-workers', type=int, default=DB_WORKERS)
+    parser.add_argument('--storage', default=STORAGE_PROFILE, choices=list(STORAGE_PROFILES))
+    parser.add_argument('--storage-config', default=None)
+    parser.add_argument('--msglog', default=MSGLOG_DIR)
+    parser.add_argument('--pending', default=PENDING_DIR)
     return parser
 
 
+def load_storage_profile(name=STORAGE_PROFILE, config=None):
+    """ Возвращает настройки профиля хранилища, дополненные настройками из JSON-файла
+    (например, {"synchronous": "FULL", "pool_size": 8}).
+
+    >>> load_storage_profile('default')
+    {'pool_size': 0}
+
+    :param name: имя профиля (см. STORAGE_PROFILES)
+    :param config: путь к JSON-файлу с настройками или None
+    :return: словарь настроек
+    """
+    storage = dict(STORAGE_PROFILES[name])
+    if config:
+        with open(config, encoding='utf-8') as f:
+            storage.update(json.load(f))
+    for key, value in storage.items():
+        if key not in STORAGE_PRAGMAS and key != 'pool_size':
+            raise ValueError('Неизвестная настройка хранилища: {}'.format(key))
+        # Значения подставляются в текст PRAGMA, поэтому допускаются только числа и слова
+        if not (value is None or isinstance(value, int) or str(value).isalnum()):
+            raise ValueError('Недопустимое значение настройки хранилища {}: {!r}'.format(key, value))
+    return storage
+
+
+def create_db_engine(storage=None, threads=1, db_path=None):
+    """ Создает движок базы данных сервера и структуру базы данных (если ее еще нет)
+    или обновляет структуру существующей базы (см. repo.server_migrations).
+
+    :param storage: настройки хранилища (см. load_storage_profile), None - настройки SQLite по умолчанию
+    :param threads: количество потоков, работающих с БД (размер пула подключений, если он не задан)
+    :param db_path: путь к файлу базы данных (по умолчанию repo/server.db)
+    :return: движок базы данных
+    """
+    # Путь до папки где лежит этот модуль
+    SERVER_PATH = path.dirname(path.abspath(__file__))
+    # Путь до файла базы данных
+    DB_PATH = db_path or path.join(SERVER_PATH, 'repo/server.db')
+    # Создаем движок
+    storage = STORAGE_PROFILES['default'] if storage is None else storage
+    if storage.get('pool_size') == 0:
+        engine = create_engine('sqlite:///{}'.format(DB_PATH), echo=False, poolclass=NullPool)
+    else:
+        # Подключение из пула используется разными потоками, но только одним потоком одновременно
+        engine = create_engine('sqlite:///{}'.format(DB_PATH), echo=False, poolclass=QueuePool,
+                               pool_size=storage.get('pool_size') or threads,
+                               connect_args={'check_same_thread': False})
+    pragmas = [(key, storage[key]) for key in STORAGE_PRAGMAS if storage.get(key) is not None]
+    if pragmas:
+        @event.listens_for(engine, 'connect')
+        def set_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for key, value in pragmas:
+                cursor.execute('PRAGMA {} = {}'.format(key, value))
+            cursor.close()
+    # Создаем структуру базы данных или применяем к ней недостающие миграции
+    migrate(engine)
+    return engine
+
+
+class OutQueue:
+    """ Очередь исходящих сообщений клиента.
+    Сообщения хранятся целиком (в виде готовых к отправке байтов), поэтому при переполнении
+    можно отбросить самые старые из них, не разрезав сообщение посередине.
+    """
+
+    def __init__(self):
+        self.messages = deque() # неотправленные сообщения
+        self.offset = 0 # количество уже отправленных байтов первого сообщения
+        self.size = 0 # количество неотправленных байтов
+        self.paused_senders = set() # отправители, приостановленные из-за переполнения этой очереди
+        self.pushed = 0 # количество байтов, поставленных в очередь за все время
+        self.consumed = 0 # количество байтов, покинувших очередь (отправленных или отброшенных) за все время
+        self.waiters = deque() # (значение consumed, функция) - функции, ждущие отправки поставленных в очередь байтов
+
+    def __bool__(self):
+        return self.size > 0
+
+    def push(self, data):
+        """ Добавляет сообщение в конец очереди
+
+        :param data: байты сообщения
+        :return: None
+        """
+        self.messages.append(data)
+        self.size += len(data)
+        self.pushed += len(data)
+
+    def on_sent(self, done):
+        """ Запоминает функцию, которую нужно вызвать, когда все сообщения, находящиеся сейчас в очереди,
+        покинут ее (см. pop_sent)
+
+        :param done: функция без аргументов
+        :return: None
+        """
+        self.waiters.append((self.pushed, done))
+
+    def pop_sent(self):
+        """ Возвращает функции, для которых все поставленные до них в очередь сообщения уже покинули очередь
+
+        :return: список функций
+        """
+        ready = []
+        while self.waiters and self.waiters[0][0] <= self.consumed:
+            ready.append(self.waiters.popleft()[1])
+        return ready
+
+    def drop_oldest(self, limit):
+        """ Отбрасывает самые старые сообщения, пока размер очереди больше limit.
+        Частично отправленное первое сообщение не отбрасывается (иначе клиент получит обрывок).
+
+        :param limit: допустимый размер очереди, байт
+        :return: количество отброшенных сообщений
+        """
+        head = None
+        if self.offset:
+            head = self.messages.popleft()
+        dropped = 0
+        while self.messages and self.size > limit:
+            size = len(self.messages.popleft())
+            self.size -= size
+            self.consumed += size
+            dropped += 1
+        if head is not None:
+            self.messages.appendleft(head)
+        return dropped
+
+    def send(self, sock):
+        """ Отправляет в неблокирующий сокет столько данных из очереди, сколько он готов принять.
+        Все накопленные сообщения отправляются одним вызовом sendmsg (по IOV_MAX сообщений за вызов),
+        без склеивания их в один буфер.
+
+        :param sock: сокет клиента
+        :return: количество отправленных байтов
+        """
+        total = 0
+        while self.messages:
+            buffers = [memoryview(self.messages[0])[self.offset:]]
+            buffers.extend(islice(self.messages, 1, IOV_MAX))
+            size = sum(len(buffer) for buffer in buffers)
+            try:
+                if hasattr(sock, 'sendmsg'):
+                    sent = sock.sendmsg(buffers)
+                else:
+                    sent = sock.send(b''.join(buffers))  # нет sendmsg (Windows)
+            except BlockingIOError:
+                break
+            total += sent
+            self.advance(sent)
+            if sent < size:
+                break  # буфер сокета заполнен
+        return total
+
+    def advance(self, sent):
+        """ Удаляет из очереди отправленные байты
+
+        :param sent: количество отправленных байтов
+        :return: None
+        """
+        self.size -= sent
+        self.consumed += sent
+        sent += self.offset
+        while self.messages and sent >= len(self.messages[0]):
+            sent -= len(self.messages.popleft())
+        self.offset = sent
+
+
 class MsgTCPServer():
     @log
-    def __init__(self, address):
+    def __init__(self, address, high_water=HIGH_WATER, low_water=LOW_WATER, slow_policy=POLICY_DISCONNECT,
+                 reuse_port=False, db_workers=DB_WORKERS, storage=None, msglog=None, pending=None):
         self.s = socket(AF_INET, SOCK_STREAM)
+        if reuse_port:
+            # Несколько процессов-обработчиков слушают один порт, ядро распределяет между ними подключения
+            self.s.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
         self.s.bind(address)
-        self.s.listen(5)
+        self.s.listen(BACKLOG)
         self.s.settimeout(0.2)
         self.clients = {} # словарь сокет-username клиентов, подключенных к чату
+        self.users = {} # словарь username-множество сокетов клиента (индекс для доставки личных сообщений)
+        self.groups = {} # словарь группа-множество сокетов подключенных участников (индекс для доставки в группу)
+        self.memberships = {} # словарь сокет-множество групп, в которых состоит клиент
+        self.contact_lists = OrderedDict() # кеш username-(количество контактов, шаблон contact_list, версия списка), LRU
+        self.contact_version = 0 # счетчик изменений списков контактов (см. send_contacts)
         self.dwh = None # объект хранилища (инициализируется в процессе работы метода create_db_session)
+        self.db_workers = db_workers # количество потоков пула запросов к БД
+        self.storage = storage # настройки хранилища (см. load_storage_profile)
+        self.msglog_path = msglog # каталог журнала сообщений (None - сообщения не записываются)
+        self.msglog = None # журнал сообщений (MessageLog, открывается методом create_db_session)
+        self.history_readers = {} # словарь имя-журнал других процессов-обработчиков, открытый для чтения истории
+        self.pending = PendingStore(pending) if pending else None # очереди сообщений неподключенных пользователей
+        self.forwarding = {} # словарь сокет-(PendingReader, время следующей отправки) клиентов, получающих очередь
+        self.claims = {} # словарь username-сокет, которому отправляется забранная очередь пользователя
+        self.remote_users = {} # словарь username-множество номеров других процессов-обработчиков, к которым подключен пользователь
+        self.db_pool = None # пул потоков запросов к БД (None - запросы выполняются в потоке цикла)
+        self.db_done = deque() # завершенные запросы к БД (сокет, future, функция обработки результата)
+        self.wakeup = None # пара сокетов, через которую потоки пула будят цикл по завершении запроса
+        self.running = True # основной цикл работает, пока не вызван метод stop
+        self.selector = None # селектор режима reactor (инициализируется в процессе работы метода reactor_loop)
+        self.outbox = {} # словарь сокет-очередь исходящих сообщений (OutQueue)
+        self.high_water = high_water # верхняя граница очереди исходящих сообщений клиента, байт
+        self.low_water = low_water # нижняя граница очереди исходящих сообщений клиента, байт
+        self.slow_policy = slow_policy # политика для медленного клиента (POLICY_DROP, POLICY_DISCONNECT, POLICY_PAUSE)
+        self.paused = {} # словарь сокет-количество причин (переполненных очередей и запросов к БД), из-за которых приостановлено чтение клиента
+        self.bus = None # шина рассылки сообщений между процессами-обработчиками (только в режиме кластера, см. cluster.py)
+        self.decoders = {} # словарь сокет-декодер кадров (None - клиент работает без кадрирования)
+        self.scratch = memoryview(bytearray(BUFFER_SIZE)) # общий буфер приема запросов клиентов без кадрирования
+        self.backlog = set() # сокеты, в декодерах которых остались полученные, но еще не обработанные запросы
+        self.states = {} # словарь сокет-состояние подключения клиента (STATE_PRESENCE, STATE_CONTACTS, STATE_READY)
+        self.timers = [] # куча отложенных отправок (время, номер, сокет, байты, функция после отправки)
+        self.timer_seq = count() # номера отложенных отправок (для упорядочивания отправок с одинаковым временем)
 
     def create_db_session(self):
-        """ Создает сессию подключения к базе данных
+        """ Создает сессию подключения к базе данных и пул потоков, выполняющих запросы к ней.
+        Сессия привязана к потоку (scoped_session): хранилище self.dwh общее, но каждый поток пула
+        работает со своей сессией и своим соединением с БД. История входов пишется в БД пачками
+        отдельным потоком (см. repo.server_repo.LogonWriter).
 
         :return:
         """
-        # Путь до папки где лежит этот модуль
-        SERVER_PATH = path.dirname(path.abspath(__file__))
-        # Путь до файла базы данных
-        DB_PATH = path.join(SERVER_PATH, 'repo/server.db')
-        # Создаем движок
-        engine = create_engine('sqlite:///{}'.format(DB_PATH), echo=False)
-        # Создаем структуру базы данных
-        Base.metadata.create_all(engine)
+        # С БД работают потоки пула, поток записи истории входов и поток основного цикла
+        engine = create_db_engine(self.storage, threads=self.db_workers + 2)
         # Создаем сессию для работы
-        Session = sessionmaker(bind=engine)
-        session = Session()
+        Session = scoped_session(sessionmaker(bind=engine))
+
+        logon_writer = LogonWriter(Session)
+        logon_writer.start()
+        self.dwh = Repo(Session, logon_writer=logon_writer)
+        self.db_pool = ThreadPoolExecutor(max_workers=self.db_workers, thread_name_prefix='db')
+        if self.msglog_path:
+            self.msglog = MessageLog(self.msglog_path)
+        self.wakeup = socketpair()
+        for sock in self.wakeup:
+            sock.setblocking(False)
 
-        self.dwh = Repo(session)
+        return Session
 
-        return session
+    def close_db_session(self):
+        """ Дожидается выполнения запросов к БД и записывает отложенные данные (при остановке сервера).
+
+        :return: None
+        """
+        if self.db_pool is not None:
+            self.db_pool.shutdown(wait=True)
+        if self.dwh is not None:
+            self.dwh.close()
+        if self.msglog is not None:
+            self.msglog.close()
+        for reader in self.history_readers.values():
+            reader.close()
+
+    def db_call(self, sock, job, done):
+        """ Выполняет запрос к БД job(хранилище) в пуле потоков, не блокируя основной цикл.
+        Результат передается функции done в потоке основного цикла (см. run_db_callbacks),
+        а при ошибке клиенту отправляется ответ 500. Пока запрос выполняется, чтение запросов клиента
+        приостановлено: ответы клиенту идут в порядке его запросов, и у каждого клиента в пуле
+        не больше одного запроса (очередь пула ограничена количеством клиентов).
+        Без пула (до запуска основного цикла) запрос выполняется сразу.
+
+        :param sock: сокет клиента
+        :param job: функция, выполняющая запрос к хранилищу (вызывается в потоке пула)
+        :param done: функция обработки результата запроса
+        :return: None
+        """
+        if self.db_pool is None:
+            future = Future()
+            try:
+                future.set_result(job(self.dwh))
+            except Exception as e:
+                future.set_exception(e)
+            self.db_finish(sock, future, done)
+            return
+        self.suspend(sock)
+        future = self.db_pool.submit(self.run_db_job, job)
+        future.add_done_callback(lambda future: self.db_completed(sock, future, done))
+
+    def run_db_job(self, job):
+        """ Выполняет запрос к БД в потоке пула и закрывает сессию потока, чтобы соединение с БД
+        не оставалось занятым (и не закрывалось потом из другого потока).
+
+        :param job: функция, выполняющая запрос к хранилищу
+        :return: результат запроса
+        """
+        try:
+            return job(self.dwh)
+        finally:
+            self.dwh.session.close()
+
+    def db_completed(self, sock, future, done):
+        """ Передает завершенный запрос к БД в основной цикл (вызывается в потоке пула).
+
+        :param sock: сокет клиента
+        :param future: future запроса
+        :param done: функция обработки результата запроса
+        :return: None
+        """
+        self.db_done.append((sock, future, done))
+        try:
+            self.wakeup[1].send(b'\0')
+        except BlockingIOError:
+            pass  # в сокете уже есть непрочитанные байты, цикл и так проснется
+
+    def run_db_callbacks(self):
+        """ Обрабатывает результаты завершенных запросов к БД и возобновляет чтение запросов их клиентов.
+
+        :return: None
+        """
+        if self.wakeup is None:
+            return
+        try:
+            while self.wakeup[0].recv(BUFFER_SIZE):
+                pass
+        except BlockingIOError:
+            pass
+        while self.db_done:
+            sock, future, done = self.db_done.popleft()
+            self.unsuspend(sock)
+            self.db_finish(sock, future, done)
+
+    def stop(self):
+        """ Просит основной цикл завершиться после текущей итерации (безопасно вызывать из обработчика сигнала:
+        в отличие от исключения, прерывающего цикл в произвольном месте, не оставляет захваченными блокировки пула).
+
+        :return: None
+        """
+        self.running = False
+        if self.wakeup is not None:
+            try:
+                self.wakeup[1].send(b'\0')  # будим цикл, спящий в select
+            except BlockingIOError:
+                pass
+
+    def db_finish(self, sock, future, done):
+        """ Передает результат запроса к БД функции done (или отвечает клиенту 500 при ошибке запроса).
+
+        :param sock: сокет клиента
+        :param future: future запроса
+        :param done: функция обработки результата запроса
+        :return: None
+        """
+        if sock not in self.clients:
+            return  # клиент отключился, пока выполнялся запрос
+        try:
+            result = future.result()
+        except Exception as e:
+            print('Ошибка запроса к БД клиента {}: {}'.format(self.clients.get(sock), e))
+            self.send_to(sock, response_bytes(500))
+            return
+        done(result)
 
     def read_requests(self, r_clients):
         """ Читает запросы клиентов-писателей на запись в чат и возвращает словарь {сокет: запрос}.
@@ -95,69 +521,923 @@ class MsgTCPServer():
 
         for sock in r_clients:
             try:
-                data = json.loads(sock.recv(1024).decode('utf-8'))
+                data = self.receive(sock)
                 #print(data)
-                if data == '':
-                    self.clients.pop(sock)
-                elif data['action'] == 'msg' or data['action'] == 'add_contact' or data['action'] == 'del_contact':
-                    responses[sock] = data
+                if data is None:
+                    pass  # запрос получен не полностью
+                elif data == '':
+                    self.disconnect(sock)
                 else:
-                    raise Exception('Сообщение должно иметь action "msg" или "add_contact"!')
+                    request = self.process_request(sock, data)
+                    if request:
+                        responses[sock] = request
+            except InvalidMessage as e:
+                self.reject(sock, e)
             except:
-                print('Клиент {} {} отключился'.format(sock.fileno(), sock.getpeername()))
-                self.clients.pop(sock)
+                print('Клиент {} {} отключился'.format(sock.fileno(), self.clients.get(sock)))
+                self.disconnect(sock)
 
         return responses
 
+    def receive(self, sock):
+        """ Читает из сокета очередной запрос клиента.
+        Для клиентов в framed-режиме байты читаются в буфер декодера кадров соединения;
+        за один вызов возвращается один запрос, а остальные полностью полученные запросы остаются в очереди декодера
+        (сокет при этом попадает в self.backlog и будет обработан на следующей итерации цикла без чтения из сокета).
+
+        :param sock: сокет клиента
+        :return: словарь запроса или None, если запрос получен не полностью
+        :raises InvalidMessage: полученные байты не являются JSON-объектом
+        """
+        decoder = self.decoders.get(sock)
+        if decoder is not None:
+            # Байты читаются сразу в буфер соединения (см. FrameDecoder.recv_into)
+            if not decoder.ready and not decoder.recv_into(sock):
+                raise ConnectionError('Соединение закрыто клиентом')
+        else:
+            # Запрос клиента без кадрирования (или первый запрос клиента) читается в общий буфер
+            # и разбирается сразу, поэтому отдельный буфер для каждого такого клиента не нужен
+            size = sock.recv_into(self.scratch)
+            if not size:
+                raise ConnectionError('Соединение закрыто клиентом')
+            data = self.scratch[:size]
+            decoder = self.get_decoder(sock, data)
+            if decoder is None:
+                return decode_message(data)
+            decoder.feed(data)
+        if not decoder.ready:
+            return None
+        try:
+            return decoder.pop()
+        finally:
+            if decoder.ready:
+                self.backlog.add(sock)
+            else:
+                self.backlog.discard(sock)
+
+    def get_decoder(self, sock, data):
+        """ Возвращает декодер кадров клиента или None, если клиент работает без кадрирования.
+        Режим определяется по первым полученным от клиента байтам: сообщение без кадрирования начинается с '{',
+        а заголовок кадра - с нулевого байта (см. jim.utils.MAX_FRAME_SIZE).
+
+        :param sock: сокет клиента
+        :param data: полученные от клиента байты
+        :return: FrameDecoder или None
+        """
+        if sock not in self.decoders:
+            self.decoders[sock] = None if data[:1] == b'{' else FrameDecoder()
+        return self.decoders[sock]
+
+    def frame(self, sock, data, framed=None):
+        """ Упаковывает отправляемые клиенту байты в кадр, если клиент работает в framed-режиме.
+
+        :param sock: сокет клиента
+        :param data: отправляемые байты
+        :param framed: уже упакованный в кадр data (при рассылке одного сообщения многим клиентам)
+        :return: байты для отправки в сокет
+        """
+        if self.decoders.get(sock) is not None:
+            return framed if framed is not None else pack_frame(data)
+        return data
+
+    def new_client(self, sock):
+        """ Добавляет в список клиентов только что подключившегося клиента.
+        Процедура подключения (presence, get_contacts) выполняется по мере поступления запросов клиента
+        без блокировки основного цикла.
+
+        :param sock: сокет клиента
+        :return: None
+        """
+        self.clients[sock] = ''
+        self.states[sock] = STATE_PRESENCE
+        self.outbox[sock] = OutQueue()
+
+    def process_request(self, sock, data):
+        """ Проверяет запрос клиента по реестру действий ACTIONS с учетом состояния его подключения
+        (процедура подключения: presence -> get_contacts или sync_contacts -> работа в чате) и обрабатывает его:
+        - presence, get_contacts и sync_contacts обрабатываются сразу
+        - остальные запросы (msg, add_contact, del_contact, join, leave, get_history) возвращаются для последующей обработки
+          функцией write_responses
+
+        :param sock: сокет клиента
+        :param data: словарь запроса
+        :return: словарь запроса для write_responses или None, если запрос уже обработан
+        :raises InvalidMessage: неизвестное или недопустимое в текущем состоянии действие, неверные поля запроса
+        """
+        try:
+            handler, validator, states, deferred = ACTIONS[data['action']]
+        except (KeyError, TypeError):
+            raise InvalidMessage('Недопустимое значение поля action')
+        if self.states[sock] not in states:
+            raise InvalidMessage('Действие {} недопустимо в состоянии подключения {}'.format(
+                data['action'], self.states[sock]))
+        validator(data)
+        if deferred:
+            return data
+        handler(self, sock, data, None)
+
+    def reject(self, sock, error):
+        """ Отвечает клиенту на недопустимый запрос ответом 400 (клиент остается подключенным).
+
+        :param sock: сокет клиента
+        :param error: исключение InvalidMessage
+        :return: None
+        """
+        print('Недопустимый запрос клиента {}: {}'.format(self.clients.get(sock), error))
+        self.send_to(sock, response_bytes(400))
+
+    def client_ip(self, sock):
+        """ Возвращает IP-адрес клиента
+
+        :param sock: сокет клиента
+        :return: IP-адрес
+        """
+        return sock.getpeername()[0]
+
     def write_responses(self, requests, w_clients):
-        """ Отправляет клиентам-читателям запросы клиентов-писателей.
-        Удаляет клиента из списка всех клиентов при отключении.
+        """ Обрабатывает отложенные запросы клиентов-писателей обработчиками из реестра ACTIONS
+        (сообщения в чат отправляются клиентам-читателям).
 
         :param requests: словарь с запросами клиентов-писателей
         :param w_clients: список клиентов-читателей
         :return: суммарная длина отправленных сообщений (нужно только для тестирования)
         """
         test_len = 0
-        for sock in requests:
-            if requests[sock]['action'] == 'add_contact':
+        for sock, request in requests.items():
+            # Клиент мог отключиться при обработке предыдущих запросов этой же итерации цикла
+            if sock in self.clients:
+                test_len += ACTIONS[request['action']][0](self, sock, request, w_clients) or 0
+        return test_len
+
+    @action('presence', {'user': {'account_name': str}}, states=(STATE_PRESENCE,), deferred=False)
+    def handle_presence(self, sock, request, w_clients):
+        """ Обрабатывает presence-сообщение, после ответа клиент должен запросить список контактов. """
+        self.presence(sock, request, self.client_ip(sock))
+
+    @action('get_contacts', {}, states=(STATE_CONTACTS, STATE_READY), deferred=False)
+    def handle_get_contacts(self, sock, request, w_clients):
+        """ Отправляет клиенту список контактов, после чего клиент может работать в чате. """
+        self.send_contacts(sock)
+
+    @action('sync_contacts', {'version': int}, states=(STATE_CONTACTS, STATE_READY), deferred=False)
+    def handle_sync_contacts(self, sock, request, w_clients):
+        """ Отправляет клиенту изменения списка контактов после версии его копии списка (или полный список). """
+        self.sync_contacts(sock, request['version'])
+
+    @action('add_contact', {'user': {'account_name': str}})
+    def handle_add_contact(self, sock, request, w_clients):
+        """ Добавляет контакт в список контактов клиента. """
+        username, contact = self.clients[sock], request['user']['account_name']
+
+        def done(result):
+            self.invalidate_contacts(username)
+            print(contact, 'added as a contact to contact list of', username)
+            self.send_to(sock, response_bytes(200))
+        self.db_call(sock, lambda repo: repo.add_contact(username, contact), done)
+
+    @action('del_contact', {'user': {'account_name': str}})
+    def handle_del_contact(self, sock, request, w_clients):
+        """ Удаляет контакт из списка контактов клиента. """
+        username, contact = self.clients[sock], request['user']['account_name']
+
+        def done(result):
+            self.invalidate_contacts(username)
+            print(contact, 'deleted from contact list of', username)
+            self.send_to(sock, response_bytes(200))
+        self.db_call(sock, lambda repo: repo.del_contact(username, contact), done)
+
+    @action('join', {'group': str})
+    def handle_join(self, sock, request, w_clients):
+        """ Добавляет клиента в группу (чат). """
+        username, group = self.clients[sock], request['group']
+
+        def done(result):
+            self.join(sock, group)
+            print(username, 'joined group', group)
+            self.send_to(sock, response_bytes(200))
+        self.db_call(sock, lambda repo: repo.join_group(username, group), done)
+
+    @action('leave', {'group': str})
+    def handle_leave(self, sock, request, w_clients):
+        """ Удаляет клиента из группы (чата). """
+        username, group = self.clients[sock], request['group']
+
+        def done(result):
+            self.leave(sock, group)
+            print(username, 'left group', group)
+            self.send_to(sock, response_bytes(200))
+        self.db_call(sock, lambda repo: repo.leave_group(username, group), done)
+
+    @action('msg', {'message': str}, optional={'to': str, 'group': str})
+    def handle_msg(self, sock, request, w_clients):
+        """ Отправляет сообщение адресату (to), участникам группы (group) или всем клиентам-читателям. """
+        test_len = 0
+        target = request.get('to')
+        group = request.get('group')
+        if group and group not in self.memberships.get(sock, ()):
+            # Писать в группу могут только ее участники
+            self.reject(sock, InvalidMessage('Клиент не состоит в группе {}'.format(group)))
+            return test_len
+        # Сообщение сериализуется (и упаковывается в кадр) один раз,
+        # все получатели ставят в очередь одни и те же неизменяемые байты
+        data = JIMLiteMsg(action='msg', login=self.clients[sock], message=request['message'],
+                          to=target, group=group).to_bytes()
+        try:
+            framed = pack_frame(data)
+        except ValueError as e:
+            # После сериализации (экранирования не-ASCII символов) сообщение может не поместиться в кадр
+            self.reject(sock, InvalidMessage(str(e)))
+            return test_len
+        if target:
+            # Личное сообщение доставляется только подключениям адресата (без перебора всех клиентов)
+            receivers = list(self.users.get(target, ()))
+            route = '@' + target
+            if self.keeps_pending(target, receivers):
+                self.store_pending(sock, target, data)
+        elif group:
+            # Сообщение в группу доставляется только подключенным участникам группы (без обращения к БД)
+            receivers = list(self.groups.get(group, ()))
+            route = '#' + group
+        else:
+            receivers = w_clients
+            route = ''
+        if self.msglog is not None:
+            # Запись попадает в буфер файла журнала, в файл буфер сбрасывается после обработки запросов
+            self.msglog.append(self.clients[sock], route, data)
+        for w_sock in receivers:
+            # Клиент мог отключиться при чтении запросов в этой же итерации цикла
+            # или еще не завершить процедуру подключения
+            if sock != w_sock and self.states.get(w_sock) == STATE_READY:
                 try:
-                    self.dwh.add_contact(self.clients[sock], requests[sock]['user']['account_name'])
-                    resp = JIMResponse(response_code=200).resp
-                    print(requests[sock]['user']['account_name'], 'added as a contact to contact list of', self.clients[sock])
-                    sock.send(json.dumps(resp).encode('utf-8'))
-                except Exception as e:
-                    resp = JIMResponse(response_code=500).resp
-                    sock.send(json.dumps(resp).encode('utf-8'))
-            elif requests[sock]['action'] == 'del_contact':
+                    test_len += len(data)
+                    #print(resp)
+                    self.send_to(w_sock, data, sender=sock, framed=framed)
+                except:
+                    print('Клиент {} {} отключился'.format(w_sock.fileno(), self.clients.get(w_sock)))
+                    self.disconnect(w_sock)
+        if self.bus is not None:
+            # Клиентам, подключенным к другим процессам-обработчикам, сообщение доставят эти процессы;
+            # адресат передается перед сообщением, чтобы им не приходилось разбирать json
+            self.bus.publish(route.encode('utf-8') + b'\n' + data)
+        return test_len
+
+    @action('get_history', {}, optional={'to': str, 'group': str, 'cursor': str, 'limit': int})
+    def handle_get_history(self, sock, request, w_clients):
+        """ Отправляет клиенту страницу истории личной переписки с пользователем (to), группы (group) или общего чата:
+        сообщение history с сообщениями страницы и курсором следующей (более старой) страницы. """
+        username = self.clients[sock]
+        target, group = request.get('to'), request.get('group')
+        if group and group not in self.memberships.get(sock, ()):
+            # Читать историю группы могут только ее участники
+            self.reject(sock, InvalidMessage('Клиент не состоит в группе {}'.format(group)))
+            return
+        try:
+            cursor = parse_cursor(request.get('cursor'))
+        except ValueError as e:
+            self.reject(sock, InvalidMessage(str(e)))
+            return
+        limit = min(max(request.get('limit') or HISTORY_PAGE, 1), HISTORY_MAX_PAGE)
+        route = '@' + target if target else '#' + group if group else ''
+        records, next_cursor = [], None
+        if self.msglog is not None:
+            records, next_cursor = read_history(self.history_logs(), conversation(username, route), cursor, limit)
+        self.send_to(sock, history_bytes([record.payload for record in records], format_cursor(next_cursor),
+                                         to=target, group=group))
+
+    def history_logs(self):
+        """ Возвращает журналы, из которых читается история: журнал этого процесса, а в режиме кластера -
+        и журналы остальных процессов-обработчиков (в том числе оставшиеся от прошлых запусков),
+        открытые только для чтения.
+
+        :return: словарь имя каталога журнала - журнал
+        """
+        logs = {path.basename(self.msglog_path): self.msglog}
+        if self.bus is not None:
+            for directory in glob(path.join(path.dirname(self.msglog_path), 'worker-*')):
+                name = path.basename(directory)
+                if name not in logs and name not in self.history_readers:
+                    self.history_readers[name] = MessageLog(directory, readonly=True)
+            logs.update(self.history_readers)
+        return logs
+
+    def deliver_remote(self, packet):
+        """ Доставляет подключенным к этому процессу клиентам сообщение, полученное по шине
+        от другого процесса-обработчика (режим кластера).
+
+        :param packet: байты адресата ('@' + username, '#' + группа или пусто для сообщения в чат;
+            '!' + username - уведомление об изменении списка контактов; '+' или '-' + username - пользователь
+            подключился к процессу-обработчику или отключился от него, '?' - процесс-обработчик запущен заново),
+            перевод строки и байты сообщения (номер процесса-обработчика для '+', '-' и '?')
+        :return: None
+        """
+        route, data = packet.split(b'\n', 1)
+        route = route.decode('utf-8')
+        if route.startswith('!'):
+            self.contact_version += 1
+            self.contact_lists.pop(route[1:], None)
+            return
+        if route and route[0] in '+-?':
+            self.update_remote_users(route, int(data))
+            return
+        if route.startswith('@'):
+            receivers = list(self.users.get(route[1:], ()))
+            if receivers and self.keeps_pending(route[1:], receivers):
+                # Адресат подключен к этому процессу, но еще не завершил процедуру подключения
+                # (пользователь подключен, поэтому его существование не проверяется)
+                if not self.pending.put(route[1:], data):
+                    print('Очередь сообщений пользователя {} переполнена, сообщение отброшено'.format(route[1:]))
+                return
+        elif route.startswith('#'):
+            receivers = list(self.groups.get(route[1:], ()))
+        else:
+            receivers = list(self.clients)
+        framed = pack_frame(data)
+        for w_sock in receivers:
+            if self.states.get(w_sock) == STATE_READY:
+                self.send_to(w_sock, data, framed=framed)
+
+    def keeps_pending(self, username, receivers):
+        """ Проверяет, должен ли этот процесс сохранить личное сообщение в очереди адресата: ни одно подключение
+        адресата к этому процессу не готово принимать сообщения, а в режиме кластера сообщение сохраняет только
+        один процесс - процесс с наименьшим номером среди тех, к которым подключен адресат (если адресат не подключен
+        ни к одному процессу, сообщение сохраняет процесс отправителя). Сообщение, отправленное адресату во время
+        процедуры подключения, отправляется ему из очереди, когда он будет готов.
+
+        :param username: имя адресата
+        :param receivers: подключения адресата к этому процессу
+        :return: True, если сообщение нужно сохранить
+        """
+        if self.pending is None or any(self.states.get(w_sock) == STATE_READY for w_sock in receivers):
+            return False
+        workers = self.remote_users.get(username, ())
+        if not receivers:
+            return not workers
+        return all(self.bus.index < index for index in workers)
+
+    def update_remote_users(self, route, index):
+        """ Обновляет индекс пользователей, подключенных к другим процессам-обработчикам (режим кластера):
+        по нему личное сообщение пользователю, подключенному к другому процессу, не сохраняется в очереди.
+
+        :param route: '+' или '-' + username, '?' - процесс-обработчик index запущен заново
+            (его пользователи удаляются из индекса, а в ответ рассылаются свои подключенные пользователи)
+        :param index: номер процесса-обработчика
+        :return: None
+        """
+        if route == '?':
+            for username in list(self.remote_users):
+                self.update_remote_users('-' + username, index)
+            for username in self.users:
+                self.announce('+', username)
+            return
+        workers = self.remote_users.setdefault(route[1:], set())
+        if route[0] == '+':
+            workers.add(index)
+        else:
+            workers.discard(index)
+        if not workers:
+            del self.remote_users[route[1:]]
+
+    def announce(self, event, username=''):
+        """ Сообщает остальным процессам-обработчикам о подключении ('+') или отключении ('-') пользователя
+        или о запуске этого процесса ('?').
+
+        :param event: '+', '-' или '?'
+        :param username: имя пользователя
+        :return: None
+        """
+        if self.bus is not None:
+            self.bus.publish((event + username).encode('utf-8') + b'\n' + str(self.bus.index).encode('utf-8'))
+
+    def add_route(self, sock, username):
+        """ Добавляет подключение клиента в индекс username-сокеты.
+
+        :param sock: сокет клиента
+        :param username: имя пользователя
+        :return: None
+        """
+        if username not in self.users:
+            self.announce('+', username)
+        self.users.setdefault(username, set()).add(sock)
+
+    def remove_route(self, sock, username):
+        """ Удаляет подключение клиента из индекса username-сокеты.
+
+        :param sock: сокет клиента
+        :param username: имя пользователя
+        :return: None
+        """
+        connections = self.users.get(username)
+        if connections is not None:
+            connections.discard(sock)
+            if not connections:
+                del self.users[username]
+                self.announce('-', username)
+
+    def join(self, sock, group):
+        """ Добавляет подключение клиента в индекс участников группы.
+
+        :param sock: сокет клиента
+        :param group: имя группы
+        :return: None
+        """
+        self.groups.setdefault(group, set()).add(sock)
+        self.memberships.setdefault(sock, set()).add(group)
+
+    def leave(self, sock, group):
+        """ Удаляет подключение клиента из индекса участников группы.
+
+        :param sock: сокет клиента
+        :param group: имя группы
+        :return: None
+        """
+        self.memberships.get(sock, set()).discard(group)
+        members = self.groups.get(group)
+        if members is not None:
+            members.discard(sock)
+            if not members:
+                del self.groups[group]
+
+    def leave_all(self, sock):
+        """ Удаляет подключение клиента из индексов всех групп (при отключении клиента).
+
+        :param sock: сокет клиента
+        :return: None
+        """
+        for group in list(self.memberships.get(sock, ())):
+            self.leave(sock, group)
+        self.memberships.pop(sock, None)
+
+    def presence(self, sock, received_msg, client_ip):
+        """ Обрабатывает presence-сообщение клиента: добавляет клиента в базу (если его там еще нет),
+        записывает время входа и отвечает клиенту 'OK', после чего клиент должен запросить список контактов.
+
+        :param sock: сокет клиента
+        :param received_msg: словарь presence-сообщения
+        :param client_ip: IP-адрес клиента
+        :return: None
+        """
+        username = received_msg['user']['account_name']
+        self.clients[sock] = username
+        self.add_route(sock, username)
+
+        def job(repo):
+            groups = []
+            if not repo.client_exists(username):
+                repo.add_client(username)
+                print('Клиент добавлен в базу: ', username)
+            else:
+                print('Клиент уже есть в базе: ', username)
+                # Членство в группах читается из БД один раз при подключении
+                groups = repo.get_groups(username)
+            repo.add_logon(username, client_ip)
+            # repo.get_logon_history(username)
+            return groups
+
+        def done(groups):
+            for group in groups:
+                self.join(sock, group)
+            self.states[sock] = STATE_CONTACTS
+            # Отправка ответа клиенту
+            self.send_to(sock, response_bytes(200))
+        self.db_call(sock, job, done)
+
+    def send_contacts(self, sock):
+        """ Отвечает на запрос get_contacts: отправляет клиенту ответ 202 с количеством контактов,
+        а затем сообщение contact_list со списком имен контактов, после чего клиент может работать в чате.
+        Клиенту без кадрирования список контактов отправляется с задержкой CONTACTS_DELAY
+        (без блокировки основного цикла), чтобы он получил два сообщения двумя отдельными recv.
+        Сериализованный список контактов хранится в кеше до изменения контактов пользователя,
+        поэтому при повторном входе из БД читается только версия списка: контакты могут измениться и в обход
+        сервера (bulk_import.py), и кеш, версия которого не совпадает с версией в БД, не используется.
+
+        :param sock: сокет клиента
+        :return: None
+        """
+        username = self.clients[sock]
+        cached = self.contact_lists.get(username)
+
+        def job(repo):
+            if cached is not None and repo.get_contact_version(username) == cached[2]:
+                return None  # список в кеше не устарел
+            return repo.get_contact_list(username)
+
+        def done(result):
+            if result is None:
+                if username in self.contact_lists:
+                    self.contact_lists.move_to_end(username)
+                self.send_contact_list(sock, *cached[:2])
+                return
+            contact_names, list_version = result
+            entry = (len(contact_names),
+                     JIMLiteMsg(action='contact_list', message=contact_names, version=list_version).to_template(),
+                     list_version)
+            # Список, прочитанный до изменения контактов, в кеш не попадает
+            if version == self.contact_version:
+                self.cache_contacts(username, entry)
+            self.send_contact_list(sock, *entry[:2])
+
+        version = self.contact_version
+        self.db_call(sock, job, done)
+
+    def sync_contacts(self, sock, version):
+        """ Отвечает на запрос sync_contacts: отправляет клиенту ответ 202 с количеством изменений и сообщение
+        contact_changes с контактами, добавленными (message) и удаленными (removed) после версии version его копии
+        списка, и новой версией списка. Если изменений в журнале нет (или у клиента нет копии списка - версия 0),
+        отправляется полный список, как на запрос get_contacts. Если версия копии совпадает с версией списка
+        в кеше и в БД, журнал изменений не читается.
+
+        :param sock: сокет клиента
+        :param version: версия копии списка контактов клиента
+        :return: None
+        """
+        username = self.clients[sock]
+        cached = self.contact_lists.get(username)
+
+        def job(repo):
+            if cached is not None and cached[2] == version and repo.get_contact_version(username) == version:
+                return version, [], []
+            return repo.get_contact_changes(username, version)
+
+        def done(changes):
+            if changes is None:
+                self.send_contacts(sock)
+            else:
+                self.send_contact_changes(sock, *changes)
+
+        if version <= 0:
+            self.send_contacts(sock)
+            return
+        self.db_call(sock, job, done)
+
+    def send_contact_changes(self, sock, version, added, removed):
+        """ Отправляет клиенту ответ 202 и сообщение contact_changes, после чего клиент может работать в чате.
+
+        :param sock: сокет клиента
+        :param version: версия списка контактов после изменений
+        :param added: имена добавленных контактов
+        :param removed: имена удаленных контактов
+        :return: None
+        """
+        template = JIMLiteMsg(action='contact_changes', message=added, version=version, removed=removed).to_template()
+        self.send_contact_list(sock, len(added) + len(removed), template)
+
+    def send_contact_list(self, sock, quantity, template):
+        """ Отправляет клиенту ответ 202 и сообщение contact_list (или contact_changes), после чего клиент может
+        работать в чате.
+
+        :param sock: сокет клиента
+        :param quantity: количество контактов (изменений)
+        :param template: шаблон байтов сообщения contact_list (см. JIMLiteMsg.to_template)
+        :return: None
+        """
+        def ready():
+            self.states[sock] = STATE_READY
+            self.start_forwarding(sock)
+
+        self.send_to(sock, response_bytes(202, quantity=quantity))
+        contacts_msg = template % (time.time(),)
+        if self.decoders.get(sock) is None:
+            # Пока отложенный список не передан в сокет, клиент не получает других сообщений,
+            # иначе они придут вместе со списком и клиент примет их за список
+            self.send_later(sock, contacts_msg, CONTACTS_DELAY, ready)
+        else:
+            self.send_to(sock, contacts_msg)
+            ready()
+
+    def store_pending(self, sock, target, data):
+        """ Сохраняет личное сообщение неподключенному пользователю в его очереди (store-and-forward).
+        Существование пользователя проверяется запросом к БД, чтобы не заводить очереди для ошибочных имен,
+        поэтому сообщение дописывается в очередь в потоке пула (и даже если отправитель уже отключился).
+
+        :param sock: сокет отправителя
+        :param target: имя адресата
+        :param data: байты сообщения
+        :return: None
+        """
+        def job(repo):
+            if not repo.client_exists(target):
+                print('Сообщение несуществующему пользователю {} отброшено'.format(target))
+            elif not self.pending.put(target, data):
+                print('Очередь сообщений пользователя {} переполнена, сообщение отброшено'.format(target))
+
+        def done(result):
+            # Адресат мог подключиться, пока выполнялся запрос к БД: его очередь забирается еще раз
+            for w_sock in list(self.users.get(target, ())):
+                if self.states.get(w_sock) == STATE_READY:
+                    self.start_forwarding(w_sock)
+        self.db_call(sock, job, done)
+
+    def start_forwarding(self, sock):
+        """ Начинает отправку клиенту сообщений, накопившихся в его очереди, пока он не был подключен
+        (сообщения отправляются частями функцией forward_pending).
+
+        Очередь пользователя отправляется только одному его подключению: пока она отправляется, повторно она
+        не забирается (иначе сообщения пришли бы дважды).
+
+        :param sock: сокет клиента
+        :return: None
+        """
+        if self.pending is None or sock in self.forwarding or self.clients[sock] in self.claims:
+            return
+        reader = self.pending.claim(self.clients[sock])
+        if reader is not None:
+            # Клиенту без кадрирования сообщения отправляются после отложенного списка контактов
+            delay = 0 if self.decoders.get(sock) is not None else 2 * CONTACTS_DELAY
+            self.forwarding[sock] = (reader, time.monotonic() + delay)
+            self.claims[self.clients[sock]] = sock
+
+    def stop_forwarding(self, sock, username):
+        """ Прекращает отправку очереди отключающемуся клиенту: смещение неотправленной части сохраняется,
+        и ее отправка продолжается другому подключению того же пользователя (или при следующем входе).
+
+        :param sock: сокет клиента (уже удаленный из индекса username-сокеты)
+        :param username: имя пользователя
+        :return: None
+        """
+        forwarding = self.forwarding.pop(sock, None)
+        if forwarding is None:
+            return
+        forwarding[0].close()
+        if self.claims.get(username) is sock:
+            del self.claims[username]
+        for other in list(self.users.get(username, ())):
+            if self.states.get(other) == STATE_READY:
+                self.start_forwarding(other)
+                break
+
+    def forward_pending(self):
+        """ Отправляет клиентам очередную часть сообщений из их очередей: клиенту с кадрированием -
+        не больше FORWARD_BATCH сообщений, клиенту без кадрирования - одно сообщение раз в CONTACTS_DELAY, и только
+        пока очередь исходящих сообщений клиента не выше нижней границы (клиенту без кадрирования - пока она не пуста,
+        чтобы сообщение не склеилось с предыдущим), поэтому клиент с большой очередью не задерживает остальных.
+        Сообщения, сохраненные в очередь во время отправки, забираются и отправляются следом.
+
+        :return: None
+        """
+        now = time.monotonic()
+        for sock, (reader, next_time) in list(self.forwarding.items()):
+            queue = self.outbox.get(sock)
+            framed = self.decoders.get(sock) is not None
+            if now < next_time or (queue is not None and queue.size > (self.low_water if framed else 0)):
+                continue
+            for data in reader.read(FORWARD_BATCH if framed else 1):
+                self.send_to(sock, data)
+            if sock not in self.forwarding:
+                continue  # клиент отключен при отправке
+            if reader.done:
+                reader.close()
+                # Сообщения, сохраненные в очередь во время отправки
+                reader = self.pending.claim(self.clients[sock])
+                if reader is None:
+                    del self.forwarding[sock]
+                    del self.claims[self.clients[sock]]
+                    continue
+            self.forwarding[sock] = (reader, now + (0 if framed else CONTACTS_DELAY))
+
+    def cache_contacts(self, username, cached):
+        """ Сохраняет сериализованный список контактов пользователя в кеше (вытесняя давно не использованные).
+
+        :param username: имя пользователя
+        :param cached: кортеж (количество контактов, шаблон сообщения contact_list, версия списка)
+        :return: None
+        """
+        self.contact_lists[username] = cached
+        self.contact_lists.move_to_end(username)
+        if len(self.contact_lists) > CONTACT_CACHE_SIZE:
+            self.contact_lists.popitem(last=False)
+
+    def invalidate_contacts(self, username):
+        """ Удаляет из кеша список контактов пользователя после его изменения
+        (в режиме кластера - и в кешах остальных процессов-обработчиков).
+
+        :param username: имя пользователя
+        :return: None
+        """
+        self.contact_version += 1
+        self.contact_lists.pop(username, None)
+        if self.bus is not None:
+            self.bus.publish(b'!' + username.encode('utf-8') + b'\n')
+
+    def send_later(self, sock, data, delay, done=None):
+        """ Откладывает отправку клиенту байтов data на delay секунд.
+        Отложенные отправки выполняются основным циклом (функция run_timers).
+
+        :param sock: сокет клиента
+        :param data: отправляемые байты
+        :param delay: задержка, с
+        :param done: функция без аргументов, вызываемая после отправки (см. when_sent)
+        :return: None
+        """
+        heapq.heappush(self.timers, (time.monotonic() + delay, next(self.timer_seq), sock, data, done))
+
+    def run_timers(self):
+        """ Выполняет отложенные отправки, время которых наступило.
+
+        :return: время в секундах до следующей отложенной отправки или None, если их нет
+        """
+        now = time.monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            _, _, sock, data, done = heapq.heappop(self.timers)
+            # Клиент мог отключиться
+            if sock in self.clients:
                 try:
-                    self.dwh.del_contact(self.clients[sock], requests[sock]['user']['account_name'])
-                    resp = JIMResponse(response_code=200).resp
-                    print(requests[sock]['user']['account_name'], 'deleted from contact list of', self.clients[sock])
-                    sock.send(json.dumps(resp).encode('utf-8'))
-                except Exception as e:
-                    resp = JIMResponse(response_code=500).resp
-                    sock.send(json.dumps(resp).encode('utf-8'))
-            elif requests[sock]['action'] == 'msg':
-                for w_sock in w_clients:
-                    if sock != w_sock:
-                        try:
-                            resp = JIMMsg(action='msg', message=requests[sock]['message']).msg
-                            test_len += len(resp)
-                            #print(resp)
-                            w_sock.send(json.dumps(resp).encode('utf-8'))
-                        except:
-                            print('Клиент {} {} отключился'.format(w_sock.fileno(), w_sock.getpeername()))
-                            w_sock.close()
-                            self.clients.pop(w_sock)
+                    self.send_to(sock, data)
+                except OSError:
+                    self.disconnect(sock)
+                if done is not None:
+                    self.when_sent(sock, done)
+        if self.timers:
+            return max(self.timers[0][0] - now, 0)
+        return None
+
+    def send_to(self, sock, data, sender=None, framed=None):
+        """ Ставит байты data в очередь исходящих сообщений клиента.
+        Отправка выполняется методом flush_outbox, когда сокет готов к записи (в режиме reactor сокет
+        регистрируется в селекторе на запись, пока очередь не пуста).
+        Если очередь клиента превысила верхнюю границу, применяется политика для медленного клиента:
+        - POLICY_DROP: из очереди отбрасываются самые старые сообщения
+        - POLICY_DISCONNECT: клиент отключается
+        - POLICY_PAUSE: сообщение ставится в очередь, а чтение запросов отправителя приостанавливается,
+          пока очередь не опустеет до нижней границы
+
+        :param sock: сокет клиента
+        :param data: отправляемые байты
+        :param sender: сокет клиента, запрос которого привел к отправке (по умолчанию - сам клиент)
+        :param framed: уже упакованный в кадр data (см. frame)
+        :return: None
+        """
+        queue = self.outbox.get(sock)
+        if queue is None:
+            return  # клиент уже отключен
+        if queue.size >= self.high_water:
+            if self.slow_policy == POLICY_DISCONNECT:
+                print('Клиент {} {} не успевает принимать сообщения'.format(sock.fileno(), self.clients.get(sock)))
+                self.disconnect(sock)
+                return
+            elif self.slow_policy == POLICY_DROP:
+                queue.drop_oldest(self.high_water - len(data))
             else:
-                raise Exception('Сообщение должно иметь action "msg" или "add_contact"!')
-        return test_len
+                self.pause(sender if sender is not None else sock, queue)
+        was_empty = not queue
+        queue.push(self.frame(sock, data, framed))
+        if was_empty:
+            self.update_events(sock)
+
+    def when_sent(self, sock, done):
+        """ Вызывает done, когда все поставленные в очередь клиента сообщения будут переданы в сокет
+        (чтобы следующие сообщения не ушли клиенту тем же вызовом sendmsg).
+        Если клиент отключится раньше, done не вызывается.
+
+        :param sock: сокет клиента
+        :param done: функция без аргументов
+        :return: None
+        """
+        queue = self.outbox.get(sock)
+        if queue is None:
+            return  # клиент уже отключен
+        if queue:
+            queue.on_sent(done)
+        else:
+            done()
+
+    def flush_outbox(self, sock):
+        """ Отправляет клиенту накопленные в очереди данные.
+        Когда очередь опустела до нижней границы, возобновляет приостановленных из-за нее отправителей.
+
+        :param sock: сокет клиента
+        :return: None
+        """
+        queue = self.outbox[sock]
+        try:
+            queue.send(sock)
+        except OSError:
+            print('Клиент {} {} отключился'.format(sock.fileno(), self.clients.get(sock)))
+            self.disconnect(sock)
+            return
+        if queue.size <= self.low_water:
+            self.resume(queue)
+        for done in queue.pop_sent():
+            if sock in self.clients:
+                done()
+        if not queue:
+            self.update_events(sock)
+
+    def pause(self, sender, queue):
+        """ Приостанавливает чтение запросов отправителя из-за переполнения очереди получателя (POLICY_PAUSE).
+
+        :param sender: сокет отправителя
+        :param queue: переполненная очередь получателя
+        :return: None
+        """
+        if sender in queue.paused_senders:
+            return
+        queue.paused_senders.add(sender)
+        self.suspend(sender)
+
+    def resume(self, queue):
+        """ Возобновляет чтение запросов отправителей, приостановленных из-за переполнения очереди queue.
+
+        :param queue: очередь получателя
+        :return: None
+        """
+        while queue.paused_senders:
+            self.unsuspend(queue.paused_senders.pop())
+
+    def suspend(self, sock):
+        """ Приостанавливает чтение запросов клиента (переполнение очереди получателя или запрос к БД).
+
+        :param sock: сокет клиента
+        :return: None
+        """
+        self.paused[sock] = self.paused.get(sock, 0) + 1
+        if self.paused[sock] == 1:
+            self.update_events(sock)
+
+    def unsuspend(self, sock):
+        """ Снимает одну из причин приостановки чтения запросов клиента; чтение возобновляется,
+        когда причин не осталось.
+
+        :param sock: сокет клиента
+        :return: None
+        """
+        if sock not in self.paused:
+            return  # клиент уже отключился
+        self.paused[sock] -= 1
+        if not self.paused[sock]:
+            del self.paused[sock]
+            self.update_events(sock)
+
+    def update_events(self, sock):
+        """ Приводит регистрацию сокета в селекторе (режим reactor) в соответствие с его состоянием:
+        на чтение - если клиент не приостановлен, на запись - если очередь исходящих сообщений не пуста.
+
+        :param sock: сокет клиента
+        :return: None
+        """
+        if self.selector is None or sock not in self.clients:
+            return
+        events = 0
+        if sock not in self.paused:
+            events |= selectors.EVENT_READ
+        if self.outbox[sock]:
+            events |= selectors.EVENT_WRITE
+        registered = sock in self.selector.get_map()
+        if not events:
+            if registered:
+                self.selector.unregister(sock)
+        elif not registered:
+            self.selector.register(sock, events)
+        elif self.selector.get_key(sock).events != events:
+            self.selector.modify(sock, events)
+
+    def accept_client(self):
+        """ Принимает все ожидающие подключения и регистрирует сокеты клиентов в селекторе (режим reactor).
+        Presence-сообщения клиентов будут обработаны в общем цикле чтения.
+
+        :return: None
+        """
+        while True:
+            try:
+                conn, addr = self.s.accept()
+            except BlockingIOError:
+                return
+            print("Получен запрос на соединение с %s" % str(addr))
+            conn.setblocking(False)
+            # Сообщения клиенту склеиваются в очереди и отправляются одним sendmsg, поэтому алгоритм Нейгла не нужен
+            conn.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+            self.new_client(conn)
+            self.selector.register(conn, selectors.EVENT_READ)
+
+    def disconnect(self, sock):
+        """ Удаляет клиента из списка клиентов и закрывает его сокет.
+
+        :param sock: сокет клиента
+        :return: None
+        """
+        username = self.clients.pop(sock, None)
+        self.remove_route(sock, username)
+        self.leave_all(sock)
+        self.stop_forwarding(sock, username)
+        queue = self.outbox.pop(sock, None)
+        if queue is not None:
+            self.resume(queue)
+        self.paused.pop(sock, None)
+        self.decoders.pop(sock, None)
+        self.states.pop(sock, None)
+        self.backlog.discard(sock)
+        if self.selector is not None:
+            try:
+                self.selector.unregister(sock)
+            except (KeyError, ValueError):
+                pass
+        sock.close()
 
     @log
     def mainloop(self):
         """ Основная функция:
         - в цикле:
-            - если новый клиент подключился, добавляет его в список клиентов, принимает presence-сообщение и отвечает 'OK'
+            - если новый клиент подключился, добавляет его в список клиентов (presence-сообщение и запрос get_contacts
+              обрабатываются в общем цикле чтения, не блокируя остальных клиентов)
             - делит всех клиентов на писателей и читателей
             - сохраняет запросы клиентов-писателей с помощью функции read_requests
             - отправляет сообщения клиентам-читателям с помощью функции write_responses
@@ -167,48 +1447,18 @@ class MsgTCPServer():
 
         self.create_db_session() # создание сессии для работы с БД
 
-        while True:
+        while self.running:
             try:
                 conn, addr = self.s.accept()  # Проверка подключений
             except OSError as e:
                 pass  # timeout вышел
             else:
                 print("Получен запрос на соединение с %s" % str(addr))
-                # self.clients.append(conn)
-                self.clients[conn] = ''
-                # Принятие presence-сообщения клиента
-                received_msg = json.loads(conn.recv(1024).decode('utf-8'))
-                # Формирование ответа клиенту
-                if received_msg['action'] == 'presence':
-                    username = received_msg['user']['account_name']
-                    self.clients[conn] = username
-                    if not self.dwh.client_exists(username):
-                        self.dwh.add_client(username)
-                        print('Клиент добавлен в базу: ', self.dwh.get_client_by_username(username))
-                    else:
-                        print('Клиент уже есть в базе: ', self.dwh.get_client_by_username(username))
-                    self.dwh.add_logon(username, addr[0])
-                    # self.dwh.get_logon_history(username)
-                    response = JIMResponse(200).resp
-                    # Отправка ответа клиенту
-                    conn.send(json.dumps(response).encode('utf-8'))
-
-                    received_msg_get_contacts = json.loads(conn.recv(1024).decode('utf-8'))
-                    if received_msg_get_contacts['action'] == 'get_contacts':
-                        contacts = self.dwh.get_contacts(username)
-                        accept = JIMResponse(response_code=202, quantity=len(contacts)).resp
-                        conn.send(json.dumps(accept).encode('utf-8'))
-
-                        time.sleep(0.1)
-                        contact_names = []
-                        for i in range(accept['quantity']):
-                            contact_names.append(contacts[i].Name)
-                        contacts_msg = JIMMsg(action='contact_list', message=contact_names).msg
-                        conn.send((json.dumps(contacts_msg).encode('utf-8')))
-                        #    contact = JIMMsg(action='contact_list', login=contacts[i].Name).msg
-                        #    conn.send(json.dumps(contact).encode('utf-8'))
-                else:
-                    raise Exception('Первым сообщением должен быть presence!')
+                # Процедура подключения клиента выполняется в общем цикле чтения запросов
+                conn.setblocking(False)
+                # Сообщения клиенту склеиваются в очереди и отправляются одним sendmsg, поэтому алгоритм Нейгла не нужен
+                conn.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+                self.new_client(conn)
             finally:
                 wait = 0
                 r = []
@@ -218,9 +1468,95 @@ class MsgTCPServer():
                     #print(r, w)
                 except Exception as e:
                    pass
+                # Добавляем клиентов, у которых уже есть полученные, но еще не обработанные запросы,
+                # и исключаем клиентов, чтение которых приостановлено
+                r = [sock for sock in set(r) | self.backlog if sock not in self.paused]
 
+                self.run_timers()  # Выполним отложенные отправки
+                self.run_db_callbacks()  # Обработаем результаты запросов к БД
                 requests = self.read_requests(r)  # Сохраним запросы клиентов на отправку сообщений
-                self.write_responses(requests, w)  # Выполним отправку сообщений клиентам
+                self.write_responses(requests, w)  # Поставим сообщения клиентам в очереди
+                self.forward_pending()  # Отправим сообщения из очередей вернувшимся клиентам
+                if self.msglog is not None:
+                    self.msglog.flush()
+                for sock in w:
+                    # Клиент мог отключиться в этой же итерации цикла
+                    if self.outbox.get(sock):
+                        self.flush_outbox(sock)  # Выполним отправку сообщений клиентам
+
+    @log
+    def reactor_loop(self):
+        """ Основная функция в режиме reactor (событийно-ориентированный цикл на базе selectors/epoll):
+        - слушающий сокет и сокеты всех клиентов зарегистрированы в одном селекторе
+        - сокет клиента регистрируется на запись, только пока у него есть неотправленные данные
+        - цикл спит в select, пока какой-либо из сокетов не станет готов, поэтому простаивающий
+          сервер не тратит процессорное время
+        - запросы готовых к чтению клиентов обрабатываются функциями read_requests и write_responses,
+          а ответы ставятся в очереди сокетов
+
+        :return: None
+        """
+
+        self.create_db_session() # создание сессии для работы с БД
+
+        self.s.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.s, selectors.EVENT_READ)
+        self.selector.register(self.wakeup[0], selectors.EVENT_READ, 'db')
+        if self.bus is not None:
+            self.selector.register(self.bus.sock, selectors.EVENT_READ)
+
+        while self.running:
+            readable = []
+            timeout = self.run_timers()  # Выполним отложенные отправки
+            if self.forwarding:
+                # Пока клиентам отправляются сообщения из очередей, цикл не засыпает надолго
+                timeout = FORWARD_INTERVAL if timeout is None else min(timeout, FORWARD_INTERVAL)
+            backlog = [sock for sock in self.backlog if sock not in self.paused]
+            # Если у кого-то из клиентов уже есть полученные запросы, не ждем событий
+            for key, mask in self.selector.select(0 if backlog else timeout):
+                sock = key.fileobj
+                if sock is self.s:
+                    self.accept_client()
+                    continue
+                if self.bus is not None and sock is self.bus.sock:
+                    for data in self.bus.receive():
+                        self.deliver_remote(data)
+                    continue
+                if key.data == 'bus':
+                    self.bus.flush(sock)  # канал шины к другому обработчику снова готов к записи
+                    continue
+                if key.data == 'db':
+                    self.run_db_callbacks()  # завершились запросы к БД
+                    continue
+                if mask & selectors.EVENT_WRITE:
+                    self.flush_outbox(sock)
+                # Сокет мог быть закрыт при отправке данных
+                if mask & selectors.EVENT_READ and sock in self.clients and sock not in self.backlog:
+                    readable.append(sock)
+            readable.extend(sock for sock in self.backlog if sock not in self.paused)
+
+            requests = self.read_requests(readable)  # Сохраним запросы клиентов на отправку сообщений
+            # Отправка ставит данные в очереди, поэтому получателями являются все подключенные клиенты
+            self.write_responses(requests, list(self.clients))
+            self.forward_pending()  # Отправим сообщения из очередей вернувшимся клиентам
+            if self.msglog is not None:
+                self.msglog.flush()
+            if self.bus is not None:
+                self.update_bus_events()
+
+    def update_bus_events(self):
+        """ Регистрирует в селекторе на запись каналы шины, в очередях которых есть неотправленные сообщения
+        (режим кластера).
+
+        :return: None
+        """
+        registered = self.selector.get_map()
+        for link in self.bus.links:
+            if self.bus.pending[link] and link not in registered:
+                self.selector.register(link, selectors.EVENT_WRITE, 'bus')
+            elif not self.bus.pending[link] and link in registered:
+                self.selector.unregister(link)
 
 
 if __name__ == '__main__':
@@ -229,8 +1565,34 @@ if __name__ == '__main__':
     namespace = parser.parse_args()
     address = (namespace.a, int(namespace.p))
 
-    # Создаем сервер и запускаем его основной цикл
-    serv = MsgTCPServer(address)
-    serv.mainloop()
+    # Создаем сервер и запускаем его основной цикл в выбранном режиме
+    try:
+        storage = load_storage_profile(namespace.storage, namespace.storage_config)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    options = dict(high_water=namespace.high_water, low_water=namespace.low_water, slow_policy=namespace.slow_policy,
+                   db_workers=namespace.db_workers, storage=storage,
+                   msglog=path.join(path.dirname(path.abspath(__file__)), namespace.msglog) if namespace.msglog else None,
+                   pending=path.join(path.dirname(path.abspath(__file__)), namespace.pending) if namespace.pending else None)
+    if namespace.workers > 1:
+        from cluster import run_cluster
+        run_cluster(address, namespace.workers, **options)
+    else:
+        if namespace.m == 'async':
+            from async_server import AsyncMsgServer
+            serv = AsyncMsgServer(address, **options)
+        else:
+            serv = MsgTCPServer(address, **options)
+        # По SIGTERM сервер завершается так же, как по Ctrl+C: с записью отложенных данных в БД
+        signal.signal(signal.SIGTERM, lambda signum, frame: serv.stop())
+        try:
+            if namespace.m == 'reactor':
+                serv.reactor_loop()
+            else:
+                serv.mainloop()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            serv.close_db_session()
 
 
@@ -0,0 +1,108 @@
+# Сравнение профилей хранилища сервера (запуск: python storage_bench.py [-t <секунды>] [-r <потоков чтения>]).
+# Для каждого профиля создается временная база с клиентами и списками контактов, после чего один поток
+# записывает входы клиентов (по транзакции на вход, как Repo.add_logon без потока отложенной записи),
+# а потоки чтения одновременно запрашивают списки контактов (как get_contacts при входе клиентов).
+# Выводится количество транзакций записи в секунду и задержки чтения.
+
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+from sqlalchemy.orm import sessionmaker, scoped_session
+from server import create_db_engine, load_storage_profile, STORAGE_PROFILES
+from repo.server_repo import Repo
+
+# Размер тестовой базы
+CLIENTS = 2000
+CONTACTS_PER_CLIENT = 50
+
+
+def create_parser():
+    """ Создает парсер аргументов командной строки.
+
+    :return: парсер
+    >>> create_parser().parse_args([])
+    Namespace(t=3.0, r=4, profiles=['default', 'wal'])
+    """
+    parser = argparse.ArgumentParser(description='Сравнение профилей хранилища сервера')
+    parser.add_argument('-t', type=float, default=3.0, help='длительность замера для каждого профиля, с')
+    parser.add_argument('-r', type=int, default=4, help='количество потоков чтения')
+    parser.add_argument('profiles', nargs='*', default=list(STORAGE_PROFILES), help='профили хранилища')
+    return parser
+
+
+def fill(repo):
+    """ Заполняет базу клиентами и списками контактов.
+
+    :param repo: хранилище
+    :return: список имен клиентов
+    """
+    names = ['user{}'.format(i) for i in range(CLIENTS)]
+    repo.add_clients_bulk((name, None) for name in names)
+    repo.add_contacts_bulk((name, contact) for name in names for contact in random.sample(names, CONTACTS_PER_CLIENT))
+    return names
+
+
+def bench(profile, duration, readers):
+    """ Замеряет запись и чтение одновременно для одного профиля.
+
+    :param profile: имя профиля хранилища
+    :param duration: длительность замера, с
+    :param readers: количество потоков чтения
+    :return: (транзакций записи в секунду, чтений в секунду, медиана и 99-й процентиль задержки чтения в мс,
+        количество ошибок)
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_db_engine(load_storage_profile(profile), threads=readers + 1,
+                                  db_path=os.path.join(directory, 'bench.db'))
+        Session = scoped_session(sessionmaker(bind=engine))
+        repo = Repo(Session)
+        names = fill(repo)
+        Session.remove()
+        stop = threading.Event()
+        writes = []
+        latencies = []
+        errors = []
+
+        def write():
+            while not stop.is_set():
+                try:
+                    repo.add_logon(random.choice(names), '127.0.0.1')
+                    writes.append(1)
+                except Exception as e:
+                    Session.rollback()
+                    errors.append(e)
+            Session.remove()
+
+        def read():
+            while not stop.is_set():
+                started = time.perf_counter()
+                try:
+                    repo.get_contact_names(random.choice(names))
+                    Session.commit()  # завершаем транзакцию чтения, чтобы не удерживать снимок базы
+                    latencies.append(time.perf_counter() - started)
+                except Exception as e:
+                    Session.rollback()
+                    errors.append(e)
+            Session.remove()
+
+        threads = [threading.Thread(target=write)] + [threading.Thread(target=read) for i in range(readers)]
+        for thread in threads:
+            thread.start()
+        time.sleep(duration)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        engine.dispose()
+    latencies.sort()
+    percentile = lambda p: latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1000 if latencies else 0
+    return len(writes) / duration, len(latencies) / duration, percentile(0.5), percentile(0.99), len(errors)
+
+
+if __name__ == '__main__':
+    namespace = create_parser().parse_args()
+    print('{:<10} {:>12} {:>12} {:>10} {:>10} {:>8}'.format('профиль', 'записей/с', 'чтений/с', 'p50, мс', 'p99, мс', 'ошибок'))
+    for profile in namespace.profiles:
+        print('{:<10} {:>12.0f} {:>12.0f} {:>10.2f} {:>10.2f} {:>8}'.format(profile, *bench(profile, namespace.t, namespace.r)))